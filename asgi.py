@@ -0,0 +1,290 @@
+import io
+import sys
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import abort, render_template, request, session
+from werkzeug.exceptions import HTTPException
+
+from app import create_app
+from async_services import (async_blog_service, async_db_session,
+                            async_engine, async_user_service)
+from config import Config
+from identity import UserMeta, is_loggedin, login_user, logout_user
+from metrics import request_metrics
+from pages import (check_post_visible, fresh_listing_page, fresh_post_page,
+                   lookup_listing_page, lookup_post_page, render_listing_page,
+                   render_post_page)
+from querybudget import QueryBudget, instrument_query_budgets
+from services import blog_service
+
+
+async def get_current_identity():
+    '''
+    Get the identity of the currently logged in user from the signed session.
+    Asyncio variant of identity.get_current_identity, verifying the identity with the async user service.
+    Once it has run, identity.get_current_identity trusts the refreshed session without a database round trip.
+    '''
+
+    if not is_loggedin():
+        return None
+
+    user_meta = UserMeta(**session['user'])
+    if time.time() - user_meta.verified_at < Config.USER_CACHE_TTL and \
+            not await async_user_service.is_changed_since(user_meta.id, user_meta.verified_at):
+        return user_meta
+
+    user = await async_user_service.fetch_cached_user(user_meta.id)
+    if user is None:
+        logout_user()
+        return None
+    login_user(user)
+    return UserMeta(**session['user'])
+
+
+@QueryBudget(5)
+async def index():
+    '''
+    Route for home page that also renders list of blog posts, one page at a time
+    Administrators can also see unpublished posts
+    '''
+
+    user = await get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    return await posts_listing_response('index', is_admin)
+
+
+@QueryBudget(4)
+async def tag_posts(tag):
+    '''
+    Route for the list of blog posts with a tag, one page at a time
+    Administrators can also see unpublished posts
+    '''
+
+    user = await get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    return await posts_listing_response('tag', is_admin, tag.strip().lower())
+
+
+@QueryBudget(7)
+async def view_post(id):
+    '''
+    Route for viewing a blog post by id - for all users
+    Administrators can view unpublished posts
+    '''
+
+    user = await get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    response = fresh_post_page(id)
+    if response is not None:
+        return response
+    lookup = lookup_post_page(id, await async_blog_service.fetch_post_stamp(id), is_admin)
+    if lookup.response is not None:
+        return lookup.response
+    post = await async_blog_service.fetch_post_by_id(id, 'view')
+    check_post_visible(post, is_admin)
+    comments = await async_blog_service.fetch_comments_page(id)
+    like_count = blog_service.fetch_like_count(post)
+    liked = user is not None and await async_blog_service.is_post_liked(id, user)
+    return lookup.store(render_post_page(post, comments, like_count, liked))
+
+
+@QueryBudget(3)
+async def post_comments(post_id):
+    '''
+    Route for loading the next page of comments of a blog post, as an HTML fragment - for all users
+    '''
+
+    user = await get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    check_post_visible(await async_blog_service.fetch_post_stamp(post_id), is_admin)
+    try:
+        comments = await async_blog_service.fetch_comments_page(
+            post_id, request.args.get('after'))
+    except ValueError:
+        abort(400, description="Invalid page")
+    return render_template('comments.html', post_id=post_id, comments=comments)
+
+
+async def posts_listing_response(route, is_admin, tag=None):
+    '''
+    Render a page of the blog post listing, optionally limited to a tag, through the page cache
+    '''
+
+    response = fresh_listing_page(route, tag)
+    if response is not None:
+        return response
+    lookup = lookup_listing_page(route, await async_blog_service.fetch_listing_stamp(), tag)
+    if lookup.response is not None:
+        return lookup.response
+    try:
+        page = await async_blog_service.fetch_posts_page(
+            is_admin, request.args.get('after'), profile='list', tag=tag)
+    except ValueError:
+        abort(400, description="Invalid page")
+    tag_counts = await async_blog_service.fetch_tag_counts() if tag is None else []
+    return lookup.store(render_listing_page(page, tag, tag_counts))
+
+
+def find_async_view(endpoint, view_args):
+    '''
+    Get the asyncio view serving a GET request to a Flask endpoint, None if the endpoint is only served by Flask
+    '''
+
+    if endpoint == 'blog.add_view_post':
+        return view_post if view_args.get('id') is not None else None
+    return ASYNC_VIEWS.get(endpoint)
+
+
+# Flask endpoints whose GET requests are served by asyncio views
+ASYNC_VIEWS = {
+    'blog.index': index,
+    'blog.tag_posts': tag_posts,
+    'blog.add_post_comment': post_comments,
+}
+
+
+class AsgiApplication:
+    '''
+    ASGI entry point serving the same routes as the Flask application, routed with its URL map.
+    The read only pages, which make up most of the traffic, are served by asyncio views on the async services,
+    so a worker keeps serving other requests while it waits on the database: GET requests to the endpoints
+    in ASYNC_VIEWS run the asyncio view in a Flask request context, so templates, sessions, error pages and
+    before and after request handlers work as in Flask. Every other request runs in the Flask application,
+    in a thread.
+    '''
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi_app = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET':
+            environ = build_environ(scope)
+            adapter = self.flask_app.url_map.bind_to_environ(environ)
+            try:
+                endpoint, view_args = adapter.match()
+            except HTTPException:
+                endpoint, view_args = None, {}
+            view = find_async_view(endpoint, view_args)
+            if view is not None:
+                await self.run_async_view(view, view_args, environ, send)
+                return
+        await self.wsgi_app(scope, receive, send)
+
+    async def run_async_view(self, view, view_args, environ, send):
+        '''
+        Run an asyncio view and send its response.
+        '''
+
+        ctx = self.flask_app.request_context(environ)
+        ctx.push()
+        try:
+            try:
+                rv = self.flask_app.preprocess_request()
+                if rv is None:
+                    rv = await view(**view_args)
+            except HTTPException as e:
+                rv = self.flask_app.handle_user_exception(e)
+            except Exception as e:
+                rv = self.flask_app.handle_exception(e)
+            response = self.flask_app.process_response(
+                self.flask_app.make_response(rv))
+        finally:
+            await async_db_session.remove()
+            ctx.pop()
+
+        headers = [(name.encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.get_wsgi_headers(environ).to_wsgi_list()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(response.iter_encoded())})
+        response.close()
+
+    async def lifespan(self, receive, send):
+        '''
+        Handle the startup and shutdown events of the server, closing the database connections on shutdown.
+        '''
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def build_environ(scope):
+    '''
+    Build the WSGI environment of a bodyless ASGI HTTP request, for the Flask request context
+    '''
+
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def create_application():
+    '''
+    Create the ASGI application serving the blog, e.g. with "uvicorn --factory asgi:create_application".
+    The Flask application is created by app.create_app, from Config.
+
+    Returns
+    -------
+    AsgiApplication
+        The application.
+    '''
+
+    flask_app = create_app()
+    if async_engine.sync_engine not in _instrumented_engines:
+        if Config.METRICS_ENABLED:
+            request_metrics.instrument_engine(async_engine.sync_engine)
+        if Config.QUERY_BUDGET_MODE != 'off':
+            instrument_query_budgets(async_engine.sync_engine)
+        _instrumented_engines.append(async_engine.sync_engine)
+    return AsgiApplication(flask_app)
+
+
+# Engines whose statements are timed and counted already, see create_application
+_instrumented_engines = []
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(create_application(), host='127.0.0.1', port=5000)
@@ -0,0 +1,212 @@
+import asyncio
+import os
+
+from sqlalchemy import and_, or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session
+from sqlalchemy.orm import defer, joinedload, sessionmaker
+
+from config import Config
+from database import create_async_db_engine
+from likes import like_aggregator
+from models import BlogPost, Comment, ContentStamp, Tag, TagCount, User
+from services import (COMMENTS_PER_PAGE, LOAD_PROFILES, POSTS_PER_PAGE,
+                      TAG_CLOUD_SIZE, CommentPage, PostPage, blog_service,
+                      user_service)
+
+async_engine = create_async_db_engine(Config)
+# One session per asyncio task, the counterpart of the thread scoped db_session
+async_db_session = async_scoped_session(sessionmaker(async_engine, class_=AsyncSession, autoflush=False,
+                                                     expire_on_commit=False),
+                                        scopefunc=asyncio.current_task)
+# Forked workers open their own connections, see database.dispose_after_fork
+os.register_at_fork(after_in_child=lambda: async_engine.sync_engine.dispose(close=False))
+
+
+class AsyncBlogService:
+    '''
+    Asyncio variant of the read operations of BlogService, used by the ASGI entry point.
+    Queries return the same objects and pages as BlogService, loaded with the same profiles. Relationships
+    cannot be lazy loaded from asyncio code, so pages may only use what their profile loads.
+    Cursors and in-memory like counts are shared with BlogService.
+    This is a singleton class.
+    '''
+
+    __instance = None
+
+    def __new__(cls):
+        if cls.__instance == None:
+            cls.__instance = super(AsyncBlogService, cls).__new__(cls)
+        return cls.__instance
+
+    async def fetch_posts_page(self, include_hidden=True, after=None, page_size=POSTS_PER_PAGE, profile=None,
+                               tag=None):
+        '''
+        Fetch a page of blog post summaries, newest first. See BlogService.fetch_posts_page.
+        '''
+
+        query = self._select_posts(profile).options(defer(BlogPost.content))
+        if not include_hidden:
+            query = query.where(BlogPost.is_visible == True)
+        if tag is not None:
+            query = query.where(BlogPost.id.in_(
+                select(Tag.blog_post_id).where(Tag.tag == tag)))
+        if after is not None:
+            post_date, id = blog_service._decode_cursor(after)
+            query = query.where(or_(BlogPost.post_date < post_date,
+                                    and_(BlogPost.post_date == post_date, BlogPost.id < id)))
+
+        result = await async_db_session.execute(
+            query.order_by(BlogPost.post_date.desc(), BlogPost.id.desc()).limit(page_size + 1))
+        posts = result.unique().scalars().all()
+
+        next_cursor = None
+        if len(posts) > page_size:
+            posts = posts[:page_size]
+            next_cursor = blog_service._encode_cursor(
+                posts[-1].post_date, posts[-1].id)
+        return PostPage(posts, next_cursor)
+
+    async def fetch_post_by_id(self, id, profile=None):
+        '''
+        Fetch a blog post by id. See BlogService.fetch_post_by_id.
+        '''
+
+        result = await async_db_session.execute(self._select_posts(profile).where(BlogPost.id == id))
+        blog_post = result.unique().scalars().first()
+        if blog_post is not None and profile == 'view' and blog_post.content_html is None:
+            # Not rendered yet, see BlogService._render_missing_html
+            content = await async_db_session.execute(select(BlogPost.content).where(BlogPost.id == id))
+            blog_service._set_rendered_html([blog_post], {id: content.scalar()})
+        return blog_post
+
+    async def fetch_tag_counts(self, limit=TAG_CLOUD_SIZE):
+        '''
+        Fetch the most used tags with the number of published posts carrying them. See BlogService.fetch_tag_counts.
+        '''
+
+        result = await async_db_session.execute(
+            select(TagCount).where(TagCount.post_count > 0)
+            .order_by(TagCount.post_count.desc(), TagCount.tag).limit(limit))
+        return result.scalars().all()
+
+    async def fetch_post_stamp(self, id):
+        '''
+        Fetch the version information of a blog post without loading its content. See BlogService.fetch_post_stamp.
+        '''
+
+        result = await async_db_session.execute(
+            select(BlogPost.id, BlogPost.is_visible, BlogPost.version, BlogPost.updated_at)
+            .where(BlogPost.id == id))
+        return result.first()
+
+    async def fetch_listing_stamp(self):
+        '''
+        Fetch the version information of the blog post listing. See BlogService.fetch_listing_stamp.
+        '''
+
+        result = await async_db_session.execute(select(ContentStamp).where(ContentStamp.name == 'posts'))
+        return result.scalars().first()
+
+    async def fetch_comments_page(self, post_id, after=None, page_size=COMMENTS_PER_PAGE):
+        '''
+        Fetch a page of the comments of a blog post, oldest first. See BlogService.fetch_comments_page.
+        '''
+
+        query = select(Comment).options(joinedload(Comment.user)) \
+            .where(Comment.blog_post_id == post_id)
+        if after is not None:
+            comment_date, id = blog_service._decode_cursor(after)
+            query = query.where(or_(Comment.comment_date > comment_date,
+                                    and_(Comment.comment_date == comment_date, Comment.id > id)))
+
+        result = await async_db_session.execute(
+            query.order_by(Comment.comment_date, Comment.id).limit(page_size + 1))
+        comments = result.scalars().all()
+
+        next_cursor = None
+        if len(comments) > page_size:
+            comments = comments[:page_size]
+            next_cursor = blog_service._encode_cursor(
+                comments[-1].comment_date, comments[-1].id)
+        return CommentPage(comments, next_cursor)
+
+    async def is_post_liked(self, post_id, user):
+        '''
+        Check whether a user likes a blog post, including likes that are not written to the database yet.
+        See BlogService.is_post_liked.
+        '''
+
+        state = like_aggregator.pending_state(post_id, user.id)
+        if state is not None:
+            return state
+        result = await async_db_session.execute(text(
+            "SELECT 1 FROM post_likes WHERE blog_post_id = :blog_post_id AND user_id = :user_id"),
+            {'blog_post_id': post_id, 'user_id': user.id})
+        return result.first() is not None
+
+    def _select_posts(self, profile):
+        '''
+        Private method that starts a blog post query with the eager loading options of the given profile.
+        '''
+
+        query = select(BlogPost)
+        if profile is None:
+            return query
+        if profile not in LOAD_PROFILES:
+            raise ValueError("Unknown loading profile: {}".format(profile))
+        return query.options(*LOAD_PROFILES[profile]())
+
+
+class AsyncUserService:
+    '''
+    Asyncio variant of the read operations of UserService, used by the ASGI entry point.
+    It shares the user cache of UserService, so users changed through either service are reloaded by both.
+    This is a singleton class.
+    '''
+
+    __instance = None
+
+    def __new__(cls):
+        if cls.__instance == None:
+            cls.__instance = super(AsyncUserService, cls).__new__(cls)
+            cls.__instance._user_cache = user_service._user_cache
+        return cls.__instance
+
+    async def fetch_user_by_id(self, id):
+        '''
+        Fetch a user by id. See UserService.fetch_user_by_id.
+        '''
+
+        result = await async_db_session.execute(select(User).where(User.id == id))
+        return result.scalars().first()
+
+    async def fetch_cached_user(self, id):
+        '''
+        Fetch a user by id, served from the short lived in-memory user cache when possible.
+        See UserService.fetch_cached_user.
+        '''
+
+        user = self._user_cache.get(id)
+        if user is not None:
+            return user
+
+        user = await self.fetch_user_by_id(id)
+        if user is not None:
+            async_db_session.expunge(user)
+            self._user_cache.put(id, user)
+        return user
+
+    async def is_changed_since(self, id, timestamp):
+        '''
+        Check whether a user was changed after the given time, by any process. See UserService.is_changed_since,
+        whose record of changed users it shares, and which it reads without blocking the event loop.
+        '''
+
+        if user_service._poll_due():
+            result = await async_db_session.execute(user_service._select_changes())
+            user_service._apply_changes(result.fetchall())
+        return user_service._changed_at.get(id, 0) > timestamp
+
+
+async_blog_service = AsyncBlogService()
+async_user_service = AsyncUserService()
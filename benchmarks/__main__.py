@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Seed a synthetic dataset and benchmark the routes of the blog.")
+    parser.add_argument('--database', help="Database URL, defaults to DATABASE_URL.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help="Populate an empty database with a synthetic dataset.")
+    seed.add_argument('--scale', default='1k', help="1k, 100k or 1m rows.")
+    seed.add_argument('--seed', type=int, default=0, help="Random seed of the dataset.")
+    seed.add_argument('--batch-size', type=int, default=5000)
+
+    run = commands.add_parser('run', help="Benchmark routes and write the results as JSON.")
+    run.add_argument('--routes', nargs='+', default=['index', 'view_post', 'add_comment', 'login'],
+                     help="Routes to benchmark, see benchmarks/driver.py.")
+    run.add_argument('--requests', type=int, default=500, help="Requests per route.")
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--page-cache-size', type=int, default=0,
+                     help="Size of the page cache, 0 (default) to measure the database path of every request.")
+    run.add_argument('--output', default='-', help="Results file, - for stdout.")
+
+    startup = commands.add_parser('startup', help="Measure the cold start and time to first request of workers.")
+    startup.add_argument('--runs', type=int, default=5, help="Fresh worker processes to start.")
+    startup.add_argument('--workers', type=int, default=4, help="Workers forked from a preloaded application.")
+
+    plans = commands.add_parser('plans', help="Check the query plans of the service read paths for full table scans.")
+    plans.add_argument('--verbose', action='store_true', help="Print the plan of every statement.")
+
+    signups = commands.add_parser('signups', help="Check that concurrent sign ups get distinct user ids.")
+    signups.add_argument('--processes', type=int, default=8)
+    signups.add_argument('--threads', type=int, default=8, help="Threads of each process.")
+    signups.add_argument('--users', type=int, default=50, help="Users signed up by each thread.")
+    signups.add_argument('--block-size', type=int, default=3, help="Ids reserved at a time by each process.")
+
+    compare = commands.add_parser('compare', help="Compare two results files.")
+    compare.add_argument('old')
+    compare.add_argument('new')
+
+    args = parser.parse_args()
+
+    # Settings are read when the application modules are first imported
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.command == 'run':
+        os.environ['PAGE_CACHE_SIZE'] = str(args.page_cache_size)
+
+    if args.command == 'seed':
+        from benchmarks.seed import DatasetSeeder
+        from database import init_db
+        init_db()
+        counts = DatasetSeeder(args.scale, args.seed, args.batch_size).seed_database()
+        print("Seeded {}".format(", ".join("{} {}s".format(count, name) for name, count in counts.items())),
+              file=sys.stderr)
+    elif args.command == 'run':
+        from benchmarks.driver import ROUTES, RouteDriver
+        from benchmarks.results import make_results, write_results
+        from config import Config
+        from database import db_session
+        from models import BlogPost, Comment, PostLike, Tag, User
+
+        unknown = set(args.routes) - set(ROUTES)
+        if unknown:
+            parser.error("unknown routes: {}".format(", ".join(sorted(unknown))))
+        dataset = {'users': User.query.count(), 'posts': BlogPost.query.count(), 'tags': Tag.query.count(),
+                   'comments': Comment.query.count(), 'likes': PostLike.query.count()}
+        db_session.remove()
+        driver = RouteDriver()
+        routes = {}
+        for name in args.routes:
+            routes[name] = driver.run(name, args.requests, args.concurrency)
+            print("{:12} {:>8} req/s  p50 {:>8} ms  p95 {:>8} ms  p99 {:>8} ms  {:>6} queries/request".format(
+                name, routes[name]['throughput_rps'], routes[name]['latency_ms']['p50'],
+                routes[name]['latency_ms']['p95'], routes[name]['latency_ms']['p99'],
+                routes[name]['queries_per_request']['mean']), file=sys.stderr)
+        config = {'database': Config.DATABASE_URL.split('@')[-1], 'page_cache_size': Config.PAGE_CACHE_SIZE,
+                  'comment_ingest_mode': Config.COMMENT_INGEST_MODE}
+        write_results(make_results(routes, dataset, config), args.output)
+    elif args.command == 'startup':
+        from benchmarks.startup import measure_cold_starts, measure_forked_workers, summarize_startup
+        from config import Config
+
+        cold = measure_cold_starts(args.runs)
+        forked = measure_forked_workers(args.workers)
+        results = {
+            'cold_start': summarize_startup(cold, 'startup_seconds', Config.STARTUP_BUDGET_MS),
+            'first_request': summarize_startup(cold, 'first_request_seconds', Config.FIRST_REQUEST_BUDGET_MS),
+            'forked_first_request': summarize_startup(forked, 'first_request_seconds',
+                                                      Config.FIRST_REQUEST_BUDGET_MS),
+        }
+        for name, result in results.items():
+            print("{:22} p50 {:>8} ms  max {:>8} ms  budget {:>6} ms  {} of {} over".format(
+                name, result['p50_ms'], result['max_ms'], result['budget_ms'], result['over_budget'],
+                result['samples']), file=sys.stderr)
+        shared = sum(sample['inherited_connections'] + sample['inherited_pages'] for sample in forked)
+        if shared:
+            print("Forked workers inherited {} pooled connections and cached pages".format(shared), file=sys.stderr)
+        if shared or any(result['over_budget'] for result in results.values()):
+            sys.exit(1)
+    elif args.command == 'plans':
+        from benchmarks.driver import Dataset
+        from benchmarks.query_plans import QueryPlanChecker, make_probes
+        from database import engine
+
+        if engine.dialect.name != 'sqlite':
+            parser.error("query plans can only be checked on SQLite")
+        checker = QueryPlanChecker()
+        failures = 0
+        for probe, statement, steps, scans, allowed in checker.check(make_probes(Dataset())):
+            failed = bool(scans) and not allowed
+            failures += failed
+            if failed or args.verbose:
+                print("{} {}: {}".format('FULL SCAN' if failed else 'ok', probe, ' '.join(statement.split())),
+                      file=sys.stderr)
+                for step in steps:
+                    print("    " + step, file=sys.stderr)
+        print("{} statements with full table scans".format(failures), file=sys.stderr)
+        if failures:
+            sys.exit(1)
+    elif args.command == 'signups':
+        from benchmarks.concurrency import check_concurrent_sign_ups
+
+        result = check_concurrent_sign_ups(args.processes, args.threads, args.users, args.block_size)
+        for error in result['errors']:
+            print(error, file=sys.stderr)
+        print("{expected} sign ups, {ids} ids handed out, {distinct_ids} distinct, {stored} users stored, "
+              "{errors} errors".format(**dict(result, errors=len(result['errors']))), file=sys.stderr)
+        if result['errors'] or not result['expected'] == result['ids'] == result['distinct_ids'] == result['stored']:
+            sys.exit(1)
+    else:
+        from benchmarks.results import compare_results, read_results
+        for route, metric, old, new, change in compare_results(read_results(args.old), read_results(args.new)):
+            print("{:12} {:20} {:>10} {:>10} {:>8}".format(
+                route, metric, old, new, '{:+.1%}'.format(change) if change is not None else 'n/a'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'wsgi': [sys.executable, '-c',
+             "import sys; from werkzeug.serving import run_simple; from app import create_app; "
+             "run_simple('127.0.0.1', int(sys.argv[1]), create_app(), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', '--factory', 'asgi:create_application', '--log-level', 'warning',
+             '--port'],
+}
+
+
+def seed(posts, comments_per_post):
+    '''
+    Fill the configured database with published posts and comments
+    '''
+
+    sys.path.insert(0, ROOT)
+    from database import db_session, init_db
+    from services import blog_service, user_service
+
+    init_db()
+    admin = user_service.sign_up('admin', 'password', 'Admin', None, 'admin@blog.com', True)
+    admin_id = admin.id
+    for i in range(posts):
+        post = blog_service.add_post("Post {}".format(i), "Some content of post {}. ".format(i) * 50,
+                                     admin, ['tag{}'.format(i % 10)])
+        blog_service.add_comments([(post.id, "Comment {}".format(c), admin_id)
+                                   for c in range(comments_per_post)])
+    db_session.remove()
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError("Server did not start on port {}".format(port))
+
+
+def drive(port, paths, concurrency, duration):
+    '''
+    Request random paths from concurrency threads for duration seconds, returning the latencies in seconds
+    '''
+
+    latencies = []
+    errors = []
+    deadline = time.time() + duration
+    lock = threading.Lock()
+
+    def worker():
+        while time.time() < deadline:
+            url = 'http://127.0.0.1:{}{}'.format(port, random.choice(paths))
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(url).read()
+            except (urllib.error.URLError, ConnectionError) as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of the WSGI (threaded) and ASGI (asyncio) entry points "
+                    "on the read only pages, with the page cache disabled so every request reads the database.")
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=20, help="Comments per post.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per run.")
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ, DATABASE_URL='sqlite:///{}'.format(os.path.join(directory, 'bench.db')),
+               SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'), PAGE_CACHE_SIZE='0', LOG_LEVEL='WARNING')
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--seed', str(args.posts), str(args.comments)],
+                   env=env, cwd=ROOT, check=True)
+
+    paths = ['/posts/{}'.format(id) for id in range(1, args.posts + 1)] + ['/index/'] * (args.posts // 10)
+    results = []
+    for name, command in SERVERS.items():
+        server = subprocess.Popen(command + [str(args.port)], env=env, cwd=ROOT)
+        try:
+            wait_for_port(args.port)
+            drive(args.port, paths, 4, 1)
+            for concurrency in args.concurrency:
+                latencies, errors = drive(args.port, paths, concurrency, args.duration)
+                result = {'server': name, 'concurrency': concurrency,
+                          'requests_per_second': round(len(latencies) / args.duration, 1),
+                          'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+                          'p99_ms': round(percentile(latencies, 0.99) * 1000, 2), 'errors': errors}
+                results.append(result)
+                print("{server:5} c={concurrency:<4} {requests_per_second:>8} req/s  p50 {p50_ms:>7} ms  "
+                      "p99 {p99_ms:>7} ms  errors {errors}".format(**result), flush=True)
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--seed':
+        seed(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main()
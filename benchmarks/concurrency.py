@@ -0,0 +1,104 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Signs up users from several threads of a fresh interpreter and prints their ids and the errors raised
+SIGN_UP_SCRIPT = (
+    "import json, sys; from benchmarks.concurrency import sign_up_in_threads; "
+    "print(json.dumps(sign_up_in_threads(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))))"
+)
+
+
+def check_concurrent_sign_ups(processes, threads, users, block_size):
+    '''
+    Sign up users from several processes and threads at the same time, against a new SQLite database,
+    and check that every user got its own id. Small id blocks make the processes reserve blocks of the
+    id sequence concurrently, including the first one, which starts the sequence.
+
+    Parameters
+    ----------
+    processes: int,
+        Number of processes signing up users.
+    threads: int,
+        Number of threads of each process.
+    users: int,
+        Number of users signed up by each thread.
+    block_size: int,
+        Number of ids reserved at a time by each process, see USER_ID_BLOCK_SIZE.
+
+    Returns
+    -------
+    dict
+        Number of users expected, ids handed out, distinct ids and users stored, and the errors raised.
+    '''
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(directory, 'signups.db'),
+                   USER_ID_BLOCK_SIZE=str(block_size))
+        subprocess.run([sys.executable, '-c', "from database import init_db; init_db()"], cwd=ROOT, env=env,
+                       check=True)
+
+        # Every process starts signing up at the same time, once all of them are imported
+        start_at = time.time() + 2
+        workers = [subprocess.Popen([sys.executable, '-c', SIGN_UP_SCRIPT, 'p{}'.format(process), str(threads),
+                                     str(users), str(start_at)], cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                                    text=True)
+                   for process in range(processes)]
+        ids, errors = [], []
+        for worker in workers:
+            output, _ = worker.communicate()
+            if worker.returncode != 0:
+                errors.append("Process exited with status {}".format(worker.returncode))
+                continue
+            result = json.loads(output.splitlines()[-1])
+            ids += result['ids']
+            errors += result['errors']
+
+        count = subprocess.run([sys.executable, '-c', "from models import User; print(User.query.count())"],
+                               cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return {'expected': processes * threads * users, 'ids': len(ids), 'distinct_ids': len(set(ids)),
+            'stored': int(count.splitlines()[-1]), 'errors': errors}
+
+
+def sign_up_in_threads(prefix, threads, users, start_at):
+    '''
+    Sign up users from several threads of this process, starting at the given time.
+
+    Returns
+    -------
+    dict
+        The ids of the users signed up and the errors raised, as text.
+    '''
+
+    from database import db_session
+    from services import user_service
+
+    ids, errors = [], []
+    lock = threading.Lock()
+
+    def sign_up(thread):
+        time.sleep(max(start_at - time.time(), 0))
+        for number in range(users):
+            name = '{}-t{}-u{}'.format(prefix, thread, number)
+            try:
+                id = user_service.sign_up(name, 'password', name, None, name + '@example.com').id
+                with lock:
+                    ids.append(id)
+            except Exception as e:
+                db_session.rollback()
+                with lock:
+                    errors.append('{}: {}'.format(type(e).__name__, e))
+        db_session.remove()
+
+    workers = [threading.Thread(target=sign_up, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {'ids': ids, 'errors': errors}
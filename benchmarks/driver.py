@@ -0,0 +1,197 @@
+import random
+import threading
+import time
+
+from sqlalchemy import event
+
+from app import create_app
+from benchmarks.seed import SEED_PASSWORD
+from database import db_session, engine
+from models import BlogPost, Tag, User
+
+
+class Route:
+    '''
+    A benchmarked route: how to build a request for it, and which account the client is logged in with
+    ('user', 'admin' or None for anonymous clients).
+    '''
+
+    def __init__(self, method, build, login=None, fresh_client=False):
+        self.method = method
+        self.build = build
+        self.login = login
+        self.fresh_client = fresh_client
+
+
+# Routes by name. build(rng, dataset) returns the path and the form data of a request.
+ROUTES = {
+    'index': Route('GET', lambda rng, dataset: ('/index/', None)),
+    'tag_posts': Route('GET', lambda rng, dataset: ('/tags/{}/'.format(rng.choice(dataset.tags)), None)),
+    'view_post': Route('GET', lambda rng, dataset: ('/posts/{}'.format(rng.choice(dataset.post_ids)), None)),
+    'add_comment': Route('POST', lambda rng, dataset: ('/posts/{}/comments/'.format(rng.choice(dataset.post_ids)),
+                                                       {'comment': 'Benchmark comment'}), login='user'),
+    'login': Route('POST', lambda rng, dataset: ('/login/', {'username': rng.choice(dataset.usernames),
+                                                             'password': SEED_PASSWORD}), fresh_client=True),
+    'api_posts': Route('GET', lambda rng, dataset: ('/api/posts?fields=id,title,excerpt', None)),
+    'search': Route('GET', lambda rng, dataset: ('/search/?q=python', None)),
+    'feed': Route('GET', lambda rng, dataset: ('/feed.xml', None)),
+}
+
+
+class Dataset:
+    '''
+    The ids and names the requests are built from, read once from the database
+    '''
+
+    def __init__(self):
+        self.post_ids = [id for id, in db_session.query(BlogPost.id).filter(BlogPost.is_visible == True)]
+        self.usernames = [name for name, in db_session.query(User.username).filter(User.type == 'user')]
+        self.admin_usernames = [name for name, in db_session.query(User.username).filter(User.type == 'admin')]
+        self.tags = [tag for tag, in db_session.query(Tag.tag).distinct().order_by(Tag.tag).limit(1000)]
+        db_session.remove()
+        if not self.post_ids or not self.usernames or not self.admin_usernames:
+            raise RuntimeError("The database is not seeded, run: python -m benchmarks seed")
+
+
+class QueryCounter:
+    '''
+    Counts the SQL statements executed by each thread, to report the queries per request
+    '''
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    def value(self):
+        return getattr(self._local, 'count', 0)
+
+
+class RouteDriver:
+    '''
+    Sends requests to routes of the Flask application from concurrent workers, each with its own test client,
+    and measures the latency and the number of queries of every request.
+    '''
+
+    def __init__(self, seed=0):
+        self.app = create_app()
+        self.dataset = Dataset()
+        self.counter = QueryCounter(engine)
+        self.seed = seed
+
+    def run(self, name, requests, concurrency, warmup=20):
+        '''
+        Benchmark a route.
+
+        Parameters
+        ----------
+        name: str,
+            Name of the route, see ROUTES.
+        requests: int,
+            Number of measured requests, shared by the workers.
+        concurrency: int,
+            Number of concurrent workers.
+        warmup: int,
+            Number of requests sent before measuring, to fill connection pools and caches.
+
+        Returns
+        -------
+        dict
+            The result of the route (see summarize).
+        '''
+
+        route = ROUTES[name]
+        self._run_workers(route, warmup, min(concurrency, max(warmup, 1)), None)
+        samples = []
+        started = time.perf_counter()
+        self._run_workers(route, requests, concurrency, samples)
+        elapsed = time.perf_counter() - started
+        return summarize(samples, elapsed, concurrency)
+
+    def _run_workers(self, route, requests, concurrency, samples):
+        remaining = [requests]
+        lock = threading.Lock()
+
+        def worker(index):
+            rng = random.Random(self.seed * 1000 + index)
+            client = self._client(route, rng)
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+                if route.fresh_client:
+                    client = self.app.test_client()
+                path, data = route.build(rng, self.dataset)
+                self.counter.reset()
+                start = time.perf_counter()
+                response = client.open(path, method=route.method, data=data, buffered=True)
+                latency = time.perf_counter() - start
+                queries = self.counter.value()
+                response.close()
+                if samples is not None:
+                    with lock:
+                        samples.append((latency, queries, response.status_code))
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _client(self, route, rng):
+        client = self.app.test_client()
+        if route.login is not None:
+            usernames = self.dataset.admin_usernames if route.login == 'admin' else self.dataset.usernames
+            client.post('/login/', data={'username': rng.choice(usernames), 'password': SEED_PASSWORD})
+        return client
+
+
+def percentile(values, fraction):
+    '''
+    Get the value below which the given fraction of the sorted values fall (nearest rank)
+    '''
+
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(len(values) * fraction)) - 1))]
+
+
+def summarize(samples, elapsed, concurrency):
+    '''
+    Summarize the (latency, queries, status) samples of a route run.
+
+    Returns
+    -------
+    dict
+        Requests, concurrency, throughput in requests per second, latency percentiles in milliseconds,
+        queries per request and the count of each response status.
+    '''
+
+    latencies = sorted(latency * 1000 for latency, _, _ in samples)
+    queries = [count for _, count, _ in samples]
+    statuses = {}
+    for _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(samples),
+        'concurrency': concurrency,
+        'throughput_rps': round(len(samples) / elapsed, 1) if elapsed > 0 else 0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3) if latencies else 0,
+        },
+        'queries_per_request': {
+            'mean': round(sum(queries) / len(queries), 2) if queries else 0,
+            'max': max(queries) if queries else 0,
+        },
+        'status_codes': statuses,
+    }
@@ -0,0 +1,174 @@
+import re
+from contextlib import nullcontext
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy import event
+
+from benchmarks.seed import SEED_PASSWORD
+from database import Base, db_session, engine, replica_engine
+from services import COMMENT_API_FIELDS, LOAD_PROFILES, POST_API_FIELDS, blog_service, user_service
+
+# Plan steps reading every row of a table, as reported by EXPLAIN QUERY PLAN (older SQLite says "SCAN TABLE")
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+# Table aliases of a statement, e.g. "FROM users AS users_1"
+_ALIAS = re.compile(r'\b(\w+) AS (\w+)\b')
+
+
+class Probe:
+    '''
+    A call of a service method whose statements are checked. Probes of methods that read whole tables by design,
+    such as the admin user list, may scan. The changes of probes that write are flushed but never committed,
+    so the seeded dataset stays as it is, apart from the id blocks reserved by the id allocators.
+    '''
+
+    def __init__(self, name, call, full_scan_allowed=False, writes=False):
+        self.name = name
+        self.call = call
+        self.full_scan_allowed = full_scan_allowed
+        self.writes = writes
+
+
+def make_probes(dataset):
+    '''
+    Build the probes of the BlogService and UserService read and write paths for the ids and names of a seeded
+    dataset (see driver.Dataset).
+    '''
+
+    post_id = dataset.post_ids[0]
+    tag = dataset.tags[0]
+    username = dataset.usernames[0]
+    user = SimpleNamespace(id=user_service.login(username, SEED_PASSWORD).id)
+    db_session.remove()
+
+    def second_posts_page(include_hidden):
+        page = blog_service.fetch_posts_page(include_hidden=include_hidden, page_size=1)
+        blog_service.fetch_posts_page(include_hidden=include_hidden, after=page.next_cursor, page_size=1)
+
+    def second_comments_page():
+        page = blog_service.fetch_comments_page(post_id, page_size=1)
+        blog_service.fetch_comments_page(post_id, after=page.next_cursor, page_size=1)
+
+    def poll_user_changes():
+        user_service._changes_polled_at = None
+        user_service.is_changed_since(user.id, 0)
+
+    def edit_post(make_visible):
+        blog_post = blog_service.fetch_post_by_id(post_id, 'edit')
+        blog_service.edit_post(post_id, blog_post.title, blog_post.content, [tag, 'probe'], make_visible)
+
+    probes = [
+        Probe('posts page', lambda: blog_service.fetch_posts_page(include_hidden=False, profile='list')),
+        Probe('next posts page', lambda: second_posts_page(False)),
+        Probe('admin posts page', lambda: second_posts_page(True)),
+        Probe('tag posts page', lambda: blog_service.fetch_posts_page(include_hidden=False, tag=tag)),
+        Probe('tag cloud', lambda: blog_service.fetch_tag_counts()),
+        Probe('comments page', second_comments_page),
+        Probe('search', lambda: blog_service.search('python')),
+        Probe('post record', lambda: blog_service.fetch_post_record(post_id, POST_API_FIELDS)),
+        Probe('posts stream', lambda: list(blog_service.stream_posts(POST_API_FIELDS, False, page_size=10))),
+        Probe('tag posts stream', lambda: list(blog_service.stream_posts(POST_API_FIELDS, False, page_size=10,
+                                                                         tag=tag))),
+        Probe('comments stream', lambda: list(blog_service.stream_comments(post_id, COMMENT_API_FIELDS))),
+        Probe('post stamp', lambda: blog_service.fetch_post_stamp(post_id)),
+        Probe('listing stamp', lambda: blog_service.fetch_listing_stamp()),
+        Probe('feed stamp', lambda: blog_service.fetch_feed_stamp()),
+        Probe('feed posts', lambda: blog_service.fetch_feed_posts()),
+        Probe('post liked', lambda: blog_service.is_post_liked(post_id, user)),
+        Probe('login', lambda: user_service.login(username, SEED_PASSWORD)),
+        Probe('default admin', lambda: user_service.is_default_admin_exists()),
+        Probe('user', lambda: user_service.fetch_user_by_id(user.id)),
+        Probe('all posts', lambda: blog_service.fetch_all_posts(include_hidden=False), full_scan_allowed=True),
+        Probe('all users', lambda: user_service.fetch_all_users(), full_scan_allowed=True),
+        Probe('user changes', poll_user_changes),
+        Probe('feed post ids', lambda: blog_service._fetch_feed_post_ids()),
+        Probe('listing stamp bump', lambda: blog_service._bump_stamp('posts'), writes=True),
+        Probe('tag count increments', lambda: blog_service._update_tag_counts(
+            [], False, [SimpleNamespace(tag=tag), SimpleNamespace(tag='probe')], True), writes=True),
+        Probe('tag count decrements', lambda: blog_service._update_tag_counts(
+            [SimpleNamespace(tag=tag)], True, [], False), writes=True),
+        Probe('add post', lambda: blog_service.add_post('Probe', '<p>probe</p>', user, [tag, 'probe']),
+              writes=True),
+        Probe('edit post', lambda: edit_post(True), writes=True),
+        Probe('unpublish post', lambda: edit_post(False), writes=True),
+        Probe('delete post', lambda: blog_service.delete_post(post_id), writes=True),
+        Probe('add comments', lambda: blog_service.add_comments([(post_id, 'probe', user.id)]), writes=True),
+        Probe('comment on missing post', lambda: blog_service.add_comments([(-1, 'probe', user.id)]),
+              writes=True),
+        Probe('change user type', lambda: user_service.change_user_type(user.id, False), writes=True),
+        Probe('update profile', lambda: user_service.update_profile(user.id, 'Probe', None, 'probe@example.com'),
+              writes=True),
+    ]
+    probes += [Probe('post ({})'.format(profile), lambda profile=profile: blog_service.fetch_post_by_id(
+        post_id, profile=profile)) for profile in [None] + sorted(LOAD_PROFILES)]
+    return probes
+
+
+class QueryPlanChecker:
+    '''
+    Runs EXPLAIN QUERY PLAN on every SELECT, INSERT, UPDATE and DELETE statement of the probes, on the connection
+    that runs it, and reports the plans that read a whole table. Only SQLite query plans are understood.
+    '''
+
+    def __init__(self):
+        self._plans = None
+        for bind in (engine, replica_engine):
+            if bind is not None:
+                event.listen(bind, 'before_cursor_execute', self._explain)
+
+    def check(self, probes):
+        '''
+        Run the probes.
+
+        Returns
+        -------
+        list
+            (probe name, statement, plan steps, scanned tables, full scan allowed) of every distinct statement.
+        '''
+
+        results = []
+        for probe in probes:
+            self._plans = []
+            try:
+                # Removing the session rolls the uncommitted changes back
+                with mock.patch.object(db_session, 'commit', db_session.flush) if probe.writes else nullcontext():
+                    probe.call()
+            finally:
+                db_session.remove()
+            plans, self._plans = self._plans, None
+            seen = set()
+            for statement, steps in plans:
+                if statement in seen:
+                    continue
+                seen.add(statement)
+                results.append((probe.name, statement, steps, full_scans(statement, steps),
+                                probe.full_scan_allowed))
+        return results
+
+    def _explain(self, conn, cursor, statement, parameters, context, executemany):
+        if self._plans is None or not statement.lstrip().upper().startswith(
+                ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+            return
+        explain = cursor.connection.cursor()
+        try:
+            explain.execute('EXPLAIN QUERY PLAN ' + statement, parameters[0] if executemany else parameters)
+            self._plans.append((statement, [row[3] for row in explain.fetchall()]))
+        finally:
+            explain.close()
+
+
+def full_scans(statement, steps):
+    '''
+    Get the tables of the model read in full by the steps of a query plan, by table name.
+    '''
+
+    aliases = dict((alias, table) for table, alias in _ALIAS.findall(statement) if table in Base.metadata.tables)
+    tables = []
+    for step in steps:
+        match = _FULL_SCAN.match(step)
+        if match is None:
+            continue
+        table = aliases.get(match.group(1), match.group(1))
+        if table in Base.metadata.tables:
+            tables.append(table)
+    return tables
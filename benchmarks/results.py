@@ -0,0 +1,100 @@
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+# Version of the results format, bumped when fields change meaning
+RESULTS_FORMAT = 1
+
+
+def git_commit():
+    '''
+    Get the commit the benchmark ran on, with "-dirty" appended if the tree has uncommitted changes
+    '''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_results(routes, dataset, config):
+    '''
+    Build the results document of a benchmark run.
+
+    Parameters
+    ----------
+    routes: dict,
+        Result of each route by name, see driver.summarize.
+    dataset: dict,
+        Number of rows per table of the benchmarked database.
+    config: dict,
+        Settings the results depend on, such as the database URL and the page cache size.
+
+    Returns
+    -------
+    dict
+        The results, ready to be written as JSON.
+    '''
+
+    return {
+        'format': RESULTS_FORMAT,
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'dataset': dataset,
+        'routes': routes,
+    }
+
+
+def write_results(results, path):
+    '''
+    Write results as JSON, with sorted keys so that files of different commits diff cleanly. "-" writes to stdout.
+    '''
+
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if path == '-':
+        sys.stdout.write(text)
+    else:
+        with open(path, 'w') as file:
+            file.write(text)
+
+
+def read_results(path):
+    with open(path) as file:
+        results = json.load(file)
+    if results.get('format') != RESULTS_FORMAT:
+        raise ValueError("{} has results format {}, expected {}".format(
+            path, results.get('format'), RESULTS_FORMAT))
+    return results
+
+
+def compare_results(old, new):
+    '''
+    Compare the routes of two results documents.
+
+    Returns
+    -------
+    list
+        One (route, metric, old value, new value, relative change) tuple per metric of the routes in both.
+    '''
+
+    rows = []
+    for route in sorted(set(old['routes']) & set(new['routes'])):
+        before, after = old['routes'][route], new['routes'][route]
+        metrics = [('throughput_rps', before['throughput_rps'], after['throughput_rps'])]
+        for name in ('p50', 'p95', 'p99'):
+            metrics.append(('latency_ms.' + name, before['latency_ms'][name], after['latency_ms'][name]))
+        metrics.append(('queries_per_request', before['queries_per_request']['mean'],
+                        after['queries_per_request']['mean']))
+        for metric, old_value, new_value in metrics:
+            change = (new_value - old_value) / old_value if old_value else None
+            rows.append((route, metric, old_value, new_value, change))
+    return rows
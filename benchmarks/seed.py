@@ -0,0 +1,111 @@
+import random
+from datetime import datetime, timedelta
+
+from bulk import BulkImporter
+from services import blog_service
+
+# Row counts of the synthetic datasets, about 1 thousand, 100 thousand and 1 million rows in total
+SCALES = {
+    '1k': {'admins': 2, 'users': 50, 'posts': 100, 'tags_per_post': 2, 'comments': 500, 'likes': 150},
+    '100k': {'admins': 10, 'users': 2000, 'posts': 5000, 'tags_per_post': 3, 'comments': 60000, 'likes': 18000},
+    '1m': {'admins': 20, 'users': 20000, 'posts': 50000, 'tags_per_post': 3, 'comments': 600000, 'likes': 180000},
+}
+
+# Password of every seeded account, so the login route can be benchmarked
+SEED_PASSWORD = 'password'
+TAG_VOCABULARY = 200
+HIDDEN_POST_RATIO = 0.05
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+         'commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum eu fugiat nulla pariatur '
+         'python flask database query index cache latency throughput').split()
+
+
+class DatasetSeeder:
+    '''
+    Populates an empty database with a synthetic, reproducible dataset of admins, users, posts, tags, comments
+    and likes, through the bulk importer. Admins are named admin, admin2, ... and users user1, user2, ...,
+    all with SEED_PASSWORD. About HIDDEN_POST_RATIO of the posts are unpublished.
+    '''
+
+    def __init__(self, scale='1k', seed=0, batch_size=5000):
+        if scale not in SCALES:
+            raise ValueError("Unknown scale: {}".format(scale))
+        self.counts = SCALES[scale]
+        self.seed = seed
+        self.batch_size = batch_size
+
+    def seed_database(self):
+        '''
+        Insert the dataset and recompute the derived counts and the search index.
+
+        Returns
+        -------
+        dict
+            Number of rows inserted per record type.
+        '''
+
+        BulkImporter(self.batch_size).import_records(self.records(), source='benchmark-seed')
+        blog_service.recompute_aggregates()
+        return self.row_counts()
+
+    def row_counts(self):
+        '''
+        Get the number of rows of each record type in the dataset.
+        '''
+
+        counts = self.counts
+        return {'user': counts['admins'] + counts['users'], 'post': counts['posts'],
+                'tag': counts['posts'] * counts['tags_per_post'], 'comment': counts['comments'],
+                'like': min(counts['likes'], counts['posts'] * counts['users'])}
+
+    def records(self):
+        '''
+        Generate the (type, record) pairs of the dataset, in insertion order.
+        '''
+
+        rng = random.Random(self.seed)
+        counts = self.counts
+        admins, users, posts = counts['admins'], counts['users'], counts['posts']
+        start = datetime(2020, 1, 1)
+        span = (datetime(2024, 1, 1) - start).total_seconds()
+
+        for id in range(1, admins + users + 1):
+            is_admin = id <= admins
+            username = ('admin' if id == 1 else 'admin{}'.format(id)) if is_admin else 'user{}'.format(id - admins)
+            yield 'user', {'id': id, 'type': 'admin' if is_admin else 'user', 'username': username,
+                           'password': SEED_PASSWORD, 'display_name': username.capitalize(),
+                           'email': '{}@example.com'.format(username)}
+
+        post_dates = sorted(start + timedelta(seconds=rng.random() * span) for _ in range(posts))
+        for id, post_date in enumerate(post_dates, 1):
+            yield 'post', {'id': id, 'title': self._text(rng, 4, 10).capitalize(),
+                           'content': self._paragraphs(rng), 'post_date': post_date,
+                           'is_visible': rng.random() >= HIDDEN_POST_RATIO,
+                           'author_id': rng.randint(1, admins)}
+
+        tag_id = 1
+        for post_id in range(1, posts + 1):
+            for tag in rng.sample(range(TAG_VOCABULARY), counts['tags_per_post']):
+                yield 'tag', {'id': tag_id, 'tag': 'tag{}'.format(tag), 'blog_post_id': post_id}
+                tag_id += 1
+
+        for id in range(1, counts['comments'] + 1):
+            # Comments favour recent posts, as real traffic does
+            post_id = posts - int(rng.paretovariate(1.2) - 1) % posts
+            yield 'comment', {'id': id, 'content': self._text(rng, 5, 40).capitalize(),
+                              'comment_date': post_dates[post_id - 1] + timedelta(hours=rng.random() * 240),
+                              'user_id': rng.randint(admins + 1, admins + users), 'blog_post_id': post_id}
+
+        # Each (post, user) pair is liked at most once
+        for id in range(1, self.row_counts()['like'] + 1):
+            index = id - 1
+            yield 'like', {'id': id, 'blog_post_id': index % posts + 1,
+                           'user_id': admins + 1 + (index // posts) % users}
+
+    def _text(self, rng, min_words, max_words):
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+    def _paragraphs(self, rng):
+        return '\n\n'.join('<p>{}.</p>'.format(self._text(rng, 40, 120).capitalize())
+                           for _ in range(rng.randint(1, 4)))
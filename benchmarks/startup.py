@@ -0,0 +1,113 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the application in a fresh interpreter, serves one request and prints the startup times
+COLD_START_SCRIPT = (
+    "import json; from app import create_app; app = create_app(); from metrics import startup_metrics; "
+    "app.test_client().get('/index/').close(); print(json.dumps(startup_metrics.stats()))"
+)
+
+
+def measure_cold_starts(runs):
+    '''
+    Measure the cold start and time to first request of fresh worker processes.
+
+    Parameters
+    ----------
+    runs: int,
+        Number of processes to start one after the other.
+
+    Returns
+    -------
+    list
+        The startup times of each process in seconds, see metrics.StartupMetrics.stats.
+    '''
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    return samples
+
+
+def measure_forked_workers(workers):
+    '''
+    Preload the application, serve a request so that the parent holds pooled connections, then fork workers
+    that each serve a request, as a pre-forking server with a preloaded application does.
+
+    Parameters
+    ----------
+    workers: int,
+        Number of workers to fork.
+
+    Returns
+    -------
+    list
+        The time to first request of each worker in seconds, and the number of pooled connections and cached
+        pages it found when forked, which must be 0 for workers not to share the parent's connections or serve
+        pages the parent cached.
+    '''
+
+    # Imported here so that the parent's time to first request starts with the preload
+    from app import create_app
+    app = create_app()
+    from cache import page_cache
+    from database import engine
+    from metrics import startup_metrics
+
+    app.test_client().get('/index/').close()
+    pipes = []
+    for _ in range(workers):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            status = 1
+            try:
+                inherited = engine.pool.checkedin()
+                inherited_pages = page_cache.stats()['size']
+                app.test_client().get('/index/').close()
+                stats = dict(startup_metrics.stats(), inherited_connections=inherited,
+                             inherited_pages=inherited_pages)
+                os.write(write_end, json.dumps(stats).encode())
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(write_end)
+        pipes.append((pid, read_end))
+
+    samples = []
+    for pid, read_end in pipes:
+        with os.fdopen(read_end) as output:
+            data = output.read()
+        _, status = os.waitpid(pid, 0)
+        if status != 0 or not data:
+            raise RuntimeError("Worker {} failed to serve its first request".format(pid))
+        samples.append(json.loads(data))
+    return samples
+
+
+def summarize_startup(samples, key, budget_ms):
+    '''
+    Summarize one startup time of the samples against its budget.
+
+    Returns
+    -------
+    dict
+        Number of samples, p50 and max in milliseconds, budget and number of samples over it.
+    '''
+
+    values = sorted(sample[key] * 1000 for sample in samples)
+    return {
+        'samples': len(values),
+        'p50_ms': round(statistics.median(values), 1) if values else 0,
+        'max_ms': round(values[-1], 1) if values else 0,
+        'budget_ms': budget_ms,
+        'over_budget': sum(1 for value in values if value > budget_ms),
+    }
@@ -0,0 +1,290 @@
+import csv
+import json
+from datetime import datetime
+
+from database import db_session
+from models import BlogPost, Comment, ImportCheckpoint, PostLike, Tag, User
+from rendering import render_content
+from reputation import reputation_engine
+from services import blog_service, tag_id_allocator, user_id_allocator
+
+IMPORT_BATCH_SIZE = 5000
+EXPORT_FETCH_SIZE = 5000
+
+# Record types in the order their rows must be inserted, so that foreign keys point to existing rows
+RECORD_TYPES = ('user', 'post', 'tag', 'comment', 'like')
+
+_TABLES = {
+    'user': User.__table__,
+    'post': BlogPost.__table__,
+    'tag': Tag.__table__,
+    'comment': Comment.__table__,
+    'like': PostLike.__table__,
+}
+
+# Reputation engine sources of the record types that earn reputation
+_REPUTATION_SOURCES = {
+    'comment': 'comments',
+    'like': 'likes',
+}
+
+_EXPORT_COLUMNS = {
+    'user': (User.id, User.type, User.username, User.password, User.display_name, User.phone, User.email,
+             User.reputation_score),
+    'post': (BlogPost.id, BlogPost.post_date, BlogPost.title, BlogPost.content, BlogPost.is_visible,
+             BlogPost.author_id),
+    'tag': (Tag.id, Tag.tag, Tag.blog_post_id),
+    'comment': (Comment.id, Comment.content, Comment.comment_date, Comment.user_id, Comment.blog_post_id),
+    'like': (PostLike.id, PostLike.user_id, PostLike.blog_post_id),
+}
+
+
+class BulkImporter:
+    '''
+    Loads users, posts, tags, comments and likes from NDJSON or CSV files with batched multi row inserts.
+    Every batch is inserted in one transaction that also records how many records of the source were loaded,
+    so an interrupted import can be resumed without loading a record twice.
+    Derived data (comment, like and tag counts, and the search index) is recomputed once at the end.
+    Imported users carry the reputation earned from the imported comments and likes, so the reputation engine
+    skips the ids of the comments and likes inserted with their id. Those without one are new events, and are
+    counted like the comments and likes written through the blog.
+
+    NDJSON records carry their type in a "record" field (one of RECORD_TYPES); the other fields are the
+    columns of the matching table, as written by BulkExporter. CSV files hold records of one type,
+    with the column names in the header row. Records without an id get a generated one.
+    '''
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def import_file(self, path, file_format='ndjson', record_type=None, resume=False, source=None):
+        '''
+        Import a file.
+
+        Parameters
+        ----------
+        path: str,
+            Path of the file.
+        file_format: str,
+            "ndjson" or "csv".
+        record_type: str,
+            Type of the records of a CSV file, one of RECORD_TYPES. Ignored for NDJSON.
+        resume: Boolean,
+            If True, skip the records committed by a previous import of the same source.
+        source: str,
+            Name of the source the checkpoint is kept under, defaults to the path.
+
+        Returns
+        -------
+        int
+            Number of records imported.
+        '''
+
+        source = source or path
+        start = self._checkpoint(source) if resume else 0
+
+        with open(path, newline='') as file:
+            if file_format == 'csv':
+                if record_type not in RECORD_TYPES:
+                    raise ValueError(
+                        "Unknown record type: {}".format(record_type))
+                records = ((record_type, row) for row in csv.DictReader(file))
+            elif file_format == 'ndjson':
+                records = ((record.pop('record', None), record)
+                           for record in (json.loads(line) for line in file if line.strip()))
+            else:
+                raise ValueError("Unknown format: {}".format(file_format))
+            imported = self.import_records(records, source, start)
+
+        blog_service.recompute_aggregates()
+        return imported
+
+    def import_records(self, records, source, start=0):
+        '''
+        Import (type, record) pairs in batches, skipping the first start records.
+
+        Returns
+        -------
+        int
+            Number of records imported.
+        '''
+
+        position = 0
+        imported = 0
+        batch = []
+        for record_type, record in records:
+            position += 1
+            if position <= start:
+                continue
+            if record_type not in RECORD_TYPES:
+                raise ValueError("Unknown record type {} at record {}".format(
+                    record_type, position))
+            batch.append((record_type, record))
+            if len(batch) >= self.batch_size:
+                self._insert_batch(batch, source, position)
+                imported += len(batch)
+                batch = []
+        if batch:
+            self._insert_batch(batch, source, position)
+            imported += len(batch)
+        return imported
+
+    def _insert_batch(self, batch, source, position):
+        '''
+        Private method that inserts a batch of records and moves the checkpoint, in one transaction.
+        '''
+
+        rows = dict((record_type, []) for record_type in RECORD_TYPES)
+        for record_type, record in batch:
+            rows[record_type].append(_ROW_BUILDERS[record_type](record))
+
+        max_user_id = max_tag_id = None
+        try:
+            connection = db_session.connection()
+            for record_type in RECORD_TYPES:
+                with_ids = [row for row in rows[record_type]
+                            if row['id'] is not None]
+                without_ids = [dict((key, value) for key, value in row.items() if key != 'id')
+                               for row in rows[record_type] if row['id'] is None]
+                if with_ids:
+                    connection.execute(_TABLES[record_type].insert(), with_ids)
+                    if record_type in _REPUTATION_SOURCES:
+                        reputation_engine.skip(connection, _REPUTATION_SOURCES[record_type],
+                                               [row['id'] for row in with_ids])
+                if without_ids:
+                    connection.execute(_TABLES[record_type].insert(), without_ids)
+            if rows['user']:
+                max_user_id = max(row['id'] for row in rows['user'])
+            if rows['tag']:
+                max_tag_id = max(row['id'] for row in rows['tag'])
+            updated = db_session.query(ImportCheckpoint).filter(ImportCheckpoint.source == source) \
+                .update({ImportCheckpoint.position: position}, synchronize_session=False)
+            if updated == 0:
+                checkpoint = ImportCheckpoint()
+                checkpoint.source = source
+                checkpoint.position = position
+                db_session.add(checkpoint)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        if max_user_id is not None:
+            user_id_allocator.advance_past(max_user_id)
+        if max_tag_id is not None:
+            tag_id_allocator.advance_past(max_tag_id)
+
+    def _checkpoint(self, source):
+        '''
+        Private method that reads the number of records of a source already imported.
+        '''
+
+        checkpoint = db_session.query(ImportCheckpoint).filter(
+            ImportCheckpoint.source == source).first()
+        return checkpoint.position if checkpoint is not None else 0
+
+
+class BulkExporter:
+    '''
+    Writes all users, posts, tags, comments and likes as NDJSON, in the format read by BulkImporter.
+    Rows are streamed from server side cursors in chunks of fetch_size, so memory use does not grow with the data.
+    '''
+
+    def __init__(self, fetch_size=EXPORT_FETCH_SIZE):
+        self.fetch_size = fetch_size
+
+    def iter_records(self, record_types=RECORD_TYPES):
+        '''
+        Yield every record as a dict with its type in the "record" field.
+        '''
+
+        for record_type in record_types:
+            columns = _EXPORT_COLUMNS[record_type]
+            query = db_session.query(*columns).order_by(columns[0]).yield_per(self.fetch_size)
+            for row in query:
+                record = {'record': record_type}
+                for column, value in zip(columns, row):
+                    record[column.key] = value.isoformat() if isinstance(value, datetime) else value
+                yield record
+
+    def export_ndjson(self, file, record_types=RECORD_TYPES):
+        '''
+        Write every record to a text file, one JSON document per line.
+
+        Returns
+        -------
+        int
+            Number of records written.
+        '''
+
+        count = 0
+        for record in self.iter_records(record_types):
+            file.write(json.dumps(record))
+            file.write('\n')
+            count += 1
+        return count
+
+
+def _int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _bool(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _datetime(value):
+    if value in (None, ''):
+        return datetime.now()
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def _text(value):
+    return value if value != '' else None
+
+
+def _user_row(record):
+    id = _int(record.get('id'))
+    return {'id': id if id is not None else user_id_allocator.next_id(),
+            'type': record.get('type') or 'user',
+            'username': record['username'], 'password': record['password'],
+            'display_name': _text(record.get('display_name')), 'phone': _text(record.get('phone')),
+            'email': record['email'], 'reputation_score': _int(record.get('reputation_score'))}
+
+
+def _post_row(record):
+    post_date = _datetime(record.get('post_date'))
+    content = _text(record.get('content'))
+    content_html, excerpt = render_content(content)
+    return {'id': _int(record.get('id')), 'post_date': post_date, 'title': record['title'],
+            'content': content, 'content_html': content_html, 'excerpt': excerpt,
+            'is_visible': _bool(record.get('is_visible', True)),
+            'author_id': _int(record.get('author_id')), 'version': 1, 'updated_at': post_date,
+            'comment_count': 0, 'like_count': 0}
+
+
+def _tag_row(record):
+    id = _int(record.get('id'))
+    return {'id': id if id is not None else tag_id_allocator.next_id(), 'tag': record['tag'].strip().lower(),
+            'blog_post_id': _int(record['blog_post_id'])}
+
+
+def _comment_row(record):
+    return {'id': _int(record.get('id')), 'content': _text(record.get('content')),
+            'comment_date': _datetime(record.get('comment_date')), 'user_id': _int(record.get('user_id')),
+            'blog_post_id': _int(record['blog_post_id'])}
+
+
+def _like_row(record):
+    return {'id': _int(record.get('id')), 'user_id': _int(record['user_id']),
+            'blog_post_id': _int(record['blog_post_id'])}
+
+
+_ROW_BUILDERS = {
+    'user': _user_row,
+    'post': _post_row,
+    'tag': _tag_row,
+    'comment': _comment_row,
+    'like': _like_row,
+}
@@ -0,0 +1,309 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+
+
+class CachedPage:
+    '''
+    A rendered page along with its HTTP validators, and its compressed variants once they are needed
+    (see compression.encoded_page_body), keyed by content encoding
+    '''
+
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.variants = {}
+        self._data = None
+
+    def data(self):
+        '''
+        Get the body of the page as UTF-8 bytes.
+        '''
+
+        if self._data is None:
+            self._data = self.body.encode() if isinstance(
+                self.body, str) else self.body
+        return self._data
+
+
+class PageCache:
+    '''
+    A bounded, thread safe LRU cache of rendered pages.
+    Entries are keyed by route, blog post id (None for pages that are not about a single post),
+    viewer and an optional variant such as the entity tag of the page. Pages keyed by entity tag are only
+    served while the version they were rendered from is current, even when another process changed it.
+    Pages can also be marked fresh under a scope, such as the page of a listing, and then be served without
+    their entity tag for a while (see get_fresh).
+    Hit, miss and eviction counters are kept so that the cache can be sized.
+    For hold_seconds after pages are invalidated, pages for the same post or route are not stored, since
+    they may have been rendered from a read replica that has not caught up with the change yet.
+    '''
+
+    def __init__(self, max_size, hold_seconds=0):
+        self.max_size = max_size
+        self.hold_seconds = hold_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_post = {}
+        self._keys_by_route = {}
+        self._held_posts = {}
+        self._held_routes = {}
+        self._fresh = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, route, post_id, viewer, variant=None):
+        '''
+        Look up a cached page.
+
+        Parameters
+        ----------
+        route: str,
+            Name of the route that rendered the page.
+        post_id: int,
+            ID of the blog post the page is about, None if not applicable.
+        viewer: tuple,
+            Viewer key, see pages.viewer_key.
+        variant: str,
+            Any other input the page depends on, such as the entity tag of the page.
+
+        Returns
+        -------
+        object
+            The cached page, None if not cached.
+        '''
+
+        key = (route, post_id, viewer, variant)
+        with self._lock:
+            page = self._entries.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, route, post_id, viewer, page, variant=None):
+        '''
+        Store a rendered page, evicting the least recently used pages if the cache is full.
+        '''
+
+        key = (route, post_id, viewer, variant)
+        with self._lock:
+            if self._is_held(route, post_id):
+                return
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            self._keys_by_route.setdefault(route, set()).add(key)
+            if post_id is not None:
+                self._keys_by_post.setdefault(post_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest, _ = self._entries.popitem(last=False)
+                self._unindex(oldest)
+                self.evictions += 1
+
+    def mark_fresh(self, route, post_id, viewer, scope, variant):
+        '''
+        Record that the cached page stored with the given variant is current now, so that it is served by
+        get_fresh for the same scope. At most max_size pages are marked, the oldest marks are dropped first.
+        '''
+
+        key = (route, post_id, viewer, variant)
+        with self._lock:
+            if key not in self._entries:
+                return
+            fresh_key = (route, post_id, viewer, scope)
+            self._fresh[fresh_key] = (time.monotonic(), key)
+            self._fresh.move_to_end(fresh_key)
+            while len(self._fresh) > self.max_size:
+                self._fresh.popitem(last=False)
+
+    def get_fresh(self, route, post_id, viewer, scope, max_age):
+        '''
+        Look up the page last marked fresh for a scope, if it was marked less than max_age seconds ago and
+        has not been invalidated or evicted since.
+
+        Returns
+        -------
+        object
+            The cached page, None if there is no fresh page. Not counted as a miss, since the page is then
+            looked up by its entity tag.
+        '''
+
+        fresh_key = (route, post_id, viewer, scope)
+        with self._lock:
+            fresh = self._fresh.get(fresh_key)
+            if fresh is None:
+                return None
+            marked_at, key = fresh
+            page = self._entries.get(key)
+            if page is None or time.monotonic() - marked_at >= max_age:
+                del self._fresh[fresh_key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def invalidate_post(self, post_id):
+        '''
+        Drop every cached page about the given blog post.
+        '''
+
+        with self._lock:
+            if self.hold_seconds:
+                self._held_posts[post_id] = time.monotonic() + self.hold_seconds
+            for key in self._keys_by_post.pop(post_id, set()):
+                self._entries.pop(key, None)
+                self._keys_by_route.get(key[0], set()).discard(key)
+
+    def invalidate_route(self, route):
+        '''
+        Drop every cached page rendered by the given route.
+        '''
+
+        with self._lock:
+            if self.hold_seconds:
+                self._held_routes[route] = time.monotonic() + self.hold_seconds
+            for key in self._keys_by_route.pop(route, set()):
+                self._entries.pop(key, None)
+                if key[1] is not None:
+                    self._keys_by_post.get(key[1], set()).discard(key)
+
+    def clear(self):
+        '''
+        Drop all cached pages. Counters are preserved.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_post.clear()
+            self._keys_by_route.clear()
+            self._fresh.clear()
+
+    def reset_after_fork(self):
+        '''
+        Drop the pages a forked process inherited and replace the lock, which another thread of the parent
+        may have held. The parent does not tell the child about the changes it sees after forking.
+        '''
+
+        self._lock = threading.Lock()
+        self._held_posts.clear()
+        self._held_routes.clear()
+        self.clear()
+
+    def stats(self):
+        '''
+        Get the cache counters.
+
+        Returns
+        -------
+        dict
+            Current size, maximum size, hits, misses and evictions.
+        '''
+
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _is_held(self, route, post_id):
+        '''
+        Private method that checks whether pages of a route or post were invalidated less than hold_seconds ago.
+        Must be called with the lock held.
+        '''
+
+        if not self._held_posts and not self._held_routes:
+            return False
+        now = time.monotonic()
+        for held, key in ((self._held_routes, route), (self._held_posts, post_id)):
+            until = held.get(key)
+            if until is not None:
+                if until > now:
+                    return True
+                del held[key]
+        return False
+
+    def _unindex(self, key):
+        '''
+        Private method that removes an evicted key from the secondary indexes.
+        Must be called with the lock held.
+        '''
+
+        route, post_id = key[0], key[1]
+        self._keys_by_route.get(route, set()).discard(key)
+        if post_id is not None:
+            self._keys_by_post.get(post_id, set()).discard(key)
+
+
+page_cache = PageCache(Config.PAGE_CACHE_SIZE,
+                       Config.REPLICA_STALENESS_SECONDS if Config.REPLICA_DATABASE_URL else 0)
+os.register_at_fork(after_in_child=page_cache.reset_after_fork)
+
+
+class TTLCache:
+    '''
+    A bounded, thread safe cache whose entries expire after a fixed time to live.
+    Least recently used entries are evicted first when the cache is full.
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Look up a cached value, None if not cached or expired.
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        '''
+        Store a value, evicting the least recently used values if the cache is full.
+        '''
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        '''
+        Drop a cached value.
+        '''
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Drop all cached values.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+
+    def reset_after_fork(self):
+        '''
+        Drop the values a forked process inherited and replace the lock, which another thread of the parent
+        may have held.
+        '''
+
+        self._lock = threading.Lock()
+        self.clear()
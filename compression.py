@@ -0,0 +1,141 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+from config import Config
+
+# Content types worth compressing; images and other binary formats are already compressed
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/atom+xml', 'application/rss+xml', 'image/svg+xml')
+
+# Encodings in order of preference when the client accepts several equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding():
+    '''
+    Choose the content encoding of the response to the current request from its Accept-Encoding header.
+
+    Returns
+    -------
+    str
+        "br", "gzip" or "identity".
+    '''
+
+    return request.accept_encodings.best_match(ENCODINGS + ('identity',), default='identity')
+
+
+def variant_etag(etag, encoding):
+    '''
+    Get the entity tag of an encoded representation of a page.
+    Each encoding is a different sequence of bytes, so it needs its own strong validator.
+    '''
+
+    return etag if encoding == 'identity' else '{}-{}'.format(etag, encoding)
+
+
+def compress(data, encoding):
+    '''
+    Compress a body with the given encoding at the configured level.
+
+    Parameters
+    ----------
+    data: bytes,
+        The uncompressed body.
+    encoding: str,
+        "br" or "gzip".
+
+    Returns
+    -------
+    bytes
+        The compressed body.
+    '''
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=Config.BROTLI_QUALITY)
+    compressor = zlib.compressobj(Config.COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    '''
+    Compress a streamed body chunk by chunk, so it is still sent while it is produced.
+    '''
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=Config.BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(
+            Config.COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def is_compressible(response):
+    '''
+    Check whether a response is of a content type that is worth compressing.
+    '''
+
+    return (not response.direct_passthrough and response.mimetype is not None
+            and response.mimetype.startswith(COMPRESSIBLE_TYPES))
+
+
+def encoded_page_body(cached_page, encoding):
+    '''
+    Get the body of a cached page in the given encoding.
+    Compressed variants are stored on the page the first time they are needed, so hot pages are
+    compressed once instead of on every hit. Bodies below COMPRESSION_MIN_SIZE are never compressed.
+
+    Returns
+    -------
+    tuple
+        The body as bytes and the encoding actually applied.
+    '''
+
+    data = cached_page.data()
+    if encoding == 'identity' or len(data) < Config.COMPRESSION_MIN_SIZE:
+        return data, 'identity'
+    body = cached_page.variants.get(encoding)
+    if body is None:
+        body = compress(data, encoding)
+        cached_page.variants[encoding] = body
+    return body, encoding
+
+
+def compress_response(response):
+    '''
+    Compress a response in the encoding negotiated for the current request, if it is worth compressing.
+    Responses that were already encoded from a cached page, and 304 responses, only get their Vary header.
+    '''
+
+    if not is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    encoding = negotiate_encoding()
+    if encoding == 'identity':
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < Config.COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(variant_etag(etag, encoding), weak)
+    return response
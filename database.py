@@ -1,20 +1,226 @@
-from sqlalchemy import create_engine
+import functools
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from config import Config
+
+# Asyncio drivers used by the ASGI entry point in place of the regular drivers
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+}
+
+# Where the reads of the current thread or asyncio task go: None until decided, "replica" or "primary"
+_read_target = ContextVar('read_target', default=None)
+
+
+def create_db_engine(config, url=None):
+    '''
+    Create the database engine described by the configuration, for DATABASE_URL or the given URL.
+    SQLite databases get a connection pool and per connection pragmas tuned for concurrent readers
+    (WAL journal, busy timeout, relaxed fsync, memory mapped I/O and a larger page cache).
+    Any other SQLAlchemy URL gets a regular pool of pre-pinged, periodically recycled connections.
+
+    Parameters
+    ----------
+    config: Config,
+        Application settings.
+    url: str,
+        Database URL, defaults to DATABASE_URL.
+
+    Returns
+    -------
+    Engine
+        The database engine.
+    '''
+
+    url = make_url(url or config.DATABASE_URL)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, echo=config.SQL_ECHO, pool_size=config.DB_POOL_SIZE,
+                             max_overflow=config.DB_MAX_OVERFLOW, pool_timeout=config.DB_POOL_TIMEOUT,
+                             pool_recycle=config.DB_POOL_RECYCLE, pool_pre_ping=True)
+
+    connect_args = {"check_same_thread": False,
+                    "timeout": config.SQLITE_BUSY_TIMEOUT / 1000}
+    if url.database in (None, '', ':memory:'):
+        # An in-memory database only exists within its connection, so it must be shared
+        sqlite_engine = create_engine(url, echo=config.SQL_ECHO, connect_args=connect_args,
+                                      poolclass=StaticPool)
+    else:
+        sqlite_engine = create_engine(url, echo=config.SQL_ECHO, connect_args=connect_args,
+                                      poolclass=QueuePool, pool_size=config.DB_POOL_SIZE,
+                                      max_overflow=config.DB_MAX_OVERFLOW, pool_timeout=config.DB_POOL_TIMEOUT)
+
+    set_sqlite_pragmas(sqlite_engine, config)
+    return sqlite_engine
+
+
+def create_async_db_engine(config):
+    '''
+    Create an asyncio engine for the database described by the configuration, used by the ASGI entry point.
+    The driver of the URL is replaced by its asyncio counterpart (see ASYNC_DRIVERS), unless ASYNC_DATABASE_URL
+    names one. Requires SQLAlchemy 1.4 or later and the async driver, e.g. aiosqlite for SQLite.
+
+    Parameters
+    ----------
+    config: Config,
+        Application settings.
+
+    Returns
+    -------
+    AsyncEngine
+        The asyncio database engine.
+    '''
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    url = make_url(config.ASYNC_DATABASE_URL or config.DATABASE_URL)
+    if url.drivername in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+    if url.get_backend_name() != 'sqlite':
+        return create_async_engine(url, echo=config.SQL_ECHO, pool_size=config.DB_POOL_SIZE,
+                                   max_overflow=config.DB_MAX_OVERFLOW, pool_timeout=config.DB_POOL_TIMEOUT,
+                                   pool_recycle=config.DB_POOL_RECYCLE, pool_pre_ping=True)
+
+    connect_args = {"timeout": config.SQLITE_BUSY_TIMEOUT / 1000}
+    if url.database in (None, '', ':memory:'):
+        async_engine = create_async_engine(url, echo=config.SQL_ECHO, connect_args=connect_args,
+                                           poolclass=StaticPool)
+    else:
+        async_engine = create_async_engine(url, echo=config.SQL_ECHO, connect_args=connect_args,
+                                           poolclass=AsyncAdaptedQueuePool, pool_size=config.DB_POOL_SIZE,
+                                           max_overflow=config.DB_MAX_OVERFLOW,
+                                           pool_timeout=config.DB_POOL_TIMEOUT)
+    set_sqlite_pragmas(async_engine.sync_engine, config)
+    return async_engine
+
+
+def set_sqlite_pragmas(sqlite_engine, config):
+    '''
+    Apply the SQLite pragmas of the configuration to every new connection of an engine
+    '''
+
+    @event.listens_for(sqlite_engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode={}".format(config.SQLITE_JOURNAL_MODE))
+        cursor.execute("PRAGMA synchronous={}".format(config.SQLITE_SYNCHRONOUS))
+        cursor.execute("PRAGMA busy_timeout={:d}".format(config.SQLITE_BUSY_TIMEOUT))
+        cursor.execute("PRAGMA mmap_size={:d}".format(config.SQLITE_MMAP_SIZE))
+        cursor.execute("PRAGMA cache_size={:d}".format(config.SQLITE_CACHE_SIZE))
+        cursor.close()
+
 
-engine = create_engine('sqlite:///test.db', convert_unicode=True,
-                       connect_args={"check_same_thread": False}, echo=True)
-db_session = scoped_session(sessionmaker(autocommit=False,
+class RoutingSession(Session):
+    '''
+    A session that sends the reads of read-only service methods (see use_replica) to the replica engine,
+    when REPLICA_DATABASE_URL is set. Flushes, updates, deletes and every statement outside of those methods
+    go to the primary engine, so a unit of work can mix objects read from both.
+    '''
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if replica_engine is not None and _read_target.get() == 'replica' and not self._flushing \
+                and not isinstance(clause, UpdateBase):
+            return replica_engine
+        return super().get_bind(mapper, clause, **kw)
+
+
+def use_replica(function):
+    '''
+    Decorator for read-only service methods, sending their reads to the replica.
+    It has no effect when called from a block that already chose where reads go, such as a write
+    that reads the row it changes (see use_primary).
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _read_target.get() is not None:
+            return function(*args, **kwargs)
+        token = _read_target.set('replica')
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _read_target.reset(token)
+    return wrapper
+
+
+@contextmanager
+def use_primary():
+    '''
+    Context manager, or decorator, that keeps every read of a block on the primary.
+    Used by writes, which must not base their changes on rows the replica has not caught up with yet.
+    '''
+
+    token = _read_target.set('primary')
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+def pin_primary(pinned):
+    '''
+    Send the reads of the current thread or asyncio task to the primary from now on, or stop doing so.
+    Set at the start of every request, so that users read their own writes while the replica catches up.
+    '''
+
+    _read_target.set('primary' if pinned else None)
+
+
+engine = create_db_engine(Config)
+# Reads of read-only service methods go to the replica if there is one, see RoutingSession
+replica_engine = create_db_engine(Config, Config.REPLICA_DATABASE_URL) if Config.REPLICA_DATABASE_URL else None
+db_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                         autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
 
+def dispose_after_fork():
+    '''
+    Drop the pooled connections and sessions a forked worker inherited from its parent, without closing them,
+    so that the worker opens its own connections and never shares an SQLite connection with another process.
+    '''
+
+    db_session.registry.clear()
+    engine.dispose(close=False)
+    if replica_engine is not None:
+        replica_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_after_fork)
+
+
 def init_db():
     '''
-    Initialize models and create database entities as needed
+    Initialize models and create database entities as needed.
+    Databases created before are brought to the latest schema version with the pending migrations
+    (see migrations.py), new ones are created at the latest version.
     '''
 
     import models
+    from migrations import schema_migrator
+    from search import search_index
+    created = not inspect(engine).has_table(models.BlogPost.__tablename__)
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        search_index.create_schema(connection)
+    if created:
+        schema_migrator.stamp()
+    else:
+        schema_migrator.upgrade()
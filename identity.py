@@ -0,0 +1,105 @@
+import time
+
+from flask import session
+
+from config import Config
+from services import user_service
+
+
+class UserMeta:
+    '''
+    Class that holds minimal user identifiable info in the session context
+    '''
+
+    def __init__(self, id, display_name, type, verified_at=None):
+        self.id = id
+        self.display_name = display_name
+        self.type = type
+        self.verified_at = verified_at if verified_at is not None else time.time()
+
+
+def login_user(user):
+    '''
+    Store the identity of an authenticated user in the session
+    '''
+
+    user_meta = UserMeta(user.id, user.display_name, user.type)
+    session['user'] = user_meta.__dict__
+
+
+def logout_user():
+    '''
+    Remove the identity of the logged in user from the session
+    '''
+
+    session.pop('user', None)
+
+
+def is_loggedin():
+    '''
+    Check if the request is made by a logged in user
+    '''
+
+    return 'user' in session
+
+
+def mark_write():
+    '''
+    Remember in the session that the user just changed data, so their reads stay on the primary database
+    while the read replica catches up (see wrote_recently)
+    '''
+
+    session['wrote_at'] = time.time()
+
+
+def wrote_recently():
+    '''
+    Check if the user changed data less than REPLICA_STALENESS_SECONDS ago
+    '''
+
+    return time.time() - session.get('wrote_at', 0) < Config.REPLICA_STALENESS_SECONDS
+
+
+def get_current_identity():
+    '''
+    Get the identity of the currently logged in user from the signed session.
+    The session is trusted without a database round trip, unless the user was changed since the
+    identity was verified or the identity is older than USER_CACHE_TTL seconds. In that case it is
+    verified again against the (cached) user record, and the user is logged out if it no longer exists.
+
+    Returns
+    -------
+    UserMeta
+        The identity of the logged in user, None if not logged in.
+    '''
+
+    if not is_loggedin():
+        return None
+
+    user_meta = UserMeta(**session['user'])
+    if time.time() - user_meta.verified_at < Config.USER_CACHE_TTL and \
+            not user_service.is_changed_since(user_meta.id, user_meta.verified_at):
+        return user_meta
+
+    user = user_service.fetch_cached_user(user_meta.id)
+    if user is None:
+        logout_user()
+        return None
+    login_user(user)
+    return UserMeta(**session['user'])
+
+
+def get_current_user():
+    '''
+    Get the full record of the currently logged in user, for the cases where the identity is not enough
+
+    Returns
+    -------
+    Admin/User
+        The logged in user, detached from the database session. None if not logged in.
+    '''
+
+    user_meta = get_current_identity()
+    if user_meta is None:
+        return None
+    return user_service.fetch_cached_user(user_meta.id)
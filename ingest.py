@@ -0,0 +1,291 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from config import Config
+from database import db_session
+from services import blog_service
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the commit batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class CommentTicket:
+    '''
+    Acknowledgement handle of a queued comment, completed once the comment is committed or rejected.
+    A ticket is claimed by the writer before its comment is written, or expired by a caller that stopped
+    waiting for it before then, in which case the comment is never written.
+    '''
+
+    def __init__(self, post_id, content, user_id):
+        self.post_id = post_id
+        self.content = content
+        self.user_id = user_id
+        self.added = None
+        self.error = None
+        self._done = threading.Event()
+        self._state = 'queued'
+        self._state_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until the comment is durable.
+
+        Parameters
+        ----------
+        timeout: float,
+            Maximum number of seconds to wait, None to wait forever.
+
+        Returns
+        -------
+        Boolean
+            True if the comment was committed, False if its blog post does not exist.
+
+        Raises
+        ------
+        TimeoutError
+            If the writer did not take the comment in time. The comment is dropped and never committed,
+            so the caller can safely submit it again. Once the writer took it, waits for the outcome.
+        Exception
+            The error that prevented the comment from being committed.
+        '''
+
+        if not self._done.wait(timeout):
+            if self._expire():
+                raise TimeoutError("Comment was not written in time")
+            self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.added
+
+    def _claim(self):
+        '''
+        Private method called by the writer before writing the comment. Returns False if the ticket expired.
+        '''
+
+        with self._state_lock:
+            if self._state == 'expired':
+                return False
+            self._state = 'claimed'
+            return True
+
+    def _expire(self):
+        '''
+        Private method that drops the comment unless the writer claimed it. Returns True if it was dropped.
+        '''
+
+        with self._state_lock:
+            if self._state != 'queued':
+                return False
+            self._state = 'expired'
+            return True
+
+    def _complete(self, added, error=None):
+        self.added = added
+        self.error = error
+        self._done.set()
+
+
+class CommentIngestQueue:
+    '''
+    A bounded queue of comments written to the database by a background writer thread.
+    The writer takes every comment queued while it was busy and commits them in one transaction
+    (group commit), so a burst of comments costs a few transactions instead of one per comment.
+    When the queue is full, submitting blocks for at most enqueue_timeout_ms milliseconds and then
+    fails with queue.Full, pushing back on the callers instead of growing without bound.
+    '''
+
+    def __init__(self, max_size, max_batch_size, enqueue_timeout_ms):
+        self.max_batch_size = max_batch_size
+        self.enqueue_timeout_ms = enqueue_timeout_ms
+        self.batches = 0
+        self.committed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.expired = 0
+        self.last_batch_size = 0
+        self.max_seen_batch_size = 0
+        self.batch_size_counts = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self._exit_handler_registered = False
+
+    def submit(self, post_id, content, user):
+        '''
+        Queue a comment for the background writer.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        content: str,
+            The body of the comment.
+        user: User,
+            The user who is making the comment. Only the id is used, so the session identity can be passed.
+
+        Returns
+        -------
+        CommentTicket
+            Handle to wait on until the comment is durable.
+
+        Raises
+        ------
+        queue.Full
+            If the queue stayed full for enqueue_timeout_ms milliseconds.
+        '''
+
+        self._ensure_worker()
+        ticket = CommentTicket(post_id, content, user.id)
+        try:
+            self._queue.put(ticket, timeout=self.enqueue_timeout_ms / 1000)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise
+        return ticket
+
+    def depth(self):
+        '''
+        Get the number of comments waiting to be written.
+        '''
+
+        return self._queue.qsize()
+
+    def stats(self):
+        '''
+        Get the queue metrics.
+
+        Returns
+        -------
+        dict
+            Queue depth, number of batches, comments committed, rejected (queue full), failed and expired
+            (dropped after their caller stopped waiting), last and largest batch size, and the batch size
+            histogram as {bucket upper bound: count}.
+        '''
+
+        with self._lock:
+            histogram = dict(zip([str(bound) for bound in BATCH_SIZE_BUCKETS] + ['+Inf'],
+                                 self.batch_size_counts))
+            return {'depth': self.depth(), 'batches': self.batches, 'committed': self.committed,
+                    'rejected': self.rejected, 'failed': self.failed, 'expired': self.expired,
+                    'last_batch_size': self.last_batch_size,
+                    'max_batch_size': self.max_seen_batch_size, 'batch_size_histogram': histogram}
+
+    def stop(self):
+        '''
+        Write the comments left in the queue and stop the background writer.
+        '''
+
+        self._queue.put(None)
+        worker = self._worker
+        if worker is not None and worker.is_alive() and worker is not threading.current_thread():
+            worker.join()
+
+    def reset_after_fork(self):
+        '''
+        Drop the comments a forked process inherited, which its parent writes, along with the writer thread,
+        which was not copied, and the locks, which another thread of the parent may have held.
+        '''
+
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+
+    def _ensure_worker(self):
+        '''
+        Private method that starts the background writer in the current process, if not running.
+        '''
+
+        with self._lock:
+            if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(
+                target=self._run, name="comment-writer", daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+            if not self._exit_handler_registered:
+                atexit.register(self.stop)
+                self._exit_handler_registered = True
+
+    def _run(self):
+        '''
+        Private method that runs the writer loop, until a None sentinel is taken from the queue.
+        '''
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [ticket for ticket in batch if ticket is not None]
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        '''
+        Private method that commits a batch of comments and completes their tickets, skipping the expired ones.
+        If the batch fails, its comments are retried one by one so that one bad comment only fails its own ticket.
+        '''
+
+        claimed = [ticket for ticket in batch if ticket._claim()]
+        if len(claimed) < len(batch):
+            with self._lock:
+                self.expired += len(batch) - len(claimed)
+        batch = claimed
+        if not batch:
+            return
+        try:
+            comments = blog_service.add_comments(
+                [(ticket.post_id, ticket.content, ticket.user_id) for ticket in batch])
+            for ticket, comment in zip(batch, comments):
+                ticket._complete(comment is not None)
+            self._record_batch(len(batch), len(batch), 0)
+        except Exception:
+            db_session.rollback()
+            logger.exception(
+                "Writing a batch of %d comments failed, retrying one by one", len(batch))
+            committed = 0
+            for ticket in batch:
+                try:
+                    comment, = blog_service.add_comments(
+                        [(ticket.post_id, ticket.content, ticket.user_id)])
+                    ticket._complete(comment is not None)
+                    committed += 1
+                except Exception as e:
+                    db_session.rollback()
+                    ticket._complete(False, e)
+            self._record_batch(len(batch), committed, len(batch) - committed)
+        finally:
+            db_session.remove()
+
+    def _record_batch(self, size, committed, failed):
+        '''
+        Private method that updates the batch metrics.
+        '''
+
+        with self._lock:
+            self.batches += 1
+            self.committed += committed
+            self.failed += failed
+            self.last_batch_size = size
+            self.max_seen_batch_size = max(self.max_seen_batch_size, size)
+            bucket = next((i for i, bound in enumerate(BATCH_SIZE_BUCKETS) if size <= bound),
+                          len(BATCH_SIZE_BUCKETS))
+            self.batch_size_counts[bucket] += 1
+
+
+comment_ingest_queue = CommentIngestQueue(
+    Config.COMMENT_QUEUE_SIZE, Config.COMMENT_BATCH_SIZE, Config.COMMENT_ENQUEUE_TIMEOUT_MS)
+os.register_at_fork(after_in_child=comment_ingest_queue.reset_after_fork)
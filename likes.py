@@ -0,0 +1,296 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import text
+
+from cache import page_cache
+from config import Config
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+
+class LikeAggregator:
+    '''
+    Collects likes and unlikes of blog posts in memory and writes them to the database in batches.
+    A background thread flushes the pending changes every flush_interval_ms milliseconds, or as soon as
+    flush_max_events changes are pending, in a single transaction that records the likes in post_likes and
+    adjusts the like_count of every affected post. Pending changes are flushed when the interpreter exits.
+
+    Likes are deduplicated per user: liking a post twice, or unliking a post that is not liked, is a no-op.
+    Like counts and states read through the aggregator include the changes of this process that are not flushed
+    yet. Other processes only see a change once it is flushed, so a request that must see its own like from any
+    worker waits for the flush with wait_written, which wakes the background thread up. Likes recorded while a
+    flush is running are written together by the next one.
+    '''
+
+    def __init__(self, flush_interval_ms, flush_max_events):
+        self.flush_interval_ms = flush_interval_ms
+        self.flush_max_events = flush_max_events
+        self.flushes = 0
+        self.flushed_events = 0
+        self._pending = {}
+        self._pending_deltas = {}
+        self._in_flight = {}
+        self._in_flight_deltas = {}
+        self._events = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._exit_handler_registered = False
+
+    def set_liked(self, post_id, user_id, liked):
+        '''
+        Like or unlike a blog post on behalf of a user.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        user_id: int,
+            ID of the user.
+        liked: Boolean,
+            True to like the post, False to unlike it.
+
+        Returns
+        -------
+        Boolean
+            True if the like state of the user changed, False if it already was as requested.
+        '''
+
+        key = (post_id, user_id)
+        stored_state = self.is_liked(post_id, user_id)
+        with self._lock:
+            state = self._pending.get(key, self._in_flight.get(key, stored_state))
+            if state == liked:
+                return False
+            self._pending[key] = liked
+            self._pending_deltas[post_id] = self._pending_deltas.get(
+                post_id, 0) + (1 if liked else -1)
+            self._events += 1
+            self._ensure_worker()
+            if self._events >= self.flush_max_events:
+                self._wakeup.notify()
+
+        page_cache.invalidate_post(post_id)
+        return True
+
+    def is_liked(self, post_id, user_id):
+        '''
+        Check whether a user likes a blog post, including changes that are not flushed yet.
+        '''
+
+        state = self.pending_state(post_id, user_id)
+        if state is not None:
+            return state
+
+        with engine.connect() as connection:
+            return connection.execute(text(
+                "SELECT 1 FROM post_likes WHERE blog_post_id = :blog_post_id AND user_id = :user_id"),
+                blog_post_id=post_id, user_id=user_id).first() is not None
+
+    def pending_state(self, post_id, user_id):
+        '''
+        Get the like state of a user for a blog post that is not flushed yet, None if there is no pending change.
+        '''
+
+        key = (post_id, user_id)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            return self._in_flight.get(key)
+
+    def pending_delta(self, post_id):
+        '''
+        Get the change of the like count of a blog post that is not flushed to the database yet.
+        '''
+
+        with self._lock:
+            return self._pending_deltas.get(post_id, 0) + self._in_flight_deltas.get(post_id, 0)
+
+    def wait_written(self, post_id, user_id, timeout):
+        '''
+        Wait until the like state of a user for a blog post is written to the database, flushing the pending
+        changes without waiting for the flush interval.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        user_id: int,
+            ID of the user.
+        timeout: float,
+            Maximum time to wait, in seconds.
+
+        Returns
+        -------
+        Boolean
+            True if the change is written, False if it is still pending after the timeout, e.g. because the
+            flush failed, in which case it is written by a later flush.
+        '''
+
+        key = (post_id, user_id)
+        with self._lock:
+            if key in self._pending:
+                self._flush_requested = True
+                self._wakeup.notify()
+            return self._flushed.wait_for(lambda: key not in self._pending and key not in self._in_flight, timeout)
+
+    def stats(self):
+        '''
+        Get the aggregator metrics.
+
+        Returns
+        -------
+        dict
+            Number of pending and in flight like changes, flushes and like changes flushed.
+        '''
+
+        with self._lock:
+            return {'pending': len(self._pending), 'in_flight': len(self._in_flight), 'flushes': self.flushes,
+                    'flushed_events': self.flushed_events}
+
+    def flush(self):
+        '''
+        Write the pending likes and unlikes to the database in one transaction.
+        If the transaction fails, the changes are kept pending and retried on the next flush.
+        '''
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch, deltas = self._pending, self._pending_deltas
+                self._in_flight, self._in_flight_deltas = batch, deltas
+                self._pending, self._pending_deltas = {}, {}
+                self._events = 0
+                self._flush_requested = False
+
+            try:
+                counts = self._write(batch)
+            except Exception:
+                logger.exception("Flushing %d post likes failed", len(batch))
+                with self._lock:
+                    for key, liked in batch.items():
+                        self._pending.setdefault(key, liked)
+                    for post_id, delta in deltas.items():
+                        self._pending_deltas[post_id] = self._pending_deltas.get(
+                            post_id, 0) + delta
+                    self._events += len(batch)
+                    self._in_flight, self._in_flight_deltas = {}, {}
+                    self._flushed.notify_all()
+                return
+
+            with self._lock:
+                self._in_flight, self._in_flight_deltas = {}, {}
+                self.flushes += 1
+                self.flushed_events += len(batch)
+                self._flushed.notify_all()
+            for post_id in counts:
+                page_cache.invalidate_post(post_id)
+
+    def stop(self):
+        '''
+        Stop the background thread and flush the pending changes.
+        '''
+
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+            worker = self._worker
+        if worker is not None and worker.is_alive() and worker is not threading.current_thread():
+            worker.join(timeout=self.flush_interval_ms / 1000 * 2 + 5)
+        self.flush()
+
+    def reset_after_fork(self):
+        '''
+        Drop the likes a forked process inherited, which its parent writes, along with the background thread,
+        which was not copied, and the locks, which another thread of the parent may have held.
+        '''
+
+        self._pending, self._pending_deltas = {}, {}
+        self._in_flight, self._in_flight_deltas = {}, {}
+        self._events = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+
+    def _write(self, batch):
+        '''
+        Private method that applies a batch of like states and returns the like count change per post.
+        The like count only moves by the rows actually inserted or deleted, so it stays correct when
+        several processes record likes of the same user.
+        '''
+
+        counts = {}
+        with engine.begin() as connection:
+            for (post_id, user_id), liked in batch.items():
+                if liked:
+                    result = connection.execute(text(
+                        "INSERT INTO post_likes (user_id, blog_post_id) SELECT :user_id, :blog_post_id "
+                        "WHERE NOT EXISTS (SELECT 1 FROM post_likes "
+                        "WHERE blog_post_id = :blog_post_id AND user_id = :user_id)"),
+                        user_id=user_id, blog_post_id=post_id)
+                    counts[post_id] = counts.get(post_id, 0) + result.rowcount
+                else:
+                    result = connection.execute(text(
+                        "DELETE FROM post_likes WHERE blog_post_id = :blog_post_id AND user_id = :user_id"),
+                        user_id=user_id, blog_post_id=post_id)
+                    counts[post_id] = counts.get(post_id, 0) - result.rowcount
+
+            updates = [{'id': post_id, 'delta': delta, 'now': datetime.now()}
+                       for post_id, delta in counts.items() if delta != 0]
+            if updates:
+                connection.execute(text(
+                    "UPDATE blog_posts SET like_count = coalesce(like_count, 0) + :delta, "
+                    "version = coalesce(version, 0) + 1, updated_at = :now WHERE id = :id"), updates)
+        return counts
+
+    def _ensure_worker(self):
+        '''
+        Private method that starts the background thread in the current process, if not running.
+        Must be called with the lock held.
+        '''
+
+        if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        self._stopping = False
+        self._worker = threading.Thread(
+            target=self._run, name="like-aggregator", daemon=True)
+        self._worker_pid = os.getpid()
+        self._worker.start()
+        if not self._exit_handler_registered:
+            atexit.register(self.stop)
+            self._exit_handler_registered = True
+
+    def _run(self):
+        '''
+        Private method that runs the background flush loop.
+        '''
+
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(lambda: self._stopping or self._events >= self.flush_max_events or
+                                      self._flush_requested,
+                                      timeout=self.flush_interval_ms / 1000)
+                if self._stopping:
+                    return
+            self.flush()
+
+
+like_aggregator = LikeAggregator(
+    Config.LIKE_FLUSH_INTERVAL_MS, Config.LIKE_FLUSH_MAX_EVENTS)
+os.register_at_fork(after_in_child=like_aggregator.reset_after_fork)
@@ -0,0 +1,385 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the SQL statements per request histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Quoted string literals and numbers outside of identifiers, replaced in slow query samples
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# Totals of the request being served by the current thread or asyncio task, None outside of requests
+_current_request = ContextVar('current_request', default=None)
+
+
+class RequestTimer:
+    '''
+    The running totals of a request: when it started, the number of SQL statements it ran
+    and the time they took.
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+    def elapsed(self):
+        '''
+        Get the number of seconds since the request started.
+        '''
+
+        return time.perf_counter() - self.started
+
+
+class Histogram:
+    '''
+    Observation counts by bucket upper bound, with their sum, as exposed in Prometheus histograms.
+    Not thread safe, callers hold the lock of the metrics that own it.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        '''
+        Count a value in the first bucket whose upper bound is at least the value.
+        '''
+
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    '''
+    Collects the latency, number of SQL statements and database time of requests, by route, and samples
+    of slow SQL statements with their bound parameters redacted.
+    SQL statements are timed by engine event hooks (see instrument_engine) and attributed to the request
+    served by the thread or asyncio task that ran them. Statements run outside of a request, such as the
+    background like and comment writers, only count in the database totals.
+    '''
+
+    def __init__(self, slow_query_ms, slow_query_samples):
+        self.slow_query_ms = slow_query_ms
+        self.queries = 0
+        self.db_time = 0.0
+        self.slow_queries = 0
+        self._requests = {}
+        self._latency = {}
+        self._query_counts = {}
+        self._db_time = {}
+        self._samples = deque(maxlen=slow_query_samples)
+        self._lock = threading.Lock()
+
+    def instrument_engine(self, engine):
+        '''
+        Time every SQL statement run by an engine.
+        '''
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            duration = time.perf_counter() - conn.info['query_start_time'].pop()
+            self.record_query(statement, parameters, executemany, duration)
+
+    def start_request(self):
+        '''
+        Start timing the request served by the current thread or asyncio task.
+        '''
+
+        _current_request.set(RequestTimer())
+
+    def current_request(self):
+        '''
+        Get the totals of the request being served, None outside of a request.
+        '''
+
+        return _current_request.get()
+
+    def finish_request(self, route, method, status):
+        '''
+        Record the request served by the current thread or asyncio task.
+
+        Parameters
+        ----------
+        route: str,
+            Name of the route (Flask endpoint) that served the request.
+        method: str,
+            HTTP method of the request.
+        status: int,
+            HTTP status of the response.
+
+        Returns
+        -------
+        RequestTimer
+            The totals of the request, None if it was not started with start_request.
+        '''
+
+        timer = _current_request.get()
+        if timer is None:
+            return None
+        _current_request.set(None)
+        elapsed = timer.elapsed()
+        key = (route, method)
+        with self._lock:
+            self._requests[key + (status,)] = self._requests.get(key + (status,), 0) + 1
+            if key not in self._latency:
+                self._latency[key] = Histogram(LATENCY_BUCKETS)
+                self._query_counts[key] = Histogram(QUERY_COUNT_BUCKETS)
+                self._db_time[key] = Histogram(LATENCY_BUCKETS)
+            self._latency[key].observe(elapsed)
+            self._query_counts[key].observe(timer.queries)
+            self._db_time[key].observe(timer.db_time)
+        return timer
+
+    def record_query(self, statement, parameters, executemany, duration):
+        '''
+        Record an SQL statement that ran for duration seconds.
+        Statements slower than slow_query_ms are logged and kept as samples, with their literals and
+        bound parameters redacted.
+        '''
+
+        timer = _current_request.get()
+        if timer is not None:
+            timer.queries += 1
+            timer.db_time += duration
+        slow = duration * 1000 >= self.slow_query_ms
+        with self._lock:
+            self.queries += 1
+            self.db_time += duration
+            if slow:
+                self.slow_queries += 1
+        if slow:
+            sample = {'statement': redact_statement(statement),
+                      'parameters': redact_parameters(parameters, executemany),
+                      'duration_ms': round(duration * 1000, 3), 'time': time.time()}
+            with self._lock:
+                self._samples.append(sample)
+            logger.warning("Slow query (%.1f ms): %s %s", sample['duration_ms'], sample['statement'],
+                           sample['parameters'])
+
+    def slow_query_samples(self):
+        '''
+        Get the most recent slow query samples, newest first.
+
+        Returns
+        -------
+        list
+            Samples as dicts of the redacted statement and parameters, duration in milliseconds and
+            Unix time.
+        '''
+
+        with self._lock:
+            return list(reversed(self._samples))
+
+    def render(self, gauges=None):
+        '''
+        Render the metrics in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        gauges: dict,
+            Other components' stats to expose as gauges, as {prefix: stats dict}, e.g.
+            {'page_cache': page_cache.stats()}. Nested dicts become one gauge labelled by bucket.
+
+        Returns
+        -------
+        str
+            The metrics document.
+        '''
+
+        lines = []
+        with self._lock:
+            lines += _metric_header('blog_http_requests_total', 'counter', "Requests served, by route and status.")
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append('blog_http_requests_total{} {}'.format(
+                    _labels(route=route, method=method, status=status), count))
+            _render_histograms(lines, 'blog_http_request_duration_seconds',
+                               "Time to produce the response, by route.", self._latency)
+            _render_histograms(lines, 'blog_http_request_queries',
+                               "SQL statements run per request, by route.", self._query_counts)
+            _render_histograms(lines, 'blog_http_request_db_seconds',
+                               "Time spent in SQL statements per request, by route.", self._db_time)
+            lines += _metric_header('blog_db_queries_total', 'counter', "SQL statements run.")
+            lines.append('blog_db_queries_total {}'.format(self.queries))
+            lines += _metric_header('blog_db_seconds_total', 'counter', "Time spent in SQL statements.")
+            lines.append('blog_db_seconds_total {}'.format(_number(self.db_time)))
+            lines += _metric_header('blog_db_slow_queries_total', 'counter',
+                                    "SQL statements slower than {} ms.".format(self.slow_query_ms))
+            lines.append('blog_db_slow_queries_total {}'.format(self.slow_queries))
+
+        for prefix, stats in sorted((gauges or {}).items()):
+            for name, value in sorted(stats.items()):
+                metric = 'blog_{}_{}'.format(prefix, name)
+                if isinstance(value, dict):
+                    lines += _metric_header(metric, 'gauge', None)
+                    lines += ['{}{} {}'.format(metric, _labels(bucket=bucket), _number(count))
+                              for bucket, count in value.items()]
+                elif isinstance(value, (int, float)):
+                    lines += _metric_header(metric, 'gauge', None)
+                    lines.append('{} {}'.format(metric, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class StartupMetrics:
+    '''
+    Measures how fast a worker process gets ready to serve: its cold start, from the import of the application
+    module to the end of create_app, and its time to first request, from the moment it was ready (or forked
+    from a preloading parent) to its first response. Either one is logged as a warning when over its budget.
+    '''
+
+    def __init__(self, startup_budget_ms, first_request_budget_ms):
+        self.startup_budget_ms = startup_budget_ms
+        self.first_request_budget_ms = first_request_budget_ms
+        self.startup_seconds = None
+        self.first_request_seconds = None
+        self._ready_at = None
+        self._lock = threading.Lock()
+
+    def app_created(self, import_started):
+        '''
+        Record the cold start of an application whose module import started at import_started (perf_counter).
+        '''
+
+        self._ready_at = time.perf_counter()
+        self.startup_seconds = self._ready_at - import_started
+        self._check("Cold start", self.startup_seconds, self.startup_budget_ms)
+
+    def worker_forked(self):
+        '''
+        Restart the time to first request in a worker forked from a parent that preloaded the application.
+        '''
+
+        self._ready_at = time.perf_counter()
+        self.first_request_seconds = None
+        self._lock = threading.Lock()
+
+    def request_served(self):
+        '''
+        Record the time to first request, when called for the first response of the process.
+        '''
+
+        if self.first_request_seconds is not None or self._ready_at is None:
+            return
+        with self._lock:
+            if self.first_request_seconds is not None:
+                return
+            self.first_request_seconds = time.perf_counter() - self._ready_at
+        self._check("Time to first request", self.first_request_seconds, self.first_request_budget_ms)
+
+    def stats(self):
+        '''
+        Get the startup times in seconds, None until measured.
+        '''
+
+        return {'startup_seconds': self.startup_seconds, 'first_request_seconds': self.first_request_seconds}
+
+    def _check(self, name, seconds, budget_ms):
+        '''
+        Private method that logs a startup time over its budget.
+        '''
+
+        if seconds * 1000 > budget_ms:
+            logger.warning("%s of worker %d took %.0f ms, over its budget of %d ms", name, os.getpid(),
+                           seconds * 1000, budget_ms)
+
+
+def server_timing(timer):
+    '''
+    Build the Server-Timing header value of a request from its totals, e.g.
+    app;dur=12.5, db;dur=3.2;desc="4 queries"
+    '''
+
+    return 'app;dur={:.1f}, db;dur={:.1f};desc="{} queries"'.format(
+        timer.elapsed() * 1000, timer.db_time * 1000, timer.queries)
+
+
+def redact_statement(statement):
+    '''
+    Replace the string and number literals of an SQL statement with ?, so samples carry no data
+    '''
+
+    return _LITERALS.sub('?', ' '.join(statement.split()))
+
+
+def redact_parameters(parameters, executemany=False):
+    '''
+    Replace bound parameter values by their type names, so samples show the shape of a statement's
+    parameters without their data. Only the first row of an executemany is described, with the number of rows.
+    '''
+
+    if executemany:
+        rows = list(parameters)
+        return '{} rows of {}'.format(len(rows), redact_parameters(rows[0]) if rows else '()')
+    if isinstance(parameters, dict):
+        return '{' + ', '.join('{}: {}'.format(name, type(value).__name__)
+                               for name, value in parameters.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters or ()) + ')'
+
+
+def _metric_header(name, kind, help_text):
+    '''
+    Private function that builds the HELP and TYPE comment lines of a metric
+    '''
+
+    lines = ['# HELP {} {}'.format(name, help_text)] if help_text else []
+    return lines + ['# TYPE {} {}'.format(name, kind)]
+
+
+def _render_histograms(lines, name, help_text, histograms):
+    '''
+    Private function that renders per route histograms with cumulative buckets, as Prometheus expects
+    '''
+
+    lines += _metric_header(name, 'histogram', help_text)
+    for (route, method), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(route=route, method=method, le=bound), cumulative))
+        labels = _labels(route=route, method=method)
+        lines.append('{}_sum{} {}'.format(name, labels, _number(histogram.sum)))
+        lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+
+
+def _labels(**labels):
+    '''
+    Private function that renders a label set, escaping the values
+    '''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for name, value in labels.items()) + '}'
+
+
+def _number(value):
+    '''
+    Private function that renders a sample value
+    '''
+
+    return repr(round(value, 6)) if isinstance(value, float) else str(int(value))
+
+
+request_metrics = RequestMetrics(Config.SLOW_QUERY_MS, Config.SLOW_QUERY_SAMPLES)
+startup_metrics = StartupMetrics(Config.STARTUP_BUDGET_MS, Config.FIRST_REQUEST_BUDGET_MS)
+os.register_at_fork(after_in_child=startup_metrics.worker_forked)
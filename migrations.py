@@ -0,0 +1,261 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Float, Integer, Text, func, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+
+from database import Base, engine
+from models import SchemaVersion
+from rendering import render_content
+from search import search_index
+
+logger = logging.getLogger(__name__)
+
+# Migrations by version, in the order they are applied
+MIGRATIONS = []
+# Rows read at a time by the migrations that rewrite existing rows
+MIGRATION_BATCH_SIZE = 500
+
+
+class Migration:
+    '''
+    A versioned change of the database schema, such as a new column or index, applied once to every database.
+    Its steps check what already exists before changing it, so a migration interrupted on a database without
+    transactional DDL (SQLite commits some statements on its own) can simply be run again.
+    '''
+
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+def migration(version, description):
+    '''
+    Decorator registering a function of a connection as the upgrade of a schema version.
+    '''
+
+    def register(upgrade):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError("Migration {} is registered after migration {}".format(
+                version, MIGRATIONS[-1].version))
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+    return register
+
+
+def add_column(connection, table, column):
+    '''
+    Add a column to a table, unless the table already has a column of that name.
+
+    Parameters
+    ----------
+    connection: Connection,
+        Database connection.
+    table: str,
+        Name of the table.
+    column: Column,
+        The column, not attached to any table. Migrations keep their own copy of the column definition,
+        since the models change after the migration is written.
+
+    Returns
+    -------
+    Boolean
+        True if the column was added, False if it already existed.
+    '''
+
+    if column.name in [existing['name'] for existing in inspect(connection).get_columns(table)]:
+        return False
+    connection.execute(text("ALTER TABLE {} ADD COLUMN {}".format(
+        connection.dialect.identifier_preparer.quote(table),
+        CreateColumn(column).compile(dialect=connection.dialect))))
+    return True
+
+
+def create_index(connection, name):
+    '''
+    Create an index declared on the models, unless its table already has an index of that name.
+
+    Returns
+    -------
+    Boolean
+        True if the index was created, False if it already existed.
+    '''
+
+    index = next(index for table in Base.metadata.tables.values() for index in table.indexes if index.name == name)
+    if name in [existing['name'] for existing in inspect(connection).get_indexes(index.table.name)]:
+        return False
+    index.create(connection)
+    return True
+
+
+def render_posts(connection, batch_size=MIGRATION_BATCH_SIZE):
+    '''
+    Render the HTML and excerpt of the blog posts that have none, in batches of posts (see
+    rendering.render_content).
+    '''
+
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            "SELECT id, content FROM blog_posts "
+            "WHERE id > :last_id AND (content_html IS NULL OR excerpt IS NULL) ORDER BY id LIMIT :limit"),
+            last_id=last_id, limit=batch_size).fetchall()
+        if not rows:
+            return
+        updates = []
+        for id, content in rows:
+            content_html, excerpt = render_content(content)
+            updates.append({'id': id, 'content_html': content_html, 'excerpt': excerpt})
+        connection.execute(text(
+            "UPDATE blog_posts SET content_html = :content_html, excerpt = :excerpt WHERE id = :id"), updates)
+        last_id = rows[-1].id
+
+
+def normalize_tags(connection):
+    '''
+    Trim and lower case the tags of the blog posts, as BlogService does when posts are saved, then delete the
+    blank tags and the duplicate tags of each post, keeping the first.
+    '''
+
+    connection.execute(text("UPDATE tags SET tag = lower(trim(tag)) WHERE tag != lower(trim(tag))"))
+    connection.execute(text("DELETE FROM tags WHERE tag IS NULL OR tag = ''"))
+    connection.execute(text(
+        "DELETE FROM tags WHERE id NOT IN (SELECT min(id) FROM tags GROUP BY blog_post_id, tag)"))
+
+
+class SchemaMigrator:
+    '''
+    Brings databases to the latest schema version with the registered migrations, and records every applied
+    migration in the schema_version table. Each migration runs in its own transaction.
+    Databases created from the current models already have the latest schema, and are only stamped with it.
+    '''
+
+    def __init__(self, engine, migrations):
+        self.engine = engine
+        self.migrations = migrations
+
+    def current_version(self):
+        '''
+        Get the schema version of the database, 0 if no migration has been applied.
+        '''
+
+        with self.engine.connect() as connection:
+            return connection.execute(select([func.coalesce(func.max(SchemaVersion.version), 0)])).scalar()
+
+    def pending(self):
+        '''
+        Get the migrations not applied to the database yet.
+        '''
+
+        version = self.current_version()
+        return [migration for migration in self.migrations if migration.version > version]
+
+    def upgrade(self):
+        '''
+        Apply the pending migrations in order.
+
+        Returns
+        -------
+        list
+            The applied migrations.
+        '''
+
+        applied = []
+        for migration in self.pending():
+            logger.info("Migrating the database to version %d: %s", migration.version, migration.description)
+            with self.engine.begin() as connection:
+                migration.upgrade(connection)
+                self._record(connection, migration)
+            applied.append(migration)
+        return applied
+
+    def stamp(self):
+        '''
+        Record every migration as applied, for a database just created from the current models.
+        '''
+
+        with self.engine.begin() as connection:
+            for migration in self.migrations:
+                self._record(connection, migration)
+
+    def _record(self, connection, migration):
+        '''
+        Private method that records an applied migration.
+        '''
+
+        connection.execute(SchemaVersion.__table__.insert().values(
+            version=migration.version, description=migration.description, applied_at=datetime.now()))
+
+
+@migration(1, "Columns, tables and indexes added since the first release")
+def upgrade_from_first_release(connection):
+    # New tables are created by init_db before migrating
+    for column in [Column('version', Integer), Column('updated_at', DateTime), Column('comment_count', Integer),
+                   Column('like_count', Integer), Column('content_html', Text), Column('excerpt', Text)]:
+        add_column(connection, 'blog_posts', column)
+
+    # Posts were rendered when read, and tags stored as typed
+    render_posts(connection)
+    normalize_tags(connection)
+
+    # Likes were not unique before, keep the first like of each user
+    connection.execute(text(
+        "DELETE FROM post_likes WHERE id NOT IN "
+        "(SELECT min(id) FROM post_likes GROUP BY blog_post_id, user_id)"))
+    for name in ['ix_comments_blog_post_id_comment_date', 'ix_post_likes_blog_post_id_user_id',
+                 'ix_tags_tag_blog_post_id']:
+        create_index(connection, name)
+
+    connection.execute(text(
+        "UPDATE blog_posts SET "
+        "comment_count = (SELECT count(*) FROM comments WHERE comments.blog_post_id = blog_posts.id), "
+        "like_count = (SELECT count(*) FROM post_likes WHERE post_likes.blog_post_id = blog_posts.id), "
+        "version = coalesce(version, 1), updated_at = coalesce(updated_at, post_date)"))
+    if connection.execute(text("SELECT count(*) FROM tag_counts")).scalar() == 0:
+        connection.execute(text(
+            "INSERT INTO tag_counts (tag, post_count) "
+            "SELECT tags.tag, count(DISTINCT tags.blog_post_id) FROM tags "
+            "JOIN blog_posts ON blog_posts.id = tags.blog_post_id "
+            "WHERE blog_posts.is_visible GROUP BY tags.tag"))
+
+    search_index.rebuild(connection)
+
+
+@migration(2, "Indexes of the post listings, tags of posts, tag cloud and external references")
+def index_hot_queries(connection):
+    for name in ['ix_blog_posts_is_visible_post_date', 'ix_blog_posts_post_date', 'ix_tags_blog_post_id',
+                 'ix_tag_counts_post_count', 'ix_external_references_blog_post_id']:
+        create_index(connection, name)
+
+
+@migration(3, "Award time and unique index of user badges")
+def index_user_badges(connection):
+    # The reputation watermarks table is created by init_db before migrating
+    add_column(connection, 'user_badges', Column('awarded_at', DateTime))
+    connection.execute(text(
+        "DELETE FROM user_badges WHERE id NOT IN "
+        "(SELECT min(id) FROM user_badges GROUP BY user_id, badge_id)"))
+    create_index(connection, 'ix_user_badges_user_id_badge_id')
+
+
+@migration(4, "Time of the last change of users")
+def track_user_changes(connection):
+    add_column(connection, 'users', Column('changed_at', Float))
+    create_index(connection, 'ix_users_changed_at')
+
+
+@migration(5, "Counted likes and skipped events of the reputation engine")
+def track_counted_likes(connection):
+    # The reputation_counted_likes and reputation_skips tables are created by init_db before migrating
+    connection.execute(text(
+        "INSERT INTO reputation_counted_likes (blog_post_id, user_id) "
+        "SELECT DISTINCT blog_post_id, user_id FROM post_likes "
+        "WHERE id <= (SELECT last_id FROM reputation_watermarks WHERE source = 'likes') "
+        "AND blog_post_id IS NOT NULL AND user_id IS NOT NULL "
+        "AND NOT EXISTS (SELECT 1 FROM reputation_counted_likes WHERE "
+        "reputation_counted_likes.blog_post_id = post_likes.blog_post_id "
+        "AND reputation_counted_likes.user_id = post_likes.user_id)"))
+
+
+schema_migrator = SchemaMigrator(engine, MIGRATIONS)
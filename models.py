@@ -1,9 +1,9 @@
 from collections import defaultdict
 
 import sqlalchemy
-from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Integer, String,
-                        Text, event)
-from sqlalchemy.orm import relationship
+from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Index,
+                        Integer, String, Text, event)
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql.schema import Table
 
 from database import Base
@@ -39,6 +39,9 @@ class User(Base):
     phone = Column(String(10), unique=True)
     email = Column(String(50), unique=True, nullable=False)
     reputation_score = Column(Integer)
+    # When the user was last changed, in seconds since the epoch. Session identities verified before then
+    # are verified again, by every process (see UserService.is_changed_since)
+    changed_at = Column(Float)
     comments = relationship("Comment", back_populates="user")
     social_media = relationship("UserSocialMedia", back_populates="user")
     badges = relationship("UserBadge", back_populates="user")
@@ -48,11 +51,16 @@ class User(Base):
         'polymorphic_on': type
     }
 
+    __table_args__ = (
+        # Finds the users changed recently
+        Index('ix_users_changed_at', 'changed_at'),
+    )
+
     def __init__(self):
         self.type = "User"
 
     def add_reputation_score(self, score):
-        self.reputation_score = self.reputation_score + score
+        self.reputation_score = (self.reputation_score or 0) + score
 
     def __repr__(self):
         return "Username: {} Displayname:{}, Type:{}, Email:{}".format(self.username, self.display_name, self.type, self.email)
@@ -93,14 +101,121 @@ class BlogPost(Base):
     content = Column(Text)
     is_visible = Column(Boolean)
     author_id = Column(Integer, ForeignKey('users.id'))
+    # Bumped on every change to the post or its comments, used as the HTTP validator of the post page
+    version = Column(Integer, default=1)
+    updated_at = Column(DateTime)
+    comment_count = Column(Integer, default=0)
+    like_count = Column(Integer, default=0)
+    # Sanitized HTML and plain text excerpt of the content, rendered once when the post is written
+    content_html = deferred(Column(Text))
+    excerpt = Column(Text)
 
     author = relationship("Admin", back_populates="blog_posts")
-    tags = relationship("Tag", back_populates="blog_post")
+    tags = relationship("Tag", back_populates="blog_post",
+                        cascade="all, delete-orphan")
     comments = relationship("Comment", back_populates="blog_post")
     likes = relationship("PostLike", back_populates="blog_post")
     external_references = relationship(
         "ExternalReference", back_populates="blog_post")
 
+    __table_args__ = (
+        # Serve the published and the full listings in (post_date, id) order without sorting
+        Index('ix_blog_posts_is_visible_post_date', 'is_visible', 'post_date', 'id'),
+        Index('ix_blog_posts_post_date', 'post_date', 'id'),
+    )
+
+
+class ContentStamp(Base):
+    '''
+    A model class that records when a set of content, such as the blog post listing, last changed.
+    Used as a cheap HTTP validator for pages that aggregate many rows.
+    '''
+
+    __tablename__ = 'content_stamps'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime)
+
+
+class IdSequence(Base):
+    '''
+    A model class that represents a named sequence of primary keys.
+    next_value is the first id that has not been handed out to any allocator yet.
+    '''
+
+    __tablename__ = 'id_sequences'
+
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
+
+
+class SchemaVersion(Base):
+    '''
+    A model class that records a schema migration applied to the database (see migrations.py).
+    '''
+
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+
+class ReputationWatermark(Base):
+    '''
+    A model class that records the id of the last comment or like counted by the reputation engine
+    (see reputation.py), so that each run only reads the events added since.
+    '''
+
+    __tablename__ = 'reputation_watermarks'
+
+    source = Column(String, primary_key=True)
+    last_id = Column(Integer, nullable=False)
+
+
+class ReputationSkip(Base):
+    '''
+    A model class that records a range of comment or like ids the reputation engine must not count,
+    e.g. the events inserted by a bulk import, whose users carry the reputation earned from them.
+    '''
+
+    __tablename__ = 'reputation_skips'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Finds the ranges overlapping a batch of events, and the ranges a run left behind
+        Index('ix_reputation_skips_source_last_id', 'source', 'last_id'),
+    )
+
+
+class CountedLike(Base):
+    '''
+    A model class that records a (post, user) pair whose like the reputation engine counted,
+    so that unliking and liking the post again does not earn its author reputation again.
+    '''
+
+    __tablename__ = 'reputation_counted_likes'
+
+    blog_post_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class ImportCheckpoint(Base):
+    '''
+    A model class that records how many records of a bulk import source have been committed,
+    so that an interrupted import can resume where it stopped.
+    '''
+
+    __tablename__ = 'import_checkpoints'
+
+    source = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False)
+
 
 class Comment(Base):
     '''
@@ -119,6 +234,12 @@ class Comment(Base):
     user = relationship("User", back_populates="comments")
     blog_post = relationship("BlogPost", back_populates="comments")
 
+    __table_args__ = (
+        # Serves the comments of a post in (comment_date, id) order for keyset pagination
+        Index('ix_comments_blog_post_id_comment_date',
+              'blog_post_id', 'comment_date', 'id'),
+    )
+
 
 class PostLike(Base):
     '''
@@ -134,6 +255,12 @@ class PostLike(Base):
     blog_post = relationship("BlogPost", back_populates="likes")
     user = relationship("User")
 
+    __table_args__ = (
+        # A user can like a post only once
+        Index('ix_post_likes_blog_post_id_user_id',
+              'blog_post_id', 'user_id', unique=True),
+    )
+
 
 class Tag(Base):
     '''
@@ -148,6 +275,30 @@ class Tag(Base):
 
     blog_post = relationship("BlogPost", back_populates="tags")
 
+    __table_args__ = (
+        # Covers "posts tagged X" lookups without touching the table
+        Index('ix_tags_tag_blog_post_id', 'tag', 'blog_post_id'),
+        # Loads the tags of a page of posts in (blog_post_id, id) order
+        Index('ix_tags_blog_post_id', 'blog_post_id'),
+    )
+
+
+class TagCount(Base):
+    '''
+    A model class that holds the number of published blog posts carrying a tag.
+    Maintained by the blog service on every post change, so the tag cloud never has to be aggregated on read.
+    '''
+
+    __tablename__ = 'tag_counts'
+
+    tag = Column(String, primary_key=True)
+    post_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Serves the most used tags first without sorting the table
+        Index('ix_tag_counts_post_count', post_count.desc(), 'tag'),
+    )
+
 
 class ExternalReference(Base):
     '''
@@ -164,6 +315,10 @@ class ExternalReference(Base):
 
     blog_post = relationship("BlogPost", back_populates="external_references")
 
+    __table_args__ = (
+        Index('ix_external_references_blog_post_id', 'blog_post_id'),
+    )
+
 
 class BadgeMaster(Base):
     '''
@@ -187,10 +342,16 @@ class UserBadge(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     badge_id = Column(Integer, ForeignKey('badge_master.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
+    awarded_at = Column(DateTime)
 
     badge = relationship("BadgeMaster")
     user = relationship("User", back_populates="badges")
 
+    __table_args__ = (
+        # A badge is awarded to a user only once
+        Index('ix_user_badges_user_id_badge_id', 'user_id', 'badge_id', unique=True),
+    )
+
 
 class UserSocialMedia(Base):
     '''
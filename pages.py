@@ -0,0 +1,267 @@
+import hashlib
+from datetime import timezone
+from urllib.parse import quote
+
+from flask import abort, make_response, render_template, request
+
+from cache import CachedPage, page_cache
+from compression import encoded_page_body, negotiate_encoding, variant_etag
+from config import Config
+from identity import get_current_identity
+
+# Viewer key of the visitors who are not logged in
+ANONYMOUS_VIEWER = ('anonymous', None)
+
+
+class PageLookup:
+    '''
+    A page requested through the page cache, with its validators. The response is already known when the
+    client has the page (a 304) or when it is cached, otherwise the page has to be rendered and stored.
+    Shared by the Flask routes and the asyncio views, which only differ in how they load the data of a page.
+    Pages of anonymous viewers that are found current are marked fresh under their scope (see fresh_page).
+    '''
+
+    def __init__(self, route, id, viewer, etag, last_modified, public=False, scope=None):
+        self.route = route
+        self.id = id
+        self.viewer = viewer
+        self.etag = etag
+        self.last_modified = last_modified
+        self.public = public
+        self.scope = scope
+        self.response = None
+
+    def store(self, body):
+        '''
+        Cache the rendered page and build its response.
+
+        Parameters
+        ----------
+        body: str,
+            The rendered page.
+
+        Returns
+        -------
+        Response
+            The page, or a 304 if the client has it.
+        '''
+
+        cached_page = CachedPage(body, self.etag, self.last_modified)
+        # Cached by entity tag, so a page is not served once another process changed its content
+        page_cache.put(self.route, self.id, self.viewer, cached_page, self.etag)
+        self.mark_fresh()
+        return page_response(cached_page, self.public)
+
+    def mark_fresh(self):
+        '''
+        Mark the cached page as current, if it is rendered for anonymous viewers.
+        '''
+
+        if self.viewer == ANONYMOUS_VIEWER and Config.PAGE_CACHE_FRESH_SECONDS > 0:
+            page_cache.mark_fresh(self.route, self.id, self.viewer, self.scope, self.etag)
+
+
+def lookup_page(route, id, viewer, etag, last_modified, public=False, scope=None):
+    '''
+    Look a page up by its entity tag, answering with a 304 when the client already has it
+    '''
+
+    lookup = PageLookup(route, id, viewer, etag, last_modified, public, scope)
+    if is_not_modified(etag, last_modified):
+        lookup.response = not_modified_response(etag, last_modified, public)
+    else:
+        cached_page = page_cache.get(route, id, viewer, etag)
+        if cached_page is not None:
+            lookup.mark_fresh()
+            lookup.response = page_response(cached_page, public)
+    return lookup
+
+
+def fresh_page(route, id, scope=None):
+    '''
+    Serve the page of an anonymous viewer from the page cache without reading its version, if it was rendered or
+    found current less than PAGE_CACHE_FRESH_SECONDS ago. Changes made by this process invalidate the page right
+    away, those made by other processes show up once that time is over.
+
+    Returns
+    -------
+    Response
+        The page, or a 304 if the client has it. None if the viewer is logged in or there is no fresh page.
+    '''
+
+    if Config.PAGE_CACHE_FRESH_SECONDS <= 0:
+        return None
+    viewer = viewer_key()
+    if viewer != ANONYMOUS_VIEWER:
+        return None
+    cached_page = page_cache.get_fresh(route, id, viewer, scope, Config.PAGE_CACHE_FRESH_SECONDS)
+    return page_response(cached_page) if cached_page is not None else None
+
+
+def fresh_post_page(id):
+    '''
+    Serve the fresh page of a blog post to an anonymous viewer, see fresh_page
+    '''
+
+    return fresh_page('post', id)
+
+
+def fresh_listing_page(route, tag=None):
+    '''
+    Serve the fresh page of the blog post listing to an anonymous viewer, see fresh_page
+    '''
+
+    return fresh_page(route, None, listing_scope(tag))
+
+
+def listing_scope(tag):
+    '''
+    Get what a page of the blog post listing depends on besides its version and viewer
+    '''
+
+    return (tag, request.args.get('after'))
+
+
+def lookup_post_page(id, stamp, is_admin):
+    '''
+    Look the page of a blog post up, given its stamp (see BlogService.fetch_post_stamp)
+    '''
+
+    check_post_visible(stamp, is_admin)
+    viewer = viewer_key()
+    # Writing likes bumps the post version, see likes.LikeAggregator
+    etag = make_etag('post', id, stamp.version, viewer)
+    return lookup_page('post', id, viewer, etag, stamp.updated_at)
+
+
+def lookup_listing_page(route, stamp, tag=None):
+    '''
+    Look a page of the blog post listing up, given the listing stamp (see BlogService.fetch_listing_stamp)
+    '''
+
+    viewer = viewer_key()
+    version = stamp.version if stamp is not None else 0
+    last_modified = stamp.updated_at if stamp is not None else None
+    scope = listing_scope(tag)
+    etag = make_etag(route, version, viewer, scope)
+    return lookup_page(route, None, viewer, etag, last_modified, scope=scope)
+
+
+def check_post_visible(post, is_admin):
+    '''
+    Answer with a 404 unless the blog post, or its stamp, exists and is visible to the viewer
+    '''
+
+    if post is None or (not post.is_visible and not is_admin):
+        abort(404, description="Post not found")
+
+
+def render_post_page(post, comments, like_count, liked):
+    '''
+    Render the page of a blog post with its first page of comments
+    '''
+
+    message = None if post.is_visible else "This post is only visible to admins."
+    return render_template('viewpost.html', post=post, comments=comments, like_count=like_count,
+                           liked=liked, warning_message=message)
+
+
+def render_listing_page(page, tag=None, tag_counts=()):
+    '''
+    Render a page of the blog post listing, optionally limited to a tag
+    '''
+
+    page_url = '/index/' if tag is None else '/tags/{}/'.format(quote(tag, safe=''))
+    return render_template('index.html', posts=page.posts, next_cursor=page.next_cursor,
+                           is_first_page=request.args.get('after') is None, tag=tag, tag_counts=tag_counts,
+                           page_url=page_url)
+
+
+def make_etag(*parts):
+    '''
+    Build a strong entity tag from the values a page depends on
+    '''
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def http_date(value):
+    '''
+    Convert a local, naive timestamp from the database to an aware UTC datetime with whole seconds,
+    as used in Last-Modified and If-Modified-Since headers
+    '''
+
+    if value is None:
+        return None
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def is_not_modified(etag, last_modified):
+    '''
+    Check whether the conditional request headers show that the client already has the page.
+    If-None-Match takes precedence over If-Modified-Since.
+    '''
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(variant_etag(etag, negotiate_encoding()))
+    if request.if_modified_since and last_modified is not None:
+        since = request.if_modified_since
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return http_date(last_modified) <= since
+    return False
+
+
+def set_validators(response, etag, last_modified, public=False):
+    '''
+    Add the validator and caching headers of a page to the response.
+    Pages depend on the session, so shared caches must key them by cookie and revalidate each time,
+    unless the page is public, i.e. the same for every viewer.
+    Each content encoding of a page has its own entity tag.
+    '''
+
+    response.set_etag(variant_etag(etag, negotiate_encoding()))
+    if last_modified is not None:
+        response.last_modified = http_date(last_modified)
+    if public:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Cookie')
+    return response
+
+
+def not_modified_response(etag, last_modified, public=False):
+    '''
+    Build an empty 304 response for a page the client already has
+    '''
+
+    return set_validators(make_response('', 304), etag, last_modified, public)
+
+
+def page_response(cached_page, public=False):
+    '''
+    Build the response for a rendered page, answering conditional requests with 304
+    '''
+
+    if is_not_modified(cached_page.etag, cached_page.last_modified):
+        return not_modified_response(cached_page.etag, cached_page.last_modified, public)
+    body, encoding = encoded_page_body(cached_page, negotiate_encoding())
+    response = make_response(body)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    return set_validators(response, cached_page.etag, cached_page.last_modified, public)
+
+
+def viewer_key():
+    '''
+    Get the key that identifies the class of viewer a page is rendered for, for the page cache.
+    Anonymous viewers share one key. Pages rendered for logged in users and admins greet the user
+    by name, so their key also carries the user id.
+    '''
+
+    user_meta = get_current_identity()
+    if user_meta is None:
+        return ANONYMOUS_VIEWER
+    viewer_class = 'admin' if user_meta.type == 'admin' else 'user'
+    return (viewer_class, user_meta.id)
@@ -0,0 +1,136 @@
+import functools
+import inspect
+import logging
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from config import Config
+from metrics import redact_statement
+
+logger = logging.getLogger(__name__)
+
+# "off" skips the checks, "log" logs budget violations as errors, "raise" raises QueryBudgetExceeded
+QUERY_BUDGET_MODES = ('off', 'log', 'raise')
+
+# Statements of the budgets entered by the current thread or asyncio task, innermost last
+_active_scopes = ContextVar('active_query_budgets', default=())
+
+
+class QueryBudgetExceeded(Exception):
+    '''
+    Raised in "raise" mode when a block of code runs more SQL statements than its budget,
+    or runs the same statement more times than the budget allows (an N+1 query pattern).
+    '''
+
+
+class _BudgetScope:
+    '''
+    The statements run during one entry of a query budget, counted by shape (the statement with its
+    literals replaced, see metrics.redact_statement).
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.shapes = Counter()
+
+    def record(self, statement):
+        '''
+        Count a statement.
+        '''
+
+        self.queries += 1
+        self.shapes[redact_statement(statement)] += 1
+
+
+class QueryBudget:
+    '''
+    Limits the number of SQL statements a route or service method may run, as a decorator or context manager:
+
+        @app.route('/index/')
+        @QueryBudget(4)
+        def index(): ...
+
+        with QueryBudget(2, name='comment form'):
+            ...
+
+    Every statement run by the thread or asyncio task while the budget is entered counts, including the
+    statements of nested budgets. The budget is exceeded when more than max_queries statements run, or when
+    a statement of the same shape runs more than max_repeats times, which is how a lazy relationship loaded
+    once per row of a page shows up. Statements run after the block returns, such as those of a streamed
+    response, are not counted.
+    Violations are handled as set by QUERY_BUDGET_MODE (see QUERY_BUDGET_MODES); statements are only
+    counted once instrument_query_budgets has been called for the engine, which the application only does when
+    the mode is not "off".
+
+    Parameters
+    ----------
+    max_queries: int,
+        Maximum number of statements.
+    max_repeats: int,
+        Maximum number of statements of the same shape, defaults to QUERY_BUDGET_MAX_REPEATS.
+    name: str,
+        Name of the budget in reports, defaults to the name of the decorated function.
+    '''
+
+    def __init__(self, max_queries, max_repeats=None, name=None):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats if max_repeats is not None else Config.QUERY_BUDGET_MAX_REPEATS
+        self.name = name
+
+    def __call__(self, function):
+        if self.name is None:
+            self.name = function.__qualname__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with self:
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self:
+                return function(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        _active_scopes.set(_active_scopes.get() + (_BudgetScope(),))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        scopes = _active_scopes.get()
+        _active_scopes.set(scopes[:-1])
+        if exc_type is None and Config.QUERY_BUDGET_MODE != 'off':
+            self.check(scopes[-1])
+        return False
+
+    def check(self, scope):
+        '''
+        Report the violations of the budget by the statements of a scope, as set by QUERY_BUDGET_MODE.
+        '''
+
+        violations = []
+        if scope.queries > self.max_queries:
+            violations.append("{} statements, budget is {}".format(scope.queries, self.max_queries))
+        violations += ["N+1 pattern, {} runs of: {}".format(count, shape)
+                       for shape, count in scope.shapes.most_common() if count > self.max_repeats]
+        if not violations:
+            return
+        message = "Query budget of {} exceeded: {}".format(self.name or 'block', "; ".join(violations))
+        if Config.QUERY_BUDGET_MODE == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.error(message)
+
+
+def instrument_query_budgets(engine):
+    '''
+    Count the statements run by an engine against the query budgets entered by the running thread or task.
+    '''
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        for scope in _active_scopes.get():
+            scope.record(statement)
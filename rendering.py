@@ -0,0 +1,140 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+
+# Maximum number of characters of a post excerpt, not counting the trailing ellipsis
+EXCERPT_LENGTH = 200
+
+# Tags kept in rendered content, with the attributes each one may carry. Any other tag is dropped,
+# keeping its text, and the text of SKIPPED_TAGS is dropped along with the tag.
+ALLOWED_TAGS = {
+    'a': ('href', 'title'),
+    'b': (), 'blockquote': (), 'br': (), 'code': (), 'em': (), 'h1': (), 'h2': (), 'h3': (), 'h4': (),
+    'h5': (), 'h6': (), 'hr': (), 'i': (), 'li': (), 'ol': (), 'p': (), 'pre': (), 's': (),
+    'strong': (), 'sub': (), 'sup': (), 'u': (), 'ul': (),
+}
+VOID_TAGS = ('br', 'hr')
+# Tags that separate words in the plain text
+BLOCK_TAGS = ('blockquote', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'ul')
+SKIPPED_TAGS = ('script', 'style', 'iframe', 'object', 'embed', 'template')
+ALLOWED_URL_SCHEMES = ('http', 'https', 'mailto')
+
+
+class _ContentParser(HTMLParser):
+    '''
+    Walks post content once, building the sanitized HTML and the plain text at the same time.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.html = []
+        self.text = []
+        self.open_tags = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+            return
+        if self.skipping or tag not in ALLOWED_TAGS:
+            return
+        kept = ''.join(' {}="{}"'.format(name, escape(value))
+                       for name, value in attrs
+                       if name in ALLOWED_TAGS[tag] and value is not None and _is_safe_value(name, value))
+        self.html.append('<{}{}>'.format(tag, kept))
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+            return
+        if self.skipping or tag not in self.open_tags:
+            return
+        # Close the tags left open inside this one, so the output is always well nested
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.html.append('</{}>'.format(open_tag))
+            if open_tag == tag:
+                break
+        if tag in BLOCK_TAGS:
+            self.text.append(' ')
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        self.html.append(escape(data, quote=False))
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.html.append('</{}>'.format(self.open_tags.pop()))
+
+
+def _is_safe_value(name, value):
+    '''
+    Check that a link does not use a scheme that can run scripts, such as javascript:
+    '''
+
+    if name != 'href':
+        return True
+    # Browsers ignore control characters and whitespace in URLs, e.g. "java\tscript:"
+    scheme = re.match(r'([a-zA-Z][a-zA-Z0-9+.-]*):', re.sub(r'[\x00-\x20\x7f]', '', value))
+    return scheme is None or scheme.group(1).lower() in ALLOWED_URL_SCHEMES
+
+
+def render_content(content):
+    '''
+    Render the content of a blog post for display and listing.
+
+    Parameters
+    ----------
+    content: str,
+        The content as written by the author, text with optional HTML markup.
+
+    Returns
+    -------
+    tuple
+        The sanitized HTML, keeping only ALLOWED_TAGS and safe attributes, and a plain text excerpt
+        of at most EXCERPT_LENGTH characters, cut at a word boundary.
+    '''
+
+    parser = _parse(content)
+    return ''.join(parser.html), make_excerpt(''.join(parser.text))
+
+
+def render_text(content):
+    '''
+    Get the plain text of the content of a blog post, as read on the rendered page: without markup,
+    attributes or the text of SKIPPED_TAGS, and with its whitespace collapsed. Used for the search index.
+    '''
+
+    return ' '.join(''.join(_parse(content).text).split())
+
+
+def _parse(content):
+    '''
+    Run the content parser over the content of a blog post
+    '''
+
+    parser = _ContentParser()
+    parser.feed(content or '')
+    parser.close()
+    return parser
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    '''
+    Collapse the whitespace of a plain text and shorten it to a word boundary, ending with an ellipsis if cut.
+    '''
+
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text[:length]
+    if ' ' in cut and not text[length].isspace():
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip() + '…'
@@ -0,0 +1,256 @@
+import bisect
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, select, text
+
+from database import engine
+from models import (BadgeMaster, BlogPost, Comment, CountedLike, PostLike, ReputationSkip, ReputationWatermark,
+                    User, UserBadge)
+
+logger = logging.getLogger(__name__)
+
+REPUTATION_BATCH_SIZE = 10000
+# Reputation earned by the author of a comment, and by the author of a post for each like of another user
+COMMENT_POINTS = 2
+LIKE_POINTS = 5
+# Badges awarded once a user's reputation reaches a threshold, as (badge name, threshold)
+BADGE_RULES = (('Contributor', 10), ('Regular', 100), ('Expert', 1000))
+# Users whose badges are checked per statement, well below the bound parameter limit of SQLite
+_USERS_PER_STATEMENT = 500
+
+
+class ReputationEngine:
+    '''
+    Computes user reputation and badges offline, from the comments and likes added since its previous run,
+    so that writing a comment or a like never has to update the users involved.
+    Comments and likes are read in batches of batch_size rows after the last id counted from each table
+    (the watermarks in reputation_watermarks), and the reputation changes are summed per user in memory.
+    They are then applied with one bulk UPDATE, badges whose threshold the new scores reach are awarded to the
+    users that changed, and the watermarks are advanced, all in one transaction. The cost of a run depends on
+    the number of new events and of users involved, not on the history.
+
+    Events are counted once: deleting a comment or unliking a post later does not take reputation back, and
+    only the first like of a user is credited to the post author (reputation_counted_likes), however often they
+    unlike and like it again. Events in the id ranges of reputation_skips, e.g. bulk imported ones, are not
+    counted. Two runs at the same time cannot count the same events, the second one fails when saving its
+    watermarks.
+    '''
+
+    def __init__(self, batch_size=REPUTATION_BATCH_SIZE, comment_points=COMMENT_POINTS, like_points=LIKE_POINTS,
+                 badge_rules=BADGE_RULES):
+        self.batch_size = batch_size
+        self.comment_points = comment_points
+        self.like_points = like_points
+        self.badge_rules = badge_rules
+
+    def run(self):
+        '''
+        Count the comments and likes added since the previous run.
+
+        Returns
+        -------
+        dict
+            Number of comments and likes counted, users whose reputation changed and badges awarded.
+        '''
+
+        with engine.begin() as connection:
+            deltas = {}
+            comments, last_comment_id = self._aggregate(
+                connection, 'comments', self._comment_batch, deltas)
+            likes, last_like_id = self._aggregate(
+                connection, 'likes', self._like_batch, deltas)
+
+            if deltas:
+                connection.execute(text(
+                    "UPDATE users SET reputation_score = coalesce(reputation_score, 0) + :delta WHERE id = :id"),
+                    [{'id': user_id, 'delta': delta} for user_id, delta in deltas.items()])
+            badges = self._award_badges(connection, sorted(deltas))
+            self._save_watermark(connection, 'comments', last_comment_id)
+            self._save_watermark(connection, 'likes', last_like_id)
+            self._prune_skips(connection, 'comments', last_comment_id[1])
+            self._prune_skips(connection, 'likes', last_like_id[1])
+
+        logger.info("Counted %d comments and %d likes: reputation of %d users changed, %d badges awarded",
+                    comments, likes, len(deltas), badges)
+        return {'comments': comments, 'likes': likes, 'users': len(deltas), 'badges': badges}
+
+    def skip(self, connection, source, ids):
+        '''
+        Record events that must not be counted, e.g. the comments or likes inserted by a bulk import of users that
+        carry the reputation earned from them. Runs in the transaction that inserts the events, so a run either
+        sees both or neither.
+
+        Parameters
+        ----------
+        connection: Connection,
+            Database connection of the transaction.
+        source: str,
+            "comments" or "likes".
+        ids: list,
+            Ids of the events.
+        '''
+
+        ranges = []
+        for id in sorted(ids):
+            if ranges and ranges[-1]['last_id'] == id - 1:
+                ranges[-1]['last_id'] = id
+            else:
+                ranges.append({'source': source, 'first_id': id, 'last_id': id})
+        if ranges:
+            connection.execute(ReputationSkip.__table__.insert(), ranges)
+
+    def _aggregate(self, connection, source, read_batch, deltas):
+        '''
+        Private method that adds the reputation changes of the events of a source after its watermark to deltas.
+        read_batch(connection, after_id) returns the next rows of (event id, user id, points).
+        Returns the number of events and the (old watermark, new watermark) of the source.
+        '''
+
+        start = self._watermark(connection, source)
+        last_id = start if start is not None else 0
+        events = 0
+        while True:
+            rows = read_batch(connection, last_id)
+            # Read after the events, so the ranges of every import whose events were read are seen
+            skipped = self._skipped(connection, source, rows)
+            for id, user_id, points in rows:
+                if skipped(id):
+                    continue
+                if user_id is not None and points:
+                    deltas[user_id] = deltas.get(user_id, 0) + points
+                events += 1
+            if len(rows) < self.batch_size:
+                return events, (start, rows[-1][0] if rows else last_id)
+            last_id = rows[-1][0]
+
+    def _comment_batch(self, connection, after_id):
+        '''
+        Private method that reads the next comments, credited to their author.
+        '''
+
+        rows = connection.execute(select([Comment.id, Comment.user_id]).where(Comment.id > after_id)
+                                  .order_by(Comment.id).limit(self.batch_size)).fetchall()
+        return [(id, user_id, self.comment_points) for id, user_id in rows]
+
+    def _like_batch(self, connection, after_id):
+        '''
+        Private method that reads the next likes, credited to the author of the liked post unless they liked it
+        or a like of the same user was counted before. The (post, user) pairs read are recorded as counted.
+        '''
+
+        counted = CountedLike.__table__
+        rows = connection.execute(select([PostLike.id, BlogPost.author_id, PostLike.user_id, PostLike.blog_post_id,
+                                          counted.c.user_id])
+                                  .select_from(PostLike.__table__
+                                               .join(BlogPost.__table__, BlogPost.id == PostLike.blog_post_id)
+                                               .outerjoin(counted, and_(counted.c.blog_post_id == PostLike.blog_post_id,
+                                                                        counted.c.user_id == PostLike.user_id)))
+                                  .where(PostLike.id > after_id)
+                                  .order_by(PostLike.id).limit(self.batch_size)).fetchall()
+        batch = []
+        pairs = set()
+        for id, author_id, user_id, blog_post_id, counted_user_id in rows:
+            first = user_id is not None and counted_user_id is None and (blog_post_id, user_id) not in pairs
+            if first:
+                pairs.add((blog_post_id, user_id))
+            batch.append((id, author_id, self.like_points if first and author_id != user_id else 0))
+        if pairs:
+            connection.execute(counted.insert(), [{'blog_post_id': blog_post_id, 'user_id': user_id}
+                                                  for blog_post_id, user_id in pairs])
+        return batch
+
+    def _skipped(self, connection, source, rows):
+        '''
+        Private method that reads the skipped id ranges overlapping a batch of events.
+        Returns a function telling whether an event id is skipped.
+        '''
+
+        if not rows:
+            return lambda id: False
+        ranges = connection.execute(select([ReputationSkip.first_id, ReputationSkip.last_id])
+                                    .where(and_(ReputationSkip.source == source,
+                                                ReputationSkip.last_id >= rows[0][0],
+                                                ReputationSkip.first_id <= rows[-1][0]))
+                                    .order_by(ReputationSkip.first_id)).fetchall()
+        # The ranges do not overlap, since each id is inserted once
+        first_ids = [first_id for first_id, _ in ranges]
+
+        def skipped(id):
+            position = bisect.bisect_right(first_ids, id) - 1
+            return position >= 0 and id <= ranges[position][1]
+        return skipped
+
+    def _prune_skips(self, connection, source, last_id):
+        '''
+        Private method that deletes the skipped id ranges a run has passed.
+        '''
+
+        if last_id:
+            connection.execute(ReputationSkip.__table__.delete().where(
+                and_(ReputationSkip.source == source, ReputationSkip.last_id <= last_id)))
+
+    def _award_badges(self, connection, user_ids):
+        '''
+        Private method that awards the badges of the rules whose threshold the given users reached,
+        unless they already have them. Returns the number of badges awarded.
+        '''
+
+        if not user_ids or not self.badge_rules:
+            return 0
+        badge_ids = self._badge_ids(connection)
+        now = datetime.now()
+        awarded = 0
+        for start in range(0, len(user_ids), _USERS_PER_STATEMENT):
+            chunk = user_ids[start:start + _USERS_PER_STATEMENT]
+            scores = connection.execute(select([User.id, User.reputation_score])
+                                        .where(User.id.in_(chunk))).fetchall()
+            owned = set(connection.execute(select([UserBadge.user_id, UserBadge.badge_id])
+                                           .where(UserBadge.user_id.in_(chunk))).fetchall())
+            rows = [{'user_id': user_id, 'badge_id': badge_ids[badge], 'awarded_at': now}
+                    for user_id, score in scores for badge, threshold in self.badge_rules
+                    if (score or 0) >= threshold and (user_id, badge_ids[badge]) not in owned]
+            if rows:
+                connection.execute(UserBadge.__table__.insert(), rows)
+                awarded += len(rows)
+        return awarded
+
+    def _badge_ids(self, connection):
+        '''
+        Private method that gets the ids of the badges of the rules by name, adding the missing badges.
+        '''
+
+        names = [badge for badge, _ in self.badge_rules]
+        badge_ids = dict((badge, id) for id, badge in connection.execute(
+            select([BadgeMaster.id, BadgeMaster.badge]).where(BadgeMaster.badge.in_(names))))
+        missing = [{'badge': badge} for badge in names if badge not in badge_ids]
+        if missing:
+            connection.execute(BadgeMaster.__table__.insert(), missing)
+            return self._badge_ids(connection)
+        return badge_ids
+
+    def _watermark(self, connection, source):
+        '''
+        Private method that reads the watermark of a source, None before the first run.
+        '''
+
+        return connection.execute(select([ReputationWatermark.last_id])
+                                  .where(ReputationWatermark.source == source)).scalar()
+
+    def _save_watermark(self, connection, source, watermark):
+        '''
+        Private method that advances the watermark of a source from its old to its new value.
+        '''
+
+        old, new = watermark
+        if old is None:
+            connection.execute(ReputationWatermark.__table__.insert().values(source=source, last_id=new))
+        elif new != old:
+            table = ReputationWatermark.__table__
+            updated = connection.execute(table.update().where(and_(table.c.source == source, table.c.last_id == old))
+                                         .values(last_id=new)).rowcount
+            if updated != 1:
+                raise RuntimeError("The {} watermark was moved by another reputation run".format(source))
+
+
+reputation_engine = ReputationEngine()
@@ -0,0 +1,379 @@
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import (BigInteger, Column, Integer, MetaData, String, Table,
+                        Text, and_, func, literal, null, or_, select, text)
+
+from database import engine
+from models import BlogPost, Comment
+from rendering import render_text
+
+SEARCH_RESULTS_PER_PAGE = 20
+# Blog posts read at a time while rebuilding the index
+REBUILD_BATCH_SIZE = 500
+
+# Markers placed around matched terms by the database, replaced by <mark> once the text is escaped
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+
+class SearchResult:
+    '''
+    A blog post or comment matching a search query, with the matched terms highlighted
+    '''
+
+    def __init__(self, kind, blog_post_id, comment_id, title, snippet):
+        self.kind = kind
+        self.blog_post_id = blog_post_id
+        self.comment_id = comment_id
+        self.title = title
+        self.snippet = snippet
+
+
+class SearchPage:
+    '''
+    A page of search results
+    '''
+
+    def __init__(self, results, page, has_next):
+        self.results = results
+        self.page = page
+        self.has_next = has_next
+
+
+class SearchIndex:
+    '''
+    Base class of the full text index over blog post titles, post content and comment text.
+    Every post and comment is one document of the index. Documents are addressed by a numeric key
+    derived from the id of the row (even keys for posts, odd keys for comments) so that they can be
+    replaced or removed through the primary key of the index. Posts are indexed by the plain text of their
+    content, so markup and attributes such as links are neither found nor ranked.
+    Writes take the connection of the caller, so the index is updated in the same transaction as the rows.
+    Subclasses implement the storage and search for a given database backend.
+    '''
+
+    def create_schema(self, connection):
+        '''
+        Create the index if it does not exist.
+        '''
+
+        pass
+
+    def index_post(self, connection, blog_post):
+        '''
+        Add or replace the document of a blog post.
+        '''
+
+        self._delete_documents(connection, [self.post_key(blog_post.id)])
+        self._insert_documents(connection, [self._post_document(
+            blog_post.id, blog_post.title, blog_post.content)])
+
+    def index_comment(self, connection, comment):
+        '''
+        Add or replace the document of a comment.
+        '''
+
+        self._delete_documents(connection, [self.comment_key(comment.id)])
+        self._insert_documents(connection, [{'key': self.comment_key(comment.id), 'kind': 'comment',
+                                             'ref_id': comment.id, 'blog_post_id': comment.blog_post_id,
+                                             'title': None, 'body': comment.content}])
+
+    def remove_post(self, connection, blog_post_id, comment_ids):
+        '''
+        Remove the documents of a blog post and of its comments.
+        '''
+
+        keys = [self.post_key(blog_post_id)] + \
+            [self.comment_key(id) for id in comment_ids]
+        self._delete_documents(connection, keys)
+
+    def rebuild(self, connection):
+        '''
+        Drop all documents and index every blog post and comment again. Posts are read and indexed in batches
+        of REBUILD_BATCH_SIZE, since their plain text is extracted in Python, comments with set based statements.
+        '''
+
+        pass
+
+    def search(self, connection, query, page=1, include_hidden=False, page_size=SEARCH_RESULTS_PER_PAGE):
+        '''
+        Search the index, best matches first.
+
+        Parameters
+        ----------
+        connection: Connection,
+            Database connection.
+        query: str,
+            Search terms, all of which must match.
+        page: int,
+            Page number, starting from 1.
+        include_hidden: Boolean,
+            If True, unpublished posts and their comments will be included.
+        page_size: int,
+            Maximum number of results in the page.
+
+        Returns
+        -------
+        SearchPage
+            The matching posts and comments.
+        '''
+
+        terms = re.findall(r'\w+', query or '')
+        if not terms:
+            return SearchPage([], page, False)
+
+        rows = self._search_rows(connection, terms, include_hidden, page_size + 1, (page - 1) * page_size)
+        results = [SearchResult(row.kind, row.blog_post_id, row.ref_id if row.kind == 'comment' else None,
+                                _highlight(row.title), _highlight(row.snippet))
+                   for row in rows[:page_size]]
+        return SearchPage(results, page, len(rows) > page_size)
+
+    def post_key(self, blog_post_id):
+        return blog_post_id * 2
+
+    def comment_key(self, comment_id):
+        return comment_id * 2 + 1
+
+    def _post_document(self, blog_post_id, title, content):
+        return {'key': self.post_key(blog_post_id), 'kind': 'post', 'ref_id': blog_post_id,
+                'blog_post_id': blog_post_id, 'title': title, 'body': render_text(content)}
+
+    def _index_all_posts(self, connection, batch_size=REBUILD_BATCH_SIZE):
+        '''
+        Private method that indexes every blog post, reading them in batches in id order.
+        '''
+
+        last_id = 0
+        while True:
+            rows = connection.execute(text(
+                "SELECT id, title, content FROM blog_posts WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                last_id=last_id, limit=batch_size).fetchall()
+            if not rows:
+                return
+            self._insert_documents(connection, [self._post_document(id, title, content)
+                                                for id, title, content in rows])
+            last_id = rows[-1].id
+
+    def _insert_documents(self, connection, documents):
+        pass
+
+    def _delete_documents(self, connection, keys):
+        pass
+
+    def _search_rows(self, connection, terms, include_hidden, limit, offset):
+        '''
+        Private method that reads a page of matching documents as rows of kind, ref_id, blog_post_id, title and
+        snippet, with the matched terms between the match markers.
+        '''
+
+        return connection.execute(text(self._search_sql(include_hidden)),
+                                  self._search_params(terms, limit, offset)).fetchall()
+
+
+class SqliteSearchIndex(SearchIndex):
+    '''
+    Full text index stored in an SQLite FTS5 virtual table, ranked with BM25.
+    Title matches weigh ten times as much as body matches.
+    '''
+
+    def create_schema(self, connection):
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "title, body, kind UNINDEXED, ref_id UNINDEXED, blog_post_id UNINDEXED, "
+            "tokenize = 'porter unicode61')"))
+
+    def rebuild(self, connection):
+        connection.execute(text("DELETE FROM search_index"))
+        self._index_all_posts(connection)
+        connection.execute(text(
+            "INSERT INTO search_index (rowid, title, body, kind, ref_id, blog_post_id) "
+            "SELECT id * 2 + 1, NULL, content, 'comment', id, blog_post_id FROM comments"))
+        connection.execute(text(
+            "INSERT INTO search_index (search_index) VALUES ('optimize')"))
+
+    def _insert_documents(self, connection, documents):
+        connection.execute(text(
+            "INSERT INTO search_index (rowid, title, body, kind, ref_id, blog_post_id) "
+            "VALUES (:key, :title, :body, :kind, :ref_id, :blog_post_id)"), documents)
+
+    def _delete_documents(self, connection, keys):
+        connection.execute(text("DELETE FROM search_index WHERE rowid = :key"),
+                           [{'key': key} for key in keys])
+
+    def _search_sql(self, include_hidden):
+        return ("SELECT s.kind, s.ref_id, s.blog_post_id, "
+                "coalesce(highlight(search_index, 0, :start, :end), p.title) AS title, "
+                "snippet(search_index, 1, :start, :end, '...', 24) AS snippet "
+                "FROM search_index s JOIN blog_posts p ON p.id = s.blog_post_id "
+                "WHERE search_index MATCH :match" +
+                ("" if include_hidden else " AND p.is_visible = 1") +
+                " ORDER BY bm25(search_index, 10.0, 1.0) LIMIT :limit OFFSET :offset")
+
+    def _search_params(self, terms, limit, offset):
+        return {'match': ' '.join('"{}"'.format(term) for term in terms), 'start': _MATCH_START,
+                'end': _MATCH_END, 'limit': limit, 'offset': offset}
+
+
+class PostgresSearchIndex(SearchIndex):
+    '''
+    Full text index stored in a PostgreSQL table with a GIN indexed tsvector column, ranked with ts_rank_cd.
+    Titles are weighted above bodies.
+    '''
+
+    _DOCUMENT = ("setweight(to_tsvector('english', coalesce({title}, '')), 'A') || "
+                 "setweight(to_tsvector('english', coalesce({body}, '')), 'B')")
+
+    def create_schema(self, connection):
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS search_index (key BIGINT PRIMARY KEY, kind VARCHAR(10) NOT NULL, "
+            "ref_id INTEGER NOT NULL, blog_post_id INTEGER NOT NULL, title TEXT, body TEXT, "
+            "document TSVECTOR NOT NULL)"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_index_document ON search_index USING GIN (document)"))
+
+    def rebuild(self, connection):
+        connection.execute(text("TRUNCATE search_index"))
+        self._index_all_posts(connection)
+        connection.execute(text(
+            "INSERT INTO search_index (key, kind, ref_id, blog_post_id, title, body, document) "
+            "SELECT id * 2 + 1, 'comment', id, blog_post_id, NULL, content, " +
+            self._DOCUMENT.format(title='NULL', body='content') + " FROM comments"))
+
+    def _insert_documents(self, connection, documents):
+        connection.execute(text(
+            "INSERT INTO search_index (key, kind, ref_id, blog_post_id, title, body, document) "
+            "VALUES (:key, :kind, :ref_id, :blog_post_id, :title, :body, " +
+            self._DOCUMENT.format(title='CAST(:title AS TEXT)', body='CAST(:body AS TEXT)') + ")"), documents)
+
+    def _delete_documents(self, connection, keys):
+        connection.execute(text("DELETE FROM search_index WHERE key = :key"),
+                           [{'key': key} for key in keys])
+
+    def _search_sql(self, include_hidden):
+        options = "StartSel=" + _MATCH_START + ", StopSel=" + _MATCH_END + ", MaxFragments=1, MaxWords=24"
+        return ("SELECT s.kind, s.ref_id, s.blog_post_id, "
+                "ts_headline('english', coalesce(s.title, p.title), q, '" + options + "') AS title, "
+                "ts_headline('english', coalesce(s.body, ''), q, '" + options + "') AS snippet "
+                "FROM search_index s JOIN blog_posts p ON p.id = s.blog_post_id, "
+                "plainto_tsquery('english', :match) q "
+                "WHERE s.document @@ q" +
+                ("" if include_hidden else " AND p.is_visible") +
+                " ORDER BY ts_rank_cd(s.document, q) DESC, s.key LIMIT :limit OFFSET :offset")
+
+    def _search_params(self, terms, limit, offset):
+        return {'match': ' '.join(terms), 'limit': limit, 'offset': offset}
+
+
+class LikeSearchIndex(SearchIndex):
+    '''
+    Index stored in a plain table, for backends without full text support, e.g. MySQL. Documents match when
+    their title or body contains every search term, newest first, without ranking or stemming, and every
+    search reads the whole table.
+    '''
+
+    _documents = Table('search_documents', MetaData(),
+                       Column('key', BigInteger, primary_key=True, autoincrement=False),
+                       Column('kind', String(10), nullable=False),
+                       Column('ref_id', Integer, nullable=False),
+                       Column('blog_post_id', Integer, nullable=False),
+                       Column('title', Text),
+                       Column('body', Text))
+
+    def create_schema(self, connection):
+        self._documents.create(connection, checkfirst=True)
+
+    def rebuild(self, connection):
+        connection.execute(self._documents.delete())
+        self._index_all_posts(connection)
+        connection.execute(self._documents.insert().from_select(
+            ['key', 'kind', 'ref_id', 'blog_post_id', 'title', 'body'],
+            select([Comment.id * 2 + 1, literal('comment'), Comment.id, Comment.blog_post_id, null(),
+                    Comment.content])))
+
+    def _insert_documents(self, connection, documents):
+        connection.execute(self._documents.insert(), documents)
+
+    def _delete_documents(self, connection, keys):
+        connection.execute(self._documents.delete().where(self._documents.c.key.in_(list(keys))))
+
+    def _search_rows(self, connection, terms, include_hidden, limit, offset):
+        documents = self._documents
+        posts = BlogPost.__table__
+        query = select([documents.c.kind, documents.c.ref_id, documents.c.blog_post_id,
+                        func.coalesce(documents.c.title, posts.c.title).label('title'), documents.c.body]) \
+            .select_from(documents.join(posts, posts.c.id == documents.c.blog_post_id)) \
+            .where(and_(*[or_(func.lower(documents.c.title).contains(term.lower(), autoescape=True),
+                              func.lower(documents.c.body).contains(term.lower(), autoescape=True))
+                          for term in terms]))
+        if not include_hidden:
+            query = query.where(posts.c.is_visible == True)
+        rows = connection.execute(query.order_by(documents.c.key.desc()).limit(limit).offset(offset)).fetchall()
+        return [_LikeSearchRow(row.kind, row.ref_id, row.blog_post_id, _mark_terms(row.title, terms),
+                               _mark_terms(_snippet(row.body, terms), terms))
+                for row in rows]
+
+
+class _LikeSearchRow:
+    '''
+    A matching document of LikeSearchIndex, with the columns of the full text search rows
+    '''
+
+    def __init__(self, kind, ref_id, blog_post_id, title, snippet):
+        self.kind = kind
+        self.ref_id = ref_id
+        self.blog_post_id = blog_post_id
+        self.title = title
+        self.snippet = snippet
+
+
+def _snippet(value, terms, words=24):
+    '''
+    Cut the words around the first matched term out of a text, as the snippets of the full text indexes
+    '''
+
+    if not value:
+        return value
+    parts = value.split()
+    lowered = [term.lower() for term in terms]
+    first = next((position for position, part in enumerate(parts)
+                  if any(term in part.lower() for term in lowered)), 0)
+    start = max(0, min(first - words // 2, len(parts) - words))
+    snippet = ' '.join(parts[start:start + words])
+    return ('...' if start > 0 else '') + snippet + ('...' if start + words < len(parts) else '')
+
+
+def _mark_terms(value, terms):
+    '''
+    Put the match markers around the search terms in a text, ignoring case
+    '''
+
+    if not value:
+        return value
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    return pattern.sub(lambda match: _MATCH_START + match.group(0) + _MATCH_END, value)
+
+
+def _highlight(value):
+    '''
+    Escape text from the index and turn the match markers into <mark> tags
+    '''
+
+    if value is None:
+        return None
+    return Markup(str(escape(value)).replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>'))
+
+
+def create_search_index(dialect_name):
+    '''
+    Create the search index implementation for a database backend.
+    Backends other than SQLite and PostgreSQL get a plain table searched with LIKE.
+    '''
+
+    if dialect_name == 'sqlite':
+        return SqliteSearchIndex()
+    if dialect_name == 'postgresql':
+        return PostgresSearchIndex()
+    return LikeSearchIndex()
+
+
+search_index = create_search_index(engine.dialect.name)
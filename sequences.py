@@ -0,0 +1,114 @@
+import os
+import threading
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import IntegrityError
+
+from database import engine
+from models import IdSequence
+
+
+class HiLoAllocator:
+    '''
+    A thread safe hi/lo allocator of primary keys.
+    Each process reserves blocks of ids by advancing a row of the id_sequences table in a short
+    transaction of its own, then hands out ids from the block in memory. Reserving a block is an
+    indexed single row update, so allocation cost does not depend on the size of the table, and the
+    row lock taken by the update keeps concurrent processes from reserving the same block.
+    Ids left in a block when a process stops are never used, so ids can have gaps.
+    '''
+
+    def __init__(self, name, id_column, block_size=50):
+        '''
+        Parameters
+        ----------
+        name: str,
+            Name of the sequence in the id_sequences table.
+        id_column: Column,
+            Primary key column the ids are for. Used once, to start the sequence after existing rows.
+        block_size: int,
+            Number of ids reserved at a time.
+        '''
+
+        self.name = name
+        self.id_column = id_column
+        self.block_size = block_size
+        self._next = 0
+        self._limit = 0
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset_after_fork)
+
+    def next_id(self):
+        '''
+        Allocate the next id.
+
+        Returns
+        -------
+        int
+            An id that has not been allocated before, by this or any other process.
+        '''
+
+        with self._lock:
+            if self._next >= self._limit:
+                self._next, self._limit = self._reserve_block()
+            id = self._next
+            self._next += 1
+            return id
+
+    def advance_past(self, id):
+        '''
+        Make sure that the sequence never hands out the given id or any lower id,
+        e.g. after rows with explicit ids were inserted in bulk.
+
+        Parameters
+        ----------
+        id: int,
+            Highest id in use.
+        '''
+
+        sequences = IdSequence.__table__
+        with self._lock:
+            with engine.begin() as connection:
+                connection.execute(
+                    sequences.update()
+                    .where(and_(sequences.c.name == self.name, sequences.c.next_value <= id))
+                    .values(next_value=id + 1))
+            if self._next <= id:
+                self._next, self._limit = 0, 0
+
+    def reset_after_fork(self):
+        '''
+        Drop the block a forked process inherited, which its parent keeps handing out,
+        and the lock, which another thread of the parent may have held.
+        '''
+
+        self._next, self._limit = 0, 0
+        self._lock = threading.Lock()
+
+    def _reserve_block(self):
+        '''
+        Private method that reserves the next block of ids in the database.
+        Returns the first id of the block and the first id after it.
+        '''
+
+        sequences = IdSequence.__table__
+        while True:
+            try:
+                with engine.begin() as connection:
+                    updated = connection.execute(
+                        sequences.update()
+                        .where(sequences.c.name == self.name)
+                        .values(next_value=sequences.c.next_value + self.block_size))
+                    if updated.rowcount != 0:
+                        limit = connection.execute(
+                            select([sequences.c.next_value]).where(sequences.c.name == self.name)).scalar()
+                        return limit - self.block_size, limit
+
+                    start = connection.execute(
+                        select([func.coalesce(func.max(self.id_column), 0) + 1])).scalar()
+                    connection.execute(sequences.insert().values(
+                        name=self.name, next_value=start + self.block_size))
+                    return start, start + self.block_size
+            except IntegrityError:
+                # Another process started the sequence at the same time, reserve from it instead
+                continue
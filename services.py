@@ -1,9 +1,135 @@
 from models import User, Admin
-from models import BlogPost, Comment, Tag
-from sqlalchemy import and_
-
-from database import db_session
+from models import BlogPost, Comment, ContentStamp, PostLike, Tag, TagCount
+from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy.orm import defer, joinedload, selectinload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
+
+from cache import TTLCache, page_cache
+from config import Config
+from database import db_session, engine, use_primary, use_replica
+from likes import like_aggregator
+from querybudget import QueryBudget
+from rendering import render_content
+from search import SEARCH_RESULTS_PER_PAGE, search_index
+from sequences import HiLoAllocator
 from datetime import datetime
+import base64
+import os
+import threading
+import time
+
+POSTS_PER_PAGE = 20
+COMMENTS_PER_PAGE = 50
+TAG_CLOUD_SIZE = 30
+FEED_SIZE = Config.FEED_SIZE
+RENDER_BATCH_SIZE = 500
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Rows fetched from the database at a time while a JSON API listing is streamed
+API_FETCH_SIZE = 500
+
+# Fields of the blog post and comment records of the JSON API, in output order, with the column each
+# one is read from. The tags of posts are loaded separately, once for every chunk of fetched rows.
+POST_API_FIELDS = ('id', 'title', 'post_date', 'updated_at', 'is_visible', 'author_id', 'author', 'tags',
+                   'excerpt', 'content', 'content_html', 'comment_count', 'like_count')
+POST_API_COLUMNS = {
+    'id': BlogPost.id,
+    'title': BlogPost.title,
+    'post_date': BlogPost.post_date,
+    'updated_at': BlogPost.updated_at,
+    'is_visible': BlogPost.is_visible,
+    'author_id': BlogPost.author_id,
+    'author': User.display_name,
+    'excerpt': BlogPost.excerpt,
+    'content': BlogPost.content,
+    'content_html': BlogPost.content_html,
+    'comment_count': BlogPost.comment_count,
+    'like_count': BlogPost.like_count,
+}
+COMMENT_API_FIELDS = ('id', 'post_id', 'comment_date',
+                      'user_id', 'author', 'content')
+COMMENT_API_COLUMNS = {
+    'id': Comment.id,
+    'post_id': Comment.blog_post_id,
+    'comment_date': Comment.comment_date,
+    'user_id': Comment.user_id,
+    'author': User.display_name,
+    'content': Comment.content,
+}
+
+# Loading profiles for blog post queries. Each profile eagerly loads exactly the relationships
+# the matching page renders, so the number of queries does not grow with the number of rows.
+# Comments of a viewed post are paged separately, see BlogService.fetch_comments_page.
+LOAD_PROFILES = {
+    'view': lambda: [defer(BlogPost.content),
+                     undefer(BlogPost.content_html),
+                     joinedload(BlogPost.author),
+                     selectinload(BlogPost.tags)],
+    'edit': lambda: [selectinload(BlogPost.tags)],
+    'list': lambda: [defer(BlogPost.content),
+                     joinedload(BlogPost.author),
+                     selectinload(BlogPost.tags)],
+    'full': lambda: [joinedload(BlogPost.author),
+                     selectinload(BlogPost.comments).joinedload(Comment.user),
+                     selectinload(BlogPost.tags),
+                     selectinload(BlogPost.likes).joinedload(PostLike.user),
+                     selectinload(BlogPost.external_references)],
+}
+
+
+def _create_tag_count_upsert(dialect_name):
+    '''
+    Create the statement that adds the first count of a tag, or increments the count of a tag that is
+    already counted, on the databases that support INSERT ... ON CONFLICT, None on the others.
+    '''
+
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    statement = insert(TagCount.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=[TagCount.tag],
+        set_={'post_count': TagCount.post_count + statement.excluded.post_count})
+
+
+_TAG_COUNT_UPSERT = _create_tag_count_upsert(engine.dialect.name)
+
+
+class PostPage:
+    '''
+    A page of blog post summaries returned by the keyset paginated listing
+    '''
+
+    def __init__(self, posts, next_cursor):
+        self.posts = posts
+        self.next_cursor = next_cursor
+
+
+class CommentPage:
+    '''
+    A page of the comments of a blog post returned by keyset pagination
+    '''
+
+    def __init__(self, comments, next_cursor):
+        self.comments = comments
+        self.next_cursor = next_cursor
+
+
+class RecordStream:
+    '''
+    A page of JSON API records produced one at a time while iterating, so a large page is never built in memory.
+    The cursor for the next page is known once the iteration has finished.
+    '''
+
+    def __init__(self, records):
+        self.next_cursor = None
+        self._records = records
+
+    def __iter__(self):
+        self.next_cursor = yield from self._records
 
 
 class BlogService:
@@ -30,9 +156,9 @@ class BlogService:
         content: str,
             Blog post content.
         author : Admin,
-            Admin user who is authring the post.
+            Admin user who is authring the post. Only the id is used, so the session identity can be passed.
         tags : list,
-            A list of Tag objects, defaults to empty list.
+            A list of tag names or Tag objects, defaults to empty list.
         make_visible: Boolean,
             Whether to make the post visible to public (publish), defaults to True.
 
@@ -43,18 +169,32 @@ class BlogService:
         '''
 
         blog_post = BlogPost()
-        blog_post.author = author
+        blog_post.author_id = author.id
         blog_post.title = title
         blog_post.content = content
+        blog_post.content_html, blog_post.excerpt = render_content(content)
         blog_post.is_visible = make_visible
-        blog_post.tags = tags
+        blog_post.tags = self._make_tags(tags)
         blog_post.post_date = datetime.now()
+        blog_post.version = 1
+        blog_post.updated_at = blog_post.post_date
 
         db_session.add(blog_post)
+        db_session.flush()
+        search_index.index_post(db_session.connection(), blog_post)
+        self._update_tag_counts([], False, blog_post.tags, make_visible)
+        self._bump_stamp('posts')
+        if make_visible:
+            # The newest post always enters the feeds
+            self._bump_stamp('feed')
         db_session.commit()
+        self._invalidate_listings()
+        if make_visible:
+            self._invalidate_feeds()
 
         return blog_post
 
+    @use_primary()
     def edit_post(self, id, title, content, tags, make_visible):
         '''
         Edit a blog post
@@ -68,7 +208,7 @@ class BlogService:
         content: str,
             Blog post content.
         tags : list,
-            A list of Tag objects.
+            A list of tag names or Tag objects, replacing the current tags. None keeps the current tags.
         make_visible: Boolean,
             Whether to make the post visible to public (publish) or not.
 
@@ -78,20 +218,40 @@ class BlogService:
             The blog post object that is edited.
         '''
 
-        blog_post = self.fetch_post_by_id(id)
+        blog_post = self.fetch_post_by_id(id, 'edit')
         if blog_post is None:
             return None
 
+        old_tags, was_visible = list(blog_post.tags), blog_post.is_visible
+        in_feed = was_visible and id in self._fetch_feed_post_ids()
         blog_post.title = title
         blog_post.content = content
+        blog_post.content_html, blog_post.excerpt = render_content(content)
         blog_post.is_visible = make_visible
-        blog_post.tags = tags
+        if tags is not None:
+            blog_post.tags = self._make_tags(tags)
+        self._touch(blog_post)
 
         db_session.add(blog_post)
+        search_index.index_post(db_session.connection(), blog_post)
+        self._update_tag_counts(
+            old_tags, was_visible, blog_post.tags, make_visible)
+        self._bump_stamp('posts')
+        # The feeds change if the post was in them or is now, e.g. when a draft is published
+        if not in_feed and make_visible:
+            db_session.flush()
+            in_feed = id in self._fetch_feed_post_ids()
+        if in_feed:
+            self._bump_stamp('feed')
         db_session.commit()
+        page_cache.invalidate_post(id)
+        self._invalidate_listings()
+        if in_feed:
+            self._invalidate_feeds()
 
         return blog_post
 
+    @use_primary()
     def delete_post(self, id):
         '''
         Delete a blog post
@@ -102,14 +262,28 @@ class BlogService:
             ID of the blog post.
         '''
 
-        blog_post = self.fetch_post_by_id(id)
+        blog_post = self.fetch_post_by_id(id, 'edit')
         if blog_post is None:
             return
 
+        comment_ids = [comment_id for comment_id, in db_session.query(
+            Comment.id).filter(Comment.blog_post_id == id)]
+        in_feed = blog_post.is_visible and id in self._fetch_feed_post_ids()
+        search_index.remove_post(db_session.connection(), id, comment_ids)
+        self._update_tag_counts(blog_post.tags, blog_post.is_visible, [], False)
         db_session.delete(blog_post)
+        self._bump_stamp('posts')
+        if in_feed:
+            self._bump_stamp('feed')
         db_session.commit()
-
-    def fetch_all_posts(self, include_hidden=True):
+        page_cache.invalidate_post(id)
+        self._invalidate_listings()
+        if in_feed:
+            self._invalidate_feeds()
+
+    @QueryBudget(5)
+    @use_replica
+    def fetch_all_posts(self, include_hidden=True, profile=None):
         '''
         Fetch all a blog posts
 
@@ -117,6 +291,8 @@ class BlogService:
         ----------
         include_hidden: Boolean,
             If True, unpublished posts will be included
+        profile: str,
+            Name of the loading profile (see LOAD_PROFILES), defaults to lazy loading.
 
         Returns
         -------
@@ -124,11 +300,67 @@ class BlogService:
             A list of BlogPost objects.
         '''
 
+        query = self._query_posts(profile)
         if include_hidden:
-            return db_session.query(BlogPost).all()
-        return db_session.query(BlogPost).filter(BlogPost.is_visible == True).all()
+            return query.all()
+        return query.filter(BlogPost.is_visible == True).all()
 
-    def fetch_post_by_id(self, id):
+    @QueryBudget(2)
+    @use_replica
+    def fetch_posts_page(self, include_hidden=True, after=None, page_size=POSTS_PER_PAGE, profile=None, tag=None):
+        '''
+        Fetch a page of blog post summaries, newest first.
+        Pages are addressed by a keyset cursor on (post_date, id), so the cost of a page does not
+        depend on how deep into the listing it is. The post content is not loaded, only its stored excerpt.
+
+        Parameters
+        ----------
+        include_hidden: Boolean,
+            If True, unpublished posts will be included
+        after: str,
+            Cursor returned with the previous page, None for the first page.
+        page_size: int,
+            Maximum number of posts in the page.
+        profile: str,
+            Name of the loading profile (see LOAD_PROFILES), defaults to lazy loading.
+        tag: str,
+            If given, only posts with this tag are listed.
+
+        Returns
+        -------
+        PostPage
+            The posts in the page and the cursor for the next page (None if this is the last page).
+
+        Raises
+        ------
+        ValueError
+            If the cursor is malformed.
+        '''
+
+        query = self._query_posts(profile).options(defer(BlogPost.content))
+        if not include_hidden:
+            query = query.filter(BlogPost.is_visible == True)
+        if tag is not None:
+            query = query.filter(BlogPost.id.in_(
+                db_session.query(Tag.blog_post_id).filter(Tag.tag == tag)))
+        if after is not None:
+            post_date, id = self._decode_cursor(after)
+            query = query.filter(or_(BlogPost.post_date < post_date,
+                                     and_(BlogPost.post_date == post_date, BlogPost.id < id)))
+
+        posts = query.order_by(BlogPost.post_date.desc(), BlogPost.id.desc()) \
+            .limit(page_size + 1).all()
+
+        next_cursor = None
+        if len(posts) > page_size:
+            posts = posts[:page_size]
+            next_cursor = self._encode_cursor(
+                posts[-1].post_date, posts[-1].id)
+        return PostPage(posts, next_cursor)
+
+    @QueryBudget(5)
+    @use_replica
+    def fetch_post_by_id(self, id, profile=None):
         '''
         Fetch a blog post by id.
 
@@ -136,6 +368,8 @@ class BlogService:
         ----------
         id: int,
             ID of the blog post.
+        profile: str,
+            Name of the loading profile (see LOAD_PROFILES), defaults to lazy loading.
 
         Returns
         -------
@@ -143,8 +377,255 @@ class BlogService:
             The matching blog post. None if no match found.
         '''
 
-        return db_session.query(BlogPost).filter(BlogPost.id == id).first()
+        blog_post = self._query_posts(profile).filter(BlogPost.id == id).first()
+        if blog_post is not None and profile == 'view':
+            self._render_missing_html([blog_post])
+        return blog_post
+
+    @QueryBudget(1)
+    @use_replica
+    def fetch_tag_counts(self, limit=TAG_CLOUD_SIZE):
+        '''
+        Fetch the most used tags with the number of published posts carrying them.
+
+        Parameters
+        ----------
+        limit: int,
+            Maximum number of tags.
+
+        Returns
+        -------
+        list
+            A list of TagCount objects, most used first.
+        '''
+
+        return db_session.query(TagCount).filter(TagCount.post_count > 0) \
+            .order_by(TagCount.post_count.desc(), TagCount.tag).limit(limit).all()
+
+    def parse_tags(self, text):
+        '''
+        Split comma separated tags, as typed in the post forms.
+
+        Parameters
+        ----------
+        text: str,
+            Comma separated tag names.
+
+        Returns
+        -------
+        list
+            A list of tag names.
+        '''
+
+        return (text or '').split(',')
+
+    def parse_fields(self, text, available):
+        '''
+        Parse a sparse fieldset, as given in the fields parameter of the JSON API.
+
+        Parameters
+        ----------
+        text: str,
+            Comma separated field names, None or blank for all fields.
+        available: tuple,
+            The fields that can be requested, in output order.
+
+        Returns
+        -------
+        list
+            The requested fields, in output order.
+
+        Raises
+        ------
+        ValueError
+            If a field is not available.
+        '''
+
+        if text is None or not text.strip():
+            return list(available)
+        requested = set(field.strip() for field in text.split(',') if field.strip())
+        unknown = requested.difference(available)
+        if unknown:
+            raise ValueError("Unknown fields: {}".format(
+                ", ".join(sorted(unknown))))
+        return [field for field in available if field in requested]
+
+    def stream_posts(self, fields, include_hidden=True, after=None, page_size=API_PAGE_SIZE, tag=None):
+        '''
+        Stream a page of blog post records for the JSON API, newest first.
+        Only the columns of the requested fields are read, and rows are fetched in chunks of API_FETCH_SIZE
+        while the records are consumed. Pages are addressed by the same keyset cursor as fetch_posts_page.
+
+        Parameters
+        ----------
+        fields: list,
+            Names of the fields of each record (see POST_API_FIELDS).
+        include_hidden: Boolean,
+            If True, unpublished posts will be included
+        after: str,
+            Cursor returned with the previous page, None for the first page.
+        page_size: int,
+            Maximum number of posts in the page.
+        tag: str,
+            If given, only posts with this tag are listed.
+
+        Returns
+        -------
+        RecordStream
+            The records of the posts as dicts, and the cursor for the next page once iterated.
+
+        Raises
+        ------
+        ValueError
+            If the cursor is malformed.
+        '''
+
+        query = self._query_post_records(fields, include_hidden)
+        if tag is not None:
+            query = query.filter(BlogPost.id.in_(
+                db_session.query(Tag.blog_post_id).filter(Tag.tag == tag)))
+        if after is not None:
+            post_date, id = self._decode_cursor(after)
+            query = query.filter(or_(BlogPost.post_date < post_date,
+                                     and_(BlogPost.post_date == post_date, BlogPost.id < id)))
+        query = query.order_by(BlogPost.post_date.desc(), BlogPost.id.desc()) \
+            .limit(page_size + 1)
+        return RecordStream(self._iter_post_records(query, fields, page_size))
+
+    @use_replica
+    def fetch_post_record(self, id, fields, include_hidden=True):
+        '''
+        Fetch the record of a blog post for the JSON API.
+
+        Parameters
+        ----------
+        id: int,
+            ID of the blog post.
+        fields: list,
+            Names of the fields of the record (see POST_API_FIELDS).
+        include_hidden: Boolean,
+            If True, an unpublished post can be returned.
+
+        Returns
+        -------
+        dict
+            The record of the blog post. None if no match found.
+        '''
+
+        query = self._query_post_records(
+            fields, include_hidden).filter(BlogPost.id == id)
+        return next(iter(RecordStream(self._iter_post_records(query, fields, 1))), None)
+
+    def stream_comments(self, post_id, fields, after=None, page_size=API_PAGE_SIZE):
+        '''
+        Stream a page of the comment records of a blog post for the JSON API, oldest first.
+        Pages are addressed by the same keyset cursor as fetch_comments_page.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        fields: list,
+            Names of the fields of each record (see COMMENT_API_FIELDS).
+        after: str,
+            Cursor returned with the previous page, None for the first page.
+        page_size: int,
+            Maximum number of comments in the page.
 
+        Returns
+        -------
+        RecordStream
+            The records of the comments as dicts, and the cursor for the next page once iterated.
+
+        Raises
+        ------
+        ValueError
+            If the cursor is malformed.
+        '''
+
+        columns = [COMMENT_API_COLUMNS[field] for field in fields]
+        query = db_session.query(Comment.id, Comment.comment_date, *columns) \
+            .filter(Comment.blog_post_id == post_id)
+        if 'author' in fields:
+            query = query.outerjoin(User, User.id == Comment.user_id)
+        if after is not None:
+            comment_date, id = self._decode_cursor(after)
+            query = query.filter(or_(Comment.comment_date > comment_date,
+                                     and_(Comment.comment_date == comment_date, Comment.id > id)))
+        query = query.order_by(Comment.comment_date, Comment.id).limit(page_size + 1)
+        return RecordStream(self._iter_records(query, page_size,
+                                               lambda chunk: [dict(zip(fields, row[2:])) for row in chunk]))
+
+    @use_replica
+    def fetch_post_stamp(self, id):
+        '''
+        Fetch the version information of a blog post without loading its content.
+
+        Parameters
+        ----------
+        id: int,
+            ID of the blog post.
+
+        Returns
+        -------
+        tuple
+            A row with id, is_visible, version and updated_at of the blog post. None if no match found.
+        '''
+
+        return db_session.query(BlogPost.id, BlogPost.is_visible, BlogPost.version, BlogPost.updated_at) \
+            .filter(BlogPost.id == id).first()
+
+    @use_replica
+    def fetch_listing_stamp(self):
+        '''
+        Fetch the version information of the blog post listing.
+        The listing version changes whenever a post is added, edited or deleted.
+
+        Returns
+        -------
+        ContentStamp
+            The listing stamp. None if no post was ever written.
+        '''
+
+        return db_session.query(ContentStamp).filter(ContentStamp.name == 'posts').first()
+
+    @use_replica
+    def fetch_feed_stamp(self):
+        '''
+        Fetch the version information of the feeds.
+        The feed version only changes when a post that is or becomes one of the latest FEED_SIZE published posts
+        is added, edited, deleted, published or unpublished, so comments and likes leave the feeds cached.
+
+        Returns
+        -------
+        ContentStamp
+            The feed stamp. None if no post was ever published.
+        '''
+
+        return db_session.query(ContentStamp).filter(ContentStamp.name == 'feed').first()
+
+    @QueryBudget(3)
+    @use_replica
+    def fetch_feed_posts(self, limit=FEED_SIZE):
+        '''
+        Fetch the latest published blog posts for the feeds, newest first, with their rendered HTML,
+        author and tags.
+
+        Parameters
+        ----------
+        limit: int,
+            Maximum number of posts.
+
+        Returns
+        -------
+        list
+            A list of BlogPost objects.
+        '''
+
+        return self._render_missing_html(self._query_posts('view').filter(BlogPost.is_visible == True)
+                                         .order_by(BlogPost.post_date.desc(), BlogPost.id.desc()).limit(limit).all())
+
+    @use_primary()
     def add_comment(self, post_id, content, user):
         '''
         Add a comment to a blog post
@@ -156,7 +637,7 @@ class BlogService:
         content: str,
             The body of the comment.
         user: User,
-            The user who is making the comment.
+            The user who is making the comment. Only the id is used, so the session identity can be passed.
 
         Returns
         -------
@@ -168,19 +649,503 @@ class BlogService:
         if blog_post is None:
             return None
 
-        if blog_post.comments is None:
-            blog_post.comments = []
+        self.add_comments([(post_id, content, user.id)])
 
-        comment = Comment()
-        comment.blog_post = blog_post
-        comment.content = content
-        comment.user = user
-        comment.comment_date = datetime.now()
+        return blog_post
 
-        db_session.add(comment)
+    def add_comments(self, entries):
+        '''
+        Add a batch of comments, possibly to different blog posts, in a single transaction.
+
+        Parameters
+        ----------
+        entries: list,
+            A list of (post_id, content, user_id) tuples.
+
+        Returns
+        -------
+        list
+            The added Comment object for each entry, in order. None for entries whose blog post does not exist.
+        '''
+
+        post_ids = set(post_id for post_id, _, _ in entries)
+        existing_ids = set(id for id, in db_session.query(
+            BlogPost.id).filter(BlogPost.id.in_(post_ids)))
+
+        now = datetime.now()
+        comments = []
+        counts = {}
+        for post_id, content, user_id in entries:
+            if post_id not in existing_ids:
+                comments.append(None)
+                continue
+            comment = Comment()
+            comment.blog_post_id = post_id
+            comment.content = content
+            comment.user_id = user_id
+            comment.comment_date = now
+            db_session.add(comment)
+            comments.append(comment)
+            counts[post_id] = counts.get(post_id, 0) + 1
+
+        if not counts:
+            return comments
+
+        db_session.flush()
+        connection = db_session.connection()
+        for comment in comments:
+            if comment is not None:
+                search_index.index_comment(connection, comment)
+        for post_id, count in counts.items():
+            db_session.query(BlogPost).filter(BlogPost.id == post_id) \
+                .update({BlogPost.comment_count: func.coalesce(BlogPost.comment_count, 0) + count,
+                         BlogPost.version: func.coalesce(BlogPost.version, 0) + 1,
+                         BlogPost.updated_at: now}, synchronize_session=False)
+        self._bump_stamp('posts')
         db_session.commit()
+        for post_id in counts:
+            page_cache.invalidate_post(post_id)
+        self._invalidate_listings()
 
-        return blog_post
+        return comments
+
+    def like_post(self, post_id, user, liked=True):
+        '''
+        Like or unlike a blog post. The like is recorded in memory and written to the database in a batch
+        with the other likes recorded meanwhile (see likes.LikeAggregator), which this waits for, for at most
+        LIKE_WRITE_TIMEOUT_MS, so that the user sees their like on the pages of every process. A like whose
+        write failed stays pending and is written by a later batch.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        user: User,
+            The user who likes the post. Only the id is used, so the session identity can be passed.
+        liked: Boolean,
+            True to like the post, False to unlike it. Defaults to True.
+
+        Returns
+        -------
+        Boolean
+            True if the like state of the user changed, False if it already was as requested.
+        '''
+
+        changed = like_aggregator.set_liked(post_id, user.id, liked)
+        if changed:
+            like_aggregator.wait_written(post_id, user.id, Config.LIKE_WRITE_TIMEOUT_MS / 1000)
+        return changed
+
+    def is_post_liked(self, post_id, user):
+        '''
+        Check whether a user likes a blog post, including likes that are not written to the database yet.
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        user: User,
+            The user. Only the id is used, so the session identity can be passed.
+
+        Returns
+        -------
+        Boolean
+            True if the user likes the post, False otherwise.
+        '''
+
+        return like_aggregator.is_liked(post_id, user.id)
+
+    def fetch_like_count(self, blog_post):
+        '''
+        Get the number of likes of a blog post, including likes that are not written to the database yet.
+
+        Parameters
+        ----------
+        blog_post: BlogPost,
+            The blog post, with its like_count loaded.
+
+        Returns
+        -------
+        int
+            The number of likes.
+        '''
+
+        return (blog_post.like_count or 0) + like_aggregator.pending_delta(blog_post.id)
+
+    @QueryBudget(1)
+    @use_replica
+    def fetch_comments_page(self, post_id, after=None, page_size=COMMENTS_PER_PAGE):
+        '''
+        Fetch a page of the comments of a blog post, oldest first, along with the users who wrote them.
+        Pages are addressed by a keyset cursor on (comment_date, id).
+
+        Parameters
+        ----------
+        post_id: int,
+            ID of the blog post.
+        after: str,
+            Cursor returned with the previous page, None for the first page.
+        page_size: int,
+            Maximum number of comments in the page.
+
+        Returns
+        -------
+        CommentPage
+            The comments in the page and the cursor for the next page (None if this is the last page).
+
+        Raises
+        ------
+        ValueError
+            If the cursor is malformed.
+        '''
+
+        query = db_session.query(Comment).options(joinedload(Comment.user)) \
+            .filter(Comment.blog_post_id == post_id)
+        if after is not None:
+            comment_date, id = self._decode_cursor(after)
+            query = query.filter(or_(Comment.comment_date > comment_date,
+                                     and_(Comment.comment_date == comment_date, Comment.id > id)))
+
+        comments = query.order_by(Comment.comment_date, Comment.id) \
+            .limit(page_size + 1).all()
+
+        next_cursor = None
+        if len(comments) > page_size:
+            comments = comments[:page_size]
+            next_cursor = self._encode_cursor(
+                comments[-1].comment_date, comments[-1].id)
+        return CommentPage(comments, next_cursor)
+
+    @QueryBudget(1)
+    @use_replica
+    def search(self, query, page=1, include_hidden=False):
+        '''
+        Full text search over blog post titles, post content and comments.
+
+        Parameters
+        ----------
+        query: str,
+            Search terms, all of which must match.
+        page: int,
+            Page number, starting from 1.
+        include_hidden: Boolean,
+            If True, unpublished posts and their comments will be included.
+
+        Returns
+        -------
+        SearchPage
+            The matching posts and comments, best matches first, with the matched terms highlighted.
+        '''
+
+        return search_index.search(db_session.connection(), query, page, include_hidden, SEARCH_RESULTS_PER_PAGE)
+
+    def recompute_aggregates(self):
+        '''
+        Recompute every value derived from posts, tags, comments and likes with set based statements:
+        comment and like counts, tag counts and the search index. Used after loading rows in bulk.
+        '''
+
+        db_session.execute(text(
+            "UPDATE blog_posts SET "
+            "comment_count = (SELECT count(*) FROM comments WHERE comments.blog_post_id = blog_posts.id), "
+            "like_count = (SELECT count(*) FROM post_likes WHERE post_likes.blog_post_id = blog_posts.id), "
+            "version = coalesce(version, 0) + 1, updated_at = coalesce(updated_at, post_date)"))
+        db_session.execute(text("DELETE FROM tag_counts"))
+        db_session.execute(text(
+            "INSERT INTO tag_counts (tag, post_count) "
+            "SELECT tags.tag, count(DISTINCT tags.blog_post_id) FROM tags "
+            "JOIN blog_posts ON blog_posts.id = tags.blog_post_id "
+            "WHERE blog_posts.is_visible GROUP BY tags.tag"))
+        search_index.rebuild(db_session.connection())
+        self._bump_stamp('posts')
+        self._bump_stamp('feed')
+        db_session.commit()
+        page_cache.clear()
+
+    def render_stored_posts(self, batch_size=RENDER_BATCH_SIZE, rerender=False):
+        '''
+        Render the HTML and excerpt of blog posts written before they were rendered at write time.
+        Posts are processed in batches of batch_size, each committed in its own transaction,
+        so a large backfill can be interrupted and run again.
+
+        Parameters
+        ----------
+        batch_size: int,
+            Number of posts rendered per transaction.
+        rerender: Boolean,
+            If True, posts that are already rendered are rendered again, e.g. after changing the allowed tags.
+
+        Returns
+        -------
+        int
+            Number of posts rendered.
+        '''
+
+        rendered = 0
+        last_id = 0
+        while True:
+            query = db_session.query(BlogPost.id, BlogPost.content).filter(BlogPost.id > last_id)
+            if not rerender:
+                query = query.filter(BlogPost.content_html == None)
+            rows = query.order_by(BlogPost.id).limit(batch_size).all()
+            if not rows:
+                break
+            updates = []
+            for id, content in rows:
+                content_html, excerpt = render_content(content)
+                updates.append({'id': id, 'content_html': content_html, 'excerpt': excerpt})
+            db_session.execute(text(
+                "UPDATE blog_posts SET content_html = :content_html, excerpt = :excerpt, "
+                "version = coalesce(version, 0) + 1 WHERE id = :id"), updates)
+            self._bump_stamp('posts')
+            self._bump_stamp('feed')
+            db_session.commit()
+            rendered += len(rows)
+            last_id = rows[-1].id
+        page_cache.clear()
+        return rendered
+
+    def rebuild_search_index(self):
+        '''
+        Index all existing blog posts and comments again, e.g. after importing data or upgrading a database.
+        '''
+
+        search_index.rebuild(db_session.connection())
+        db_session.commit()
+
+    def _make_tags(self, tags):
+        '''
+        Private method that builds the Tag objects of a post from tag names or Tag objects.
+        Names are trimmed and lower cased, and blanks and duplicates are dropped.
+        '''
+
+        names = []
+        for tag in tags:
+            name = (tag.tag if isinstance(tag, Tag) else tag or '').strip().lower()
+            if name and name not in names:
+                names.append(name)
+
+        new_tags = []
+        for name in names:
+            tag = Tag()
+            # With their ids known up front, the tags of a post are inserted in one batch
+            tag.id = tag_id_allocator.next_id()
+            tag.tag = name
+            new_tags.append(tag)
+        return new_tags
+
+    def _update_tag_counts(self, old_tags, was_visible, new_tags, is_visible):
+        '''
+        Private method that adjusts the published post count of every tag affected by a change of a post's
+        tags or visibility, as part of the current transaction.
+        '''
+
+        deltas = {}
+        if was_visible:
+            for tag in old_tags:
+                deltas[tag.tag] = deltas.get(tag.tag, 0) - 1
+        if is_visible:
+            for tag in new_tags:
+                deltas[tag.tag] = deltas.get(tag.tag, 0) + 1
+
+        # One update per distinct delta rather than per tag, usually a single statement
+        names_by_delta = {}
+        for name, delta in deltas.items():
+            if delta != 0:
+                names_by_delta.setdefault(delta, []).append(name)
+
+        for delta, names in names_by_delta.items():
+            if delta > 0 and _TAG_COUNT_UPSERT is not None:
+                # Adds the first count of a tag or increments it in one statement, so that the first
+                # uses of a tag by concurrent transactions do not both try to insert it
+                db_session.execute(_TAG_COUNT_UPSERT, [{'tag': name, 'post_count': delta} for name in names])
+                continue
+            updated = db_session.query(TagCount).filter(TagCount.tag.in_(names)) \
+                .update({TagCount.post_count: TagCount.post_count + delta}, synchronize_session=False)
+            if updated == len(names) or delta < 0:
+                continue
+            existing = set(name for name, in db_session.query(TagCount.tag).filter(TagCount.tag.in_(names)))
+            for name in names:
+                if name not in existing:
+                    tag_count = TagCount()
+                    tag_count.tag = name
+                    tag_count.post_count = delta
+                    db_session.add(tag_count)
+
+    def _render_missing_html(self, posts):
+        '''
+        Private method that renders the HTML of the given posts that have none stored yet, such as posts
+        written before it was rendered on save, until `flask render-posts` renders them. The HTML is only
+        set on the loaded objects, the posts are not changed. Returns the posts.
+        '''
+
+        missing = [post for post in posts if post.content_html is None]
+        if missing:
+            self._set_rendered_html(missing, dict(db_session.query(BlogPost.id, BlogPost.content)
+                                                  .filter(BlogPost.id.in_([post.id for post in missing]))))
+        return posts
+
+    def _set_rendered_html(self, posts, contents):
+        '''
+        Private method that sets the HTML of posts rendered from their content, given as {post id: content},
+        without marking the posts as changed.
+        '''
+
+        for post in posts:
+            set_committed_value(post, 'content_html', render_content(contents.get(post.id))[0])
+
+    def _invalidate_listings(self):
+        '''
+        Private method that drops the cached pages listing blog posts.
+        '''
+
+        page_cache.invalidate_route('index')
+        page_cache.invalidate_route('tag')
+
+    def _invalidate_feeds(self):
+        '''
+        Private method that drops the cached feeds.
+        '''
+
+        page_cache.invalidate_route('atom')
+        page_cache.invalidate_route('rss')
+
+    def _fetch_feed_post_ids(self):
+        '''
+        Private method that fetches the ids of the blog posts in the feeds, with one indexed query.
+        '''
+
+        return set(id for id, in db_session.query(BlogPost.id).filter(BlogPost.is_visible == True)
+                   .order_by(BlogPost.post_date.desc(), BlogPost.id.desc()).limit(FEED_SIZE))
+
+    def _touch(self, blog_post):
+        '''
+        Private method that bumps the version of a blog post, as part of the current transaction.
+        '''
+
+        blog_post.version = func.coalesce(BlogPost.version, 0) + 1
+        blog_post.updated_at = datetime.now()
+
+    def _bump_stamp(self, name):
+        '''
+        Private method that bumps the version of a content stamp, as part of the current transaction:
+        'posts' for the blog post listing, 'feed' for the feeds of the latest posts.
+        '''
+
+        now = datetime.now()
+        updated = db_session.query(ContentStamp).filter(ContentStamp.name == name) \
+            .update({ContentStamp.version: ContentStamp.version + 1, ContentStamp.updated_at: now},
+                    synchronize_session=False)
+        if updated == 0:
+            stamp = ContentStamp()
+            stamp.name = name
+            stamp.version = 1
+            stamp.updated_at = now
+            db_session.add(stamp)
+
+    def _query_posts(self, profile):
+        '''
+        Private method that starts a blog post query with the eager loading options of the given profile.
+        '''
+
+        query = db_session.query(BlogPost)
+        if profile is None:
+            return query
+        if profile not in LOAD_PROFILES:
+            raise ValueError("Unknown loading profile: {}".format(profile))
+        return query.options(*LOAD_PROFILES[profile]())
+
+    def _query_post_records(self, fields, include_hidden):
+        '''
+        Private method that starts a query of the (id, post_date) key and the columns of the given post fields.
+        '''
+
+        columns = [POST_API_COLUMNS[field]
+                   for field in fields if field in POST_API_COLUMNS]
+        query = db_session.query(BlogPost.id, BlogPost.post_date, *columns)
+        if 'author' in fields:
+            query = query.outerjoin(User, User.id == BlogPost.author_id)
+        if not include_hidden:
+            query = query.filter(BlogPost.is_visible == True)
+        return query
+
+    def _iter_post_records(self, query, fields, page_size):
+        '''
+        Private method that yields blog post records from a record query, and returns the cursor for the next page.
+        '''
+
+        columns = [field for field in fields if field in POST_API_COLUMNS]
+
+        def build(chunk):
+            tags = self._fetch_tag_names([row[0] for row in chunk]) if 'tags' in fields else {}
+            records = []
+            for row in chunk:
+                values = dict(zip(columns, row[2:]))
+                values['tags'] = tags.get(row[0], [])
+                if 'like_count' in values:
+                    values['like_count'] = (values['like_count'] or 0) + \
+                        like_aggregator.pending_delta(row[0])
+                records.append(dict((field, values[field]) for field in fields))
+            return records
+
+        return (yield from self._iter_records(query, page_size, build))
+
+    def _iter_records(self, query, page_size, build):
+        '''
+        Private method that yields records from a query of (id, date, *field columns) rows, fetched in chunks of
+        API_FETCH_SIZE rows and turned into records by build(chunk). Returns the cursor for the next page,
+        or None if the query has no more than page_size rows.
+        '''
+
+        count = 0
+        last = None
+        # Streamed responses are iterated after the request teardown removed the session the query was built on
+        rows = query.with_session(db_session()).yield_per(API_FETCH_SIZE).__iter__()
+        try:
+            while True:
+                chunk = [row for _, row in zip(range(API_FETCH_SIZE), rows)]
+                if not chunk:
+                    return None
+                for row, record in zip(chunk, build(chunk)):
+                    if count == page_size:
+                        return self._encode_cursor(last[1], last[0])
+                    yield record
+                    count += 1
+                    last = row
+        finally:
+            # Release the cursor of a page that stops before the end of the query
+            rows.close()
+
+    def _fetch_tag_names(self, post_ids):
+        '''
+        Private method that loads the tag names of the given blog posts with one query.
+        '''
+
+        tags = {}
+        for blog_post_id, tag in db_session.query(Tag.blog_post_id, Tag.tag) \
+                .filter(Tag.blog_post_id.in_(post_ids)).order_by(Tag.blog_post_id, Tag.id):
+            tags.setdefault(blog_post_id, []).append(tag)
+        return tags
+
+    def _encode_cursor(self, date, id):
+        '''
+        Private method that builds an opaque listing cursor pointing after the row with the given (date, id) key.
+        '''
+
+        key = "{}|{}".format(date.isoformat(), id)
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    def _decode_cursor(self, cursor):
+        '''
+        Private method that parses a listing cursor into its (date, id) key.
+        '''
+
+        try:
+            post_date, id = base64.urlsafe_b64decode(
+                cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(post_date), int(id)
+        except (ValueError, UnicodeError) as e:
+            raise ValueError("Invalid cursor: {}".format(cursor)) from e
 
 
 class UserService:
@@ -194,6 +1159,11 @@ class UserService:
     def __new__(cls):
         if cls.__instance == None:
             cls.__instance = super(UserService, cls).__new__(cls)
+            cls.__instance._user_cache = TTLCache(
+                Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+            cls.__instance._changed_at = {}
+            cls.__instance._changes_polled_at = None
+            cls.__instance._changes_lock = threading.Lock()
         return cls.__instance
 
     def sign_up(self, username, password, display_name, phone, email, is_admin=False):
@@ -222,7 +1192,7 @@ class UserService:
         '''
 
         user = Admin() if is_admin else User()
-        user.id = self._get_next_user_id()
+        user.id = user_id_allocator.next_id()
         user.username = username
         user.password = password
         user.display_name = display_name
@@ -249,6 +1219,7 @@ class UserService:
 
         return count != 0
 
+    @use_replica
     def fetch_all_users(self):
         '''
         Fetch a list of users in the system.
@@ -261,6 +1232,7 @@ class UserService:
 
         return db_session.query(User).all()
 
+    @use_replica
     def fetch_user_by_id(self, id):
         '''
         Fetch a user by id.
@@ -277,6 +1249,143 @@ class UserService:
         '''
         return db_session().query(User).filter(User.id == id).first()
 
+    @QueryBudget(1)
+    def fetch_cached_user(self, id):
+        '''
+        Fetch a user by id, served from a short lived in-memory cache when possible.
+        The returned object is detached from the database session, so only its column attributes can be used.
+
+        Parameters
+        ----------
+        id: int,
+            ID of the user.
+
+        Returns
+        -------
+        Admin/User
+            Matching Admin/User object, None if no match found.
+        '''
+
+        user = self._user_cache.get(id)
+        if user is not None:
+            return user
+
+        user = self.fetch_user_by_id(id)
+        if user is not None:
+            db_session.expunge(user)
+            self._user_cache.put(id, user)
+        return user
+
+    def change_user_type(self, id, is_admin):
+        '''
+        Promote a user to admin or demote an admin to a regular user.
+
+        Parameters
+        ----------
+        id: int,
+            ID of the user.
+        is_admin: Boolean,
+            If True the user becomes an admin, otherwise a regular user.
+
+        Returns
+        -------
+        Boolean
+            True if the user exists, False otherwise.
+        '''
+
+        updated = db_session.query(User).filter(User.id == id) \
+            .update({User.type: 'admin' if is_admin else 'user', User.changed_at: time.time()},
+                    synchronize_session=False)
+        db_session.commit()
+        self.invalidate_user(id)
+        return updated != 0
+
+    @use_primary()
+    def update_profile(self, id, display_name, phone, email):
+        '''
+        Update the profile of a user.
+
+        Parameters
+        ----------
+        id: int,
+            ID of the user.
+        display_name: str,
+            User's display name.
+        phone: str,
+            User's phone, must be unique.
+        email: : str,
+            User's email id, must be unique.
+
+        Returns
+        -------
+        Admin/User
+            The updated user, None if no match found.
+        '''
+
+        user = self.fetch_user_by_id(id)
+        if user is None:
+            return None
+
+        user.display_name = display_name
+        user.phone = phone
+        user.email = email
+        user.changed_at = time.time()
+
+        db_session.commit()
+        self.invalidate_user(id)
+        return user
+
+    def invalidate_user(self, id):
+        '''
+        Drop any cached copy of a user and mark the identities issued for the user before now as stale,
+        in this process. Other processes learn about the change from the changed_at column of the user,
+        which the change must set (see is_changed_since).
+
+        Parameters
+        ----------
+        id: int,
+            ID of the user.
+        '''
+
+        self._changed_at[id] = time.time()
+        self._user_cache.invalidate(id)
+
+    def is_changed_since(self, id, timestamp):
+        '''
+        Check whether a user was changed after the given time, by any process.
+        Every USER_CHANGES_POLL_SECONDS at most, the users changed in the last USER_CACHE_TTL seconds are read
+        from the database with one indexed query, and their cached copies are dropped. Identities verified
+        earlier than that are verified again anyway (see identity.get_current_identity).
+
+        Parameters
+        ----------
+        id: int,
+            ID of the user.
+        timestamp: float,
+            Time in seconds since the epoch.
+
+        Returns
+        -------
+        Boolean
+            True if the user was changed after the given time, False otherwise.
+        '''
+
+        if self._poll_due():
+            with engine.connect() as connection:
+                self._apply_changes(connection.execute(self._select_changes()).fetchall())
+        return self._changed_at.get(id, 0) > timestamp
+
+    def reset_after_fork(self):
+        '''
+        Drop the users and user changes a forked process inherited, so that it reads them from the database,
+        and replace the lock, which another thread of the parent may have held.
+        '''
+
+        self._changes_lock = threading.Lock()
+        self._changed_at = {}
+        self._changes_polled_at = None
+        self._user_cache.reset_after_fork()
+
     def login(self, username, password):
         '''
         Authenticates a user.
@@ -295,14 +1404,44 @@ class UserService:
         '''
         return db_session.query(User).filter(and_(User.username == username, User.password == password)).first()
 
-    def _get_next_user_id(self):
+    def _poll_due(self):
+        '''
+        Private method that checks whether the users changed recently have to be read again, i.e. they were last
+        read USER_CHANGES_POLL_SECONDS ago or more. Only the first caller is told so, and is expected to read them.
+        '''
+
+        now = time.monotonic()
+        with self._changes_lock:
+            if self._changes_polled_at is not None and \
+                    now - self._changes_polled_at < Config.USER_CHANGES_POLL_SECONDS:
+                return False
+            self._changes_polled_at = now
+            return True
+
+    def _select_changes(self):
+        '''
+        Private method that builds the query of the users changed by any process in the last USER_CACHE_TTL
+        seconds, as (id, changed_at) rows.
+        '''
+
+        return select([User.id, User.changed_at]).where(User.changed_at > time.time() - Config.USER_CACHE_TTL)
+
+    def _apply_changes(self, rows):
         '''
-        Private method used for calculating the next primary key/ID for the user record.
-        This is done manually since SQL alchemy does not allow autoincrement of primary keys for polymorphic types.
+        Private method that records the users changed recently, read with _select_changes, and drops the cached
+        copies of those changed since the previous read.
         '''
-        count = db_session.query(User).filter(User.id != None).count()
-        return count+1
+
+        changed_at = dict(rows)
+        for id, timestamp in changed_at.items():
+            if self._changed_at.get(id, 0) < timestamp:
+                self._user_cache.invalidate(id)
+        self._changed_at = changed_at
 
 
+# Ids are allocated manually since SQL alchemy does not allow autoincrement of primary keys for polymorphic types.
+user_id_allocator = HiLoAllocator('users', User.id, Config.USER_ID_BLOCK_SIZE)
+tag_id_allocator = HiLoAllocator('tags', Tag.id, Config.TAG_ID_BLOCK_SIZE)
 blog_service = BlogService()
 user_service = UserService()
+os.register_at_fork(after_in_child=user_service.reset_after_fork)
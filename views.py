@@ -0,0 +1,771 @@
+import json
+import logging
+import os
+import queue
+from datetime import datetime
+from email.utils import format_datetime
+
+import click
+from flask import (Blueprint, Response, abort, redirect, render_template,
+                   request, stream_with_context)
+from flask.helpers import url_for
+from flask.json import jsonify
+
+from bulk import (EXPORT_FETCH_SIZE, IMPORT_BATCH_SIZE, RECORD_TYPES,
+                  BulkExporter, BulkImporter)
+from cache import page_cache
+from compression import compress_response
+from config import Config
+from database import db_session, engine, init_db, pin_primary, replica_engine
+from identity import (get_current_identity, is_loggedin, login_user,
+                      logout_user, mark_write, wrote_recently)
+from ingest import comment_ingest_queue
+from likes import like_aggregator
+from metrics import request_metrics, server_timing, startup_metrics
+from migrations import schema_migrator
+from pages import (check_post_visible, fresh_listing_page, fresh_post_page,
+                   http_date, lookup_listing_page, lookup_page,
+                   lookup_post_page, make_etag, render_listing_page,
+                   render_post_page)
+from querybudget import QueryBudget, instrument_query_budgets
+from reputation import REPUTATION_BATCH_SIZE, ReputationEngine
+from services import (API_MAX_PAGE_SIZE, API_PAGE_SIZE, COMMENT_API_FIELDS,
+                      POST_API_FIELDS, RENDER_BATCH_SIZE, blog_service,
+                      user_service)
+
+# Routes, handlers and commands of the blog, registered on the application by app.create_app
+blog = Blueprint('blog', __name__, cli_group=None)
+
+logger = logging.getLogger(__name__)
+
+host_url = "http://localhost:5000"
+if os.environ.get("CODESPACES") == "true":
+    host_url = "https://{}-5000.apps.codespaces.githubusercontent.com".format(
+        os.environ.get("CLOUDENV_ENVIRONMENT_ID"))
+
+# Engines whose statements are timed and counted already, see instrument_engines
+_instrumented_engines = []
+
+
+def instrument_engines():
+    '''
+    Time the SQL statements of the primary and replica engines and count them against the query budgets,
+    as enabled by METRICS_ENABLED and QUERY_BUDGET_MODE. Engines are only instrumented once, however many
+    applications are created.
+    '''
+
+    for instrumented_engine in [engine] + ([replica_engine] if replica_engine is not None else []):
+        if instrumented_engine in _instrumented_engines:
+            continue
+        if Config.METRICS_ENABLED:
+            request_metrics.instrument_engine(instrumented_engine)
+        if Config.QUERY_BUDGET_MODE != 'off':
+            instrument_query_budgets(instrumented_engine)
+        _instrumented_engines.append(instrumented_engine)
+
+
+def setup_admin(user_service):
+    '''
+    Create admin user when the app is launched for the first time
+    '''
+
+    if not user_service.is_default_admin_exists():
+        user_service.sign_up('admin', 'password', 'Admin',
+                             None, 'admin@blog.com', True)
+        logger.info("Admin Added")
+
+
+@blog.route('/')
+@blog.route('/index/')
+@QueryBudget(5)
+def index():
+    '''
+    Route for home page that also renders list of blog posts, one page at a time
+    Administrators can also see unpublished posts
+    '''
+
+    is_admin = False
+
+    if is_loggedin():
+        user = get_current_identity()
+        is_admin = user is not None and user.type == 'admin'
+
+    return posts_listing_response('index', is_admin)
+
+
+@blog.route('/tags/<tag>/')
+@QueryBudget(4)
+def tag_posts(tag):
+    '''
+    Route for the list of blog posts with a tag, one page at a time
+    Administrators can also see unpublished posts
+    '''
+
+    user = get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    return posts_listing_response('tag', is_admin, tag.strip().lower())
+
+
+@blog.route('/search/')
+@QueryBudget(3)
+def search():
+    '''
+    Route for searching blog posts and comments
+    Administrators can also find unpublished posts
+    '''
+
+    user = get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400, description="Invalid page")
+    results = blog_service.search(query, page, include_hidden=is_admin)
+    return render_template('search.html', query=query, results=results)
+
+
+@blog.route('/feed.xml')
+@QueryBudget(4)
+def atom_feed():
+    '''
+    Route for the Atom feed of the latest published blog posts
+    '''
+
+    return feed_response('atom', 'atom.xml', 'application/atom+xml')
+
+
+@blog.route('/rss.xml')
+@QueryBudget(4)
+def rss_feed():
+    '''
+    Route for the RSS feed of the latest published blog posts
+    '''
+
+    return feed_response('rss', 'rss.xml', 'application/rss+xml')
+
+
+@blog.app_template_filter('atom_date')
+def atom_date(value):
+    '''
+    Format a timestamp from the database as an RFC 3339 date in UTC, as used in Atom feeds
+    '''
+
+    return http_date(value).isoformat()
+
+
+@blog.app_template_filter('rss_date')
+def rss_date(value):
+    '''
+    Format a timestamp from the database as an RFC 822 date, as used in RSS feeds
+    '''
+
+    return format_datetime(http_date(value), usegmt=True)
+
+
+@blog.route('/login/', methods=['GET', 'POST'])
+@QueryBudget(2)
+def login():
+    '''
+    Route for login page and for submitting login form
+    '''
+
+    if not is_loggedin():
+        if request.method == 'POST':
+            username = request.form['username']
+            password = request.form['password']
+
+            user = user_service.login(username, password)
+            if user is not None:
+                login_user(user)
+            else:
+                return render_template('login.html', error_message='Invalid credentials.')
+        elif request.method == 'GET':
+            return render_template('login.html')
+    return redirect(host_url + "/index/", code=303)
+
+
+@blog.route('/logout/')
+@QueryBudget(1)
+def logout():
+    '''
+    Logout end point
+    '''
+
+    if is_loggedin():
+        logout_user()
+    return redirect(host_url + "/index/", code=303)
+
+
+@blog.route('/register/', methods=['GET', 'POST'])
+@QueryBudget(6)
+def register():
+    '''
+    Route for registration page and for submitting registration form
+    '''
+
+    if not is_loggedin():
+        if request.method == 'POST':
+            username = request.form['username']
+            password = request.form['password']
+            display_name = request.form['display_name']
+            email = request.form['email']
+            try:
+                user = user_service.sign_up(
+                    username, password, display_name, None, email)
+                login_user(user)
+            except:
+                return render_template('register.html', error_message='Registration failed. Please check your input and try again. It is also possible that there is an account with the given username or emailid.')
+        elif request.method == 'GET':
+            return render_template('register.html')
+    return redirect(host_url + "/index/", code=303)
+
+
+@blog.route('/posts/', methods=['GET', 'POST'])
+@blog.route('/posts/<int:id>', methods=['GET', 'POST'])
+@QueryBudget(16)
+def add_view_post(id=None):
+    '''
+    Route for "add post" page and for submitting "add post" form for admins
+    Also for viewing a blog post by id - for all users
+    Administrators can view unpublished posts
+    '''
+
+    user = None
+    is_admin = False
+
+    if is_loggedin():
+        user = get_current_identity()
+        is_admin = user is not None and user.type == 'admin'
+
+    if request.method == 'POST':
+        if not is_loggedin():
+            return redirect(host_url + '/login/', code=303)
+        if not is_admin:
+            return redirect(host_url + '/index/', code=303)
+
+        title = request.form['title']
+        content = request.form['content']
+        visibility = False
+        if 'is_visible' in request.form:
+            is_visible = request.form['is_visible']
+            visibility = True if is_visible == 'on' else False
+        tags = blog_service.parse_tags(request.form.get('tags'))
+        post = blog_service.add_post(
+            title, content, user, tags, make_visible=visibility)
+        message = "Posted Successfully. <a href=\"/posts/{}\" class=\"alert-link\">View Post.</a>".format(
+            post.id)
+        return render_template('editpost.html', post=post, success_message=message)
+    elif request.method == 'GET':
+        if id is not None:
+            response = fresh_post_page(id)
+            if response is not None:
+                return response
+            lookup = lookup_post_page(id, blog_service.fetch_post_stamp(id), is_admin)
+            if lookup.response is not None:
+                return lookup.response
+            post = blog_service.fetch_post_by_id(id, 'view')
+            check_post_visible(post, is_admin)
+            comments = blog_service.fetch_comments_page(id)
+            like_count = blog_service.fetch_like_count(post)
+            liked = user is not None and blog_service.is_post_liked(
+                id, user)
+            return lookup.store(render_post_page(post, comments, like_count, liked))
+        if is_admin:
+            return render_template('addpost.html')
+        elif not is_loggedin():
+            return redirect(host_url + '/login/', code=303)
+        else:
+            abort(403, description="Post not found")
+
+
+@blog.route('/editpost/<int:id>/', methods=['GET', 'POST'])
+@QueryBudget(16)
+def edit_post(id):
+    '''
+    Route for "edit post" page and for submitting "edit post" form, for admins
+    '''
+
+    is_admin = False
+
+    if is_loggedin():
+        user = get_current_identity()
+        is_admin = user is not None and user.type == 'admin'
+    else:
+        return redirect(host_url + '/login/', code=303)
+
+    if not is_admin:
+        abort(403, "Only admin can edit posts")
+
+    if request.method == 'GET':
+        if id is not None:
+            post = blog_service.fetch_post_by_id(id, 'edit')
+            if post is None:
+                abort(404, description="Post not found")
+            return render_template('editpost.html', post=post)
+        else:
+            abort(404, description="Post not found")
+
+    if request.method == 'POST':
+        if id is not None:
+            title = request.form['title']
+            content = request.form['content']
+            visibility = False
+            if 'is_visible' in request.form:
+                is_visible = request.form['is_visible']
+                visibility = True if is_visible == 'on' else False
+            tags = blog_service.parse_tags(request.form.get('tags'))
+            post = blog_service.edit_post(
+                id, title, content, tags, make_visible=visibility)
+            if post is None:
+                abort(404, description="Post not found")
+
+            message = "Post Updated Successfully.<a href=\"/posts/{}\" class=\"alert-link\">View Post.</a>".format(
+                post.id)
+            return render_template('editpost.html', post=post, success_message=message)
+        else:
+            abort(404, description="Post not found")
+
+
+@blog.route('/posts/<int:post_id>/comments/', methods=['GET', 'POST'])
+@QueryBudget(9)
+def add_post_comment(post_id):
+    '''
+    Route for adding comments to the blog posts - for registered users
+    Also for loading the next page of comments of a blog post, as an HTML fragment - for all users
+    '''
+
+    if request.method == 'GET':
+        user = get_current_identity()
+        is_admin = user is not None and user.type == 'admin'
+
+        check_post_visible(blog_service.fetch_post_stamp(post_id), is_admin)
+        try:
+            comments = blog_service.fetch_comments_page(
+                post_id, request.args.get('after'))
+        except ValueError:
+            abort(400, description="Invalid page")
+        return render_template('comments.html', post_id=post_id, comments=comments)
+
+    if request.method == 'POST':
+        if is_loggedin():
+            user = get_current_identity()
+
+            content = request.form['comment']
+            if Config.COMMENT_INGEST_MODE == 'batched':
+                try:
+                    ticket = comment_ingest_queue.submit(
+                        post_id, content, user)
+                    added = ticket.wait(Config.COMMENT_ACK_TIMEOUT_MS / 1000)
+                except (queue.Full, TimeoutError):
+                    # The comment was not written and will not be, so trying again cannot duplicate it
+                    abort(503, description="Too many comments are being posted. Please try again.")
+                if not added:
+                    abort(404, description="Post not found")
+            else:
+                post = blog_service.add_comment(post_id, content, user)
+                if post is None:
+                    abort(404, description="Post not found")
+            return redirect(host_url + '/posts/'+str(post_id), code=303)
+        else:
+            return redirect(host_url + '/login/', code=303)
+
+
+@blog.route('/posts/<int:post_id>/likes/', methods=['POST'])
+@QueryBudget(3)
+def like_post(post_id):
+    '''
+    Route for liking or unliking a blog post - for registered users
+    '''
+
+    user = get_current_identity()
+    if user is None:
+        return redirect(host_url + '/login/', code=303)
+    is_admin = user.type == 'admin'
+
+    stamp = blog_service.fetch_post_stamp(post_id)
+    if stamp is None or (not stamp.is_visible and not is_admin):
+        abort(404, description="Post not found")
+    liked = request.form.get('liked', 'true') == 'true'
+    blog_service.like_post(post_id, user, liked)
+    return redirect(host_url + '/posts/'+str(post_id), code=303)
+
+
+@blog.route('/deletepost/<int:id>/', methods=['GET'])
+@QueryBudget(14)
+def delete_post_comment(id):
+    '''
+    Route for deleting a blog post - for admins
+    '''
+
+    if request.method == 'GET':
+        is_admin = False
+
+        if is_loggedin():
+            user = get_current_identity()
+            is_admin = user is not None and user.type == 'admin'
+            if is_admin:
+                blog_service.delete_post(id)
+                return redirect(host_url + '/', code=303)
+            else:
+                abort(403, 'Only admin can delete posts')
+        else:
+            return redirect(host_url + '/login/', code=303)
+
+
+@blog.route('/api/posts')
+@QueryBudget(3)
+def api_posts():
+    '''
+    JSON API route for the blog post listing, newest first, streamed one post at a time
+    Supports cursor pagination (after, limit), a tag filter and sparse fieldsets (fields=id,title)
+    Administrators can also see unpublished posts
+    '''
+
+    user = get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    tag = request.args.get('tag')
+    try:
+        fields = blog_service.parse_fields(
+            request.args.get('fields'), POST_API_FIELDS)
+        posts = blog_service.stream_posts(fields, is_admin, request.args.get('after'), api_page_size(),
+                                          tag.strip().lower() if tag else None)
+    except ValueError as e:
+        return api_error(400, str(e))
+    return json_stream_response('posts', posts)
+
+
+@blog.route('/api/posts/<int:id>')
+@QueryBudget(3)
+def api_post(id):
+    '''
+    JSON API route for a blog post, with sparse fieldsets (fields=id,title)
+    Administrators can also see unpublished posts
+    '''
+
+    user = get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    try:
+        fields = blog_service.parse_fields(
+            request.args.get('fields'), POST_API_FIELDS)
+    except ValueError as e:
+        return api_error(400, str(e))
+    post = blog_service.fetch_post_record(id, fields, is_admin)
+    if post is None:
+        return api_error(404, "Post not found")
+    return Response(json.dumps({name: json_value(value) for name, value in post.items()}),
+                    mimetype='application/json')
+
+
+@blog.route('/api/posts/<int:post_id>/comments')
+@QueryBudget(3)
+def api_post_comments(post_id):
+    '''
+    JSON API route for the comments of a blog post, oldest first, streamed one comment at a time
+    Supports cursor pagination (after, limit) and sparse fieldsets (fields=id,content)
+    '''
+
+    user = get_current_identity()
+    is_admin = user is not None and user.type == 'admin'
+
+    stamp = blog_service.fetch_post_stamp(post_id)
+    if stamp is None or (not stamp.is_visible and not is_admin):
+        return api_error(404, "Post not found")
+    try:
+        fields = blog_service.parse_fields(
+            request.args.get('fields'), COMMENT_API_FIELDS)
+        comments = blog_service.stream_comments(
+            post_id, fields, request.args.get('after'), api_page_size())
+    except ValueError as e:
+        return api_error(400, str(e))
+    return json_stream_response('comments', comments)
+
+
+@blog.route('/metrics')
+@QueryBudget(0)
+def metrics():
+    '''
+    Route for the request, SQL and cache metrics in the Prometheus text format
+    '''
+
+    if not Config.METRICS_ENABLED:
+        abort(404)
+    gauges = {'page_cache': page_cache.stats(), 'comment_queue': comment_ingest_queue.stats(),
+              'likes': like_aggregator.stats(), 'worker': startup_metrics.stats()}
+    return Response(request_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@blog.route('/metrics/slow-queries')
+@QueryBudget(1)
+def slow_queries():
+    '''
+    JSON route for the most recent slow SQL statements, with their parameters redacted - for admins
+    '''
+
+    if not Config.METRICS_ENABLED:
+        abort(404)
+    user = get_current_identity()
+    if user is None or user.type != 'admin':
+        return api_error(403, "Only admin can view slow queries")
+    return jsonify({'slow_query_ms': Config.SLOW_QUERY_MS, 'samples': request_metrics.slow_query_samples()})
+
+
+@blog.cli.command('init-db')
+def init_db_command():
+    '''
+    Command for creating the database schema and the default admin, run once before starting the server.
+    Running it again keeps the existing tables and admin, and applies the schema migrations added since.
+    '''
+
+    init_db()
+    setup_admin(user_service)
+    db_session.remove()
+    print("Database initialized at schema version {}".format(schema_migrator.current_version()))
+
+
+@blog.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    '''
+    Command for indexing all existing blog posts and comments for search
+    '''
+
+    blog_service.rebuild_search_index()
+    db_session.remove()
+    print("Search index rebuilt")
+
+
+@blog.cli.command('sync-replica')
+def sync_replica():
+    '''
+    Command for copying an SQLite database to its replica file, standing in for replication when testing locally
+    '''
+
+    if replica_engine is None or engine.url.get_backend_name() != 'sqlite' \
+            or replica_engine.url.get_backend_name() != 'sqlite':
+        raise click.ClickException("DATABASE_URL and REPLICA_DATABASE_URL must both be SQLite files")
+    primary, replica = engine.raw_connection(), replica_engine.raw_connection()
+    try:
+        primary.connection.backup(replica.connection)
+    finally:
+        replica.close()
+        primary.close()
+    print("Copied {} to {}".format(engine.url.database, replica_engine.url.database))
+
+
+@blog.cli.command('render-posts')
+@click.option('--batch-size', type=int, default=RENDER_BATCH_SIZE, help="Posts rendered per transaction.")
+@click.option('--all', 'rerender', is_flag=True, help="Also render the posts that are already rendered.")
+def render_posts(batch_size, rerender):
+    '''
+    Command for rendering the HTML and excerpt of existing blog posts
+    '''
+
+    rendered = blog_service.render_stored_posts(batch_size, rerender)
+    db_session.remove()
+    print("Rendered {} posts".format(rendered))
+
+
+@blog.cli.command('compute-reputation')
+@click.option('--batch-size', type=int, default=REPUTATION_BATCH_SIZE, help="Comments or likes read at a time.")
+def compute_reputation(batch_size):
+    '''
+    Command for updating user reputation and badges from the comments and likes added since the last run,
+    meant to be run periodically, e.g. from cron
+    '''
+
+    counts = ReputationEngine(batch_size).run()
+    print("Counted {comments} comments and {likes} likes, reputation of {users} users changed, "
+          "{badges} badges awarded".format(**counts))
+
+
+@blog.cli.command('import-data')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help="Format of the file.")
+@click.option('--type', 'record_type', type=click.Choice(RECORD_TYPES), default=None,
+              help="Type of the records of a CSV file.")
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="Records inserted per transaction.")
+@click.option('--resume', is_flag=True, help="Skip the records loaded by a previous run.")
+@click.option('--source', default=None, help="Name the checkpoint is kept under, defaults to the path.")
+def import_data(path, file_format, record_type, batch_size, resume, source):
+    '''
+    Command for loading users, posts, tags, comments and likes from an NDJSON or CSV file
+    '''
+
+    init_db()
+    imported = BulkImporter(batch_size).import_file(
+        path, file_format, record_type, resume, source)
+    db_session.remove()
+    page_cache.clear()
+    print("Imported {} records".format(imported))
+
+
+@blog.cli.command('export-data')
+@click.argument('path', default='-')
+@click.option('--fetch-size', type=int, default=EXPORT_FETCH_SIZE, help="Rows fetched from the database at a time.")
+def export_data(path, fetch_size):
+    '''
+    Command for writing all users, posts, tags, comments and likes as NDJSON, to a file or "-" for stdout
+    '''
+
+    with click.open_file(path, 'w') as file:
+        exported = BulkExporter(fetch_size).export_ndjson(file)
+    db_session.remove()
+    if path != '-':
+        print("Exported {} records".format(exported))
+
+
+@blog.before_app_request
+def route_reads():
+    '''
+    Handler for keeping the reads of users who just changed data on the primary database, so they see their
+    changes while the read replica catches up
+    '''
+
+    if replica_engine is not None:
+        pin_primary(wrote_recently())
+
+
+@blog.after_app_request
+def track_writes(response):
+    '''
+    Handler for remembering when a logged in user last changed data, see route_reads
+    '''
+
+    if replica_engine is not None and request.method not in ('GET', 'HEAD') and response.status_code < 400 \
+            and is_loggedin():
+        mark_write()
+    return response
+
+
+@blog.before_app_request
+def start_request_metrics():
+    '''
+    Handler for timing each request and the SQL statements it runs
+    '''
+
+    if Config.METRICS_ENABLED:
+        request_metrics.start_request()
+
+
+@blog.after_app_request
+def record_request_metrics(response):
+    '''
+    Handler for recording the metrics of each request, and reporting them in a Server-Timing header if enabled,
+    along with the time to first request of the worker.
+    Registered before the compression handler so that it runs after it, and the time includes compression.
+    Streamed responses are measured up to their first byte.
+    '''
+
+    startup_metrics.request_served()
+    timer = request_metrics.finish_request(request.endpoint or 'unmatched', request.method,
+                                           response.status_code)
+    if timer is not None and Config.SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(timer)
+    return response
+
+
+@blog.after_app_request
+def compress(response):
+    '''
+    Handler for compressing responses in the encoding accepted by the client
+    '''
+
+    return compress_response(response)
+
+
+def shutdown_session(exception=None):
+    '''
+    Handler for disposing database sessions after each request lifecycle
+    '''
+
+    db_session.remove()
+
+
+def posts_listing_response(route, is_admin, tag=None):
+    '''
+    Render a page of the blog post listing, optionally limited to a tag, through the page cache
+    '''
+
+    response = fresh_listing_page(route, tag)
+    if response is not None:
+        return response
+    lookup = lookup_listing_page(route, blog_service.fetch_listing_stamp(), tag)
+    if lookup.response is not None:
+        return lookup.response
+    try:
+        page = blog_service.fetch_posts_page(
+            is_admin, request.args.get('after'), profile='list', tag=tag)
+    except ValueError:
+        abort(400, description="Invalid page")
+    tag_counts = blog_service.fetch_tag_counts() if tag is None else []
+    return lookup.store(render_listing_page(page, tag, tag_counts))
+
+
+def feed_response(route, template, mimetype):
+    '''
+    Render a feed of the latest published blog posts through the page cache.
+    The serialized feed is cached by feed version, which only changes when one of its posts does,
+    and polling clients that already have the current version get a 304.
+    Feeds are the same for every viewer, so shared caches may store them.
+    '''
+
+    stamp = blog_service.fetch_feed_stamp()
+    version = stamp.version if stamp is not None else 0
+    last_modified = stamp.updated_at if stamp is not None else None
+    base_url = request.url_root.rstrip('/')
+    lookup = lookup_page(route, None, None, make_etag(route, (version, base_url)), last_modified, public=True)
+    response = lookup.response
+    if response is None:
+        response = lookup.store(render_template(template, posts=blog_service.fetch_feed_posts(),
+                                                base_url=base_url, updated=last_modified or datetime.now()))
+    response.mimetype = mimetype
+    return response
+
+
+def api_page_size():
+    '''
+    Read the page size of a JSON API listing from the limit parameter
+    '''
+
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    if not 1 <= limit <= API_MAX_PAGE_SIZE:
+        raise ValueError(
+            "limit must be between 1 and {}".format(API_MAX_PAGE_SIZE))
+    return limit
+
+
+def api_error(status, message):
+    '''
+    Build a JSON API error response
+    '''
+
+    return jsonify({'error': message}), status
+
+
+def json_value(value):
+    '''
+    Convert a value of a JSON API record to JSON, writing timestamps in ISO 8601 format
+    '''
+
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def json_stream_response(key, records):
+    '''
+    Build a streamed JSON response of the form {key: [records], "next_cursor": cursor},
+    encoding each record as it is produced instead of building the whole document in memory
+    '''
+
+    def generate():
+        yield '{{"{}": ['.format(key)
+        separator = ''
+        for record in records:
+            yield separator + json.dumps({name: json_value(value) for name, value in record.items()})
+            separator = ','
+        yield '], "next_cursor": {}}}'.format(json.dumps(records.next_cursor))
+
+    return Response(stream_with_context(generate()), mimetype='application/json')